@@ -6,6 +6,9 @@ from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from tg_bot.config import load_config
 from tg_bot.handlers import register_all_handlers
 from tg_bot.handlers.subscription import ActivityMiddleware
+from tg_bot.services.jobs import report_jobs
+from tg_bot.services.workbooks import start_workbook_pool
+from tg_bot.services.anomalies import push_anomalies
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 logger = logging.getLogger(__name__)
 
@@ -51,9 +54,14 @@ async def main():
 
     register_all_handlers(dp)
 
+    # Фоновые задачи отчётов: доставка через бота и перезапуск прерванных
+    await report_jobs.start(bot)
+    start_workbook_pool()
+
     # --- Здесь запускаем планировщик ---
     scheduler = AsyncIOScheduler()
     scheduler.add_job(cleanup_inactive_users, 'interval', days=1)
+    scheduler.add_job(push_anomalies, 'interval', minutes=30, args=[bot])
     scheduler.start()
     # ------------------------------------
 
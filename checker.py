@@ -1,4 +1,9 @@
 from tg_bot.models import Shop, engine, sessionmaker, Order
+from tg_bot.services.dedup import dedup_orders
+from tg_bot.services.articles import register_articles
+from tg_bot.services.elasticity import refresh_elasticity
+from tg_bot.services.order_cube import touched_days, refresh_order_cube
+from tg_bot.services.funnel import refresh_funnel
 import requests
 import time
 from datetime import datetime, timedelta
@@ -10,7 +15,7 @@ def get_orders(api_token, start_date):
     params = {'dateFrom': start_date.isoformat(), 'flag': 0}
     response = requests.get('https://statistics-api.wildberries.ru/api/v1/supplier/orders', headers=headers,
                             params=params)
-    return response.json()
+    return dedup_orders(response.json())
 
 
 def get_buys(api_token, start_date):
@@ -18,7 +23,7 @@ def get_buys(api_token, start_date):
     params = {'dateFrom': start_date.isoformat(), 'flag': 0}
     response = requests.get('https://statistics-api.wildberries.ru/api/v1/supplier/sales', headers=headers,
                             params=params)
-    return response.json()
+    return dedup_orders(response.json())
 
 
 def save_order_data(session, order_data, account_id):
@@ -97,6 +102,12 @@ def checker():
                     continue
                 buys_data = get_buys(account.api_token, start_date)
                 is_skip = session.query(Order).filter(Order.shop_id == account.id).first() == None
+                # Дни куба заказов, которые затронет загрузка (до merge — он перезаписывает дату)
+                try:
+                    cube_days = touched_days(session, account.id, list(orders_data) + list(buys_data))
+                except Exception as E:
+                    print(E)
+                    cube_days = None
                 try:
                     for order_data in orders_data:
                         save_order_data(session, order_data, account.id)
@@ -113,6 +124,34 @@ def checker():
                         session.commit()
                     except Exception as E:
                         print(E, buy_data)
+
+                # Новые артикулы — в справочник (шаблон себестоимости пересоберётся)
+                try:
+                    register_articles(session, account.id, (
+                        (row.get('supplierArticle'), row.get('nmId'), row.get('subject'))
+                        for row in list(orders_data) + list(buys_data) if isinstance(row, dict)
+                    ))
+                    session.commit()
+                except Exception as E:
+                    session.rollback()
+                    print(E)
+
+                # Куб заказов и воронка: пересчёт только затронутых дней
+                try:
+                    refresh_order_cube(session, account.id, cube_days)
+                    refresh_funnel(session, account.id, cube_days)
+                    session.commit()
+                except Exception as E:
+                    session.rollback()
+                    print(E)
+
+                # Эластичность спроса: только новые устоявшиеся дни заказов
+                try:
+                    refresh_elasticity(session, account.id)
+                    session.commit()
+                except Exception as E:
+                    session.rollback()
+                    print(E)
             except Exception as e:
                 print(f"Error processing account {account.id}: {e}")
     finally:
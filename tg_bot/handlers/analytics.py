@@ -1,6 +1,5 @@
 from aiogram import types
 import asyncio
-from tg_bot.services.wb_api import fetch_report_detail_by_period
 from aiogram.dispatcher import FSMContext, Dispatcher
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InputFile
 from aiogram.utils.exceptions import MessageNotModified
@@ -13,7 +12,6 @@ from tg_bot.models import (
     TaxSystemSetting,
     RegularExpense,
     TaxSystemType,
-    CashedShopData,
     OneTimeExpense,
     Advertisement,
     Penalty,
@@ -26,17 +24,32 @@ from tg_bot.keyboards.analytics_menu import (
     period_keyboard,
     period_keyboard2,
 )
-from tg_bot.services.wb_api import fetch_full_report
+from tg_bot.services.shop_dataset import get_shop_frame, PROMOTION_BONUS_TYPE
+from tg_bot.services.fresh_fetch import fetch_report_with_deadline, wait_fresh_report, freshness_note
+from tg_bot.services.jobs import report_jobs, job_runner, job_key, JobResult
+from tg_bot.services.workbooks import build_workbook, product_analytics_workbook, scenario_workbook, order_cube_workbook
+from tg_bot.services.artifacts import cached_report
+from tg_bot.services.profitability import (
+    PROFITABILITY_LEVELS,
+    get_article_profitability,
+    get_profitability_rows,
+)
+from tg_bot.services.ranking import RANKING_METRICS, get_ranked_products
+from tg_bot.services.simulator import simulate_grid, simulate_one, run_simulation
+from tg_bot.services.forecast import get_shop_forecast, FORECAST_HISTORY_DAYS
+from tg_bot.services.anomalies import get_recent_anomalies, format_anomaly
+from tg_bot.services.abc_xyz import get_catalog_classification, ABC, XYZ, ABC_XYZ_WEEKS, XYZ_CV
+from tg_bot.services.order_cube import get_cube_slice, cube_window, DIMENSION_TITLES
+from tg_bot.services.funnel import funnel_metrics
 from dateutil.relativedelta import relativedelta
 from datetime import datetime, timedelta
 import math
 import io
+import heapq
+import numpy as np
+from sqlalchemy import func
 import logging
-import openpyxl
 import json
-from openpyxl.styles import Font, PatternFill, Border, Side, Alignment
-from openpyxl.utils import get_column_letter
-from openpyxl import load_workbook
 
 
 logger = logging.getLogger(__name__)
@@ -54,93 +67,6 @@ async def analytics_callback(callback: types.CallbackQuery):
 
 
 # Обработчики для подменю
-PROFITABILITY_LEVELS = [
-    {
-        "min": -float("inf"),
-        "max": 20,
-        "name": "⚠️ Низкая доходность",
-        "characteristics": "Плохая рентабельность, высокие риски или низкая маржинальность.",
-        "reasons": "Высокая конкуренция, большие расходы на логистику/хранение, низкие наценки.",
-        "conclusion": "Такой бизнес невыгоден, нужно пересматривать модель.",
-        "recommendations": [
-            "Срочно пересмотрите ценовую политику и себестоимость.",
-            "Ищите более выгодных поставщиков или сокращайте логистические издержки.",
-            "Проверьте скрытые расходы (хранение, возвраты, реклама) и оптимизируйте их.",
-            "Если рост невозможен – рассмотрите закрытие или смену ниши.",
-        ],
-        "action": "Оптимизировать или уходить",
-    },
-    {
-        "min": 20,
-        "max": 40,
-        "name": "⚠️ Ниже среднего",
-        "characteristics": "Минимально приемлемая рентабельность, но требует оптимизации.",
-        "reasons": "Средняя конкуренция, умеренные издержки.",
-        "conclusion": "Высокий риск уйти в ноль или минус из-за внешних факторов.",
-        "recommendations": [
-            "Увеличивайте маржу через улучшение упаковки, допродажи или брендинг.",
-            "Автоматизируйте процессы для снижения операционных затрат.",
-            "Тестируйте новые рекламные каналы для увеличения продаж.",
-            "Анализируйте конкурентов на предмет более выгодных товаров.",
-        ],
-        "action": "Улучшать и тестировать другие товары",
-    },
-    {
-        "min": 40,
-        "max": 60,
-        "name": "✅ Средняя доходность",
-        "characteristics": "Нормальный уровень для стабильного бизнеса.",
-        "reasons": "Хороший спрос, грамотное ценообразование, контроль затрат.",
-        "conclusion": "Устойчивый бизнес, можно масштабировать.",
-        "recommendations": [
-            "Фокусируйтесь на стабильности: контролируйте качество и сервис.",
-            "Расширяйте ассортимент в нише для увеличения среднего чека.",
-            "Инвестируйте в лояльность клиентов (отзывы, рассылки).",
-            "Тестируйте смежные ниши с более высокой маржой.",
-        ],
-        "action": "Закрепляться и расти",
-    },
-    {
-        "min": 60,
-        "max": 100,
-        "name": "🔥 Высокая доходность",
-        "characteristics": "Очень хорошая рентабельность, перспективный бизнес.",
-        "reasons": "Уникальный товар, низкая конкуренция, эффективные рекламные каналы.",
-        "conclusion": "Отличный результат, стоит вкладывать больше ресурсов.",
-        "recommendations": [
-            "Активно масштабируйте: выходите на новые маркетплейсы или рынки.",
-            "Усиливайте бренд и работайте с повторными продажами.",
-            "Диверсифицируйте поставщиков для снижения рисков.",
-            "Инвестируйте часть прибыли в новые высокомаржинальные товары.",
-        ],
-        "action": "Масштабировать и защищать",
-    },
-    {
-        "min": 100,
-        "max": float("inf"),
-        "name": "✨ Премиальная доходность",
-        "characteristics": "Высокомаржинальный бизнес, часто нишевый.",
-        "reasons": "Эксклюзивные товары, VIP-сегмент, отсутствие прямых аналогов.",
-        "conclusion": "Редкий и ценный кейс, требует защиты позиций.",
-        "recommendations": [
-            "Укрепляйте эксклюзивность через товарный знак и уникальные условия с поставщиками.",
-            "Создавайте финансовую подушку безопасности.",
-            "Масштабируйте до точки максимальной эффективности.",
-            "Мониторьте динамику прибыли и будьте готовы к поиску новых товаров.",
-        ],
-        "action": "Укреплять позиции или выжимать все соки",
-    },
-]
-
-
-def get_profitability_level(profitability):
-    """Определение уровня доходности по проценту рентабельности"""
-    for level in PROFITABILITY_LEVELS:
-        if level["min"] <= profitability < level["max"]:
-            return level
-    return PROFITABILITY_LEVELS[0]  # По умолчанию низкая доходность
-
-
 async def profitability_estimation_callback(
     callback: types.CallbackQuery, state: FSMContext
 ):
@@ -155,89 +81,16 @@ async def profitability_estimation_callback(
     async with state.proxy() as data:
         data["analytics_type"] = "profitability"
         data["article_page"] = 0
+        data["profitability_level"] = None
 
     await show_articles_page(callback, state)
 
 
-async def calculate_profitability_for_article(article, shop_id, api_token):
-    """Расчет доходности для конкретного артикула"""
-    end_date = datetime.utcnow()
-    start_date = end_date - timedelta(days=30)
-
-    # Получаем отчет за последний месяц
-    report = await fetch_full_report(api_token, start_date, end_date)
-    if not report:
-        return None
-
-    print("FLAG0")
-    # for i in report:
-    # print(i['nm_id'])
-    # Фильтруем данные по выбранному артикулу
-    article_data = [item for item in report if item.get("nm_id") == article]
-    print("FLAG0.5")
-    print(article_data)
-    if not article_data:
-        return None
-    print("FLAG1")
-    # Рассчитываем показатели
-    total_quantity = sum(item.get("quantity", 0) for item in article_data)
-    total_revenue = sum(
-        item.get("retail_price_withdisc_rub", 0) for item in article_data
-    )
-    total_commission = -sum(
-        item.get("ppvz_sales_commission", 0)
-        + item.get("ppvz_vw", 0)
-        + item.get("ppvz_vw_nds", 0)
-        for item in article_data
-    )
-    print("FLAG2")
-
-    # Рассчитываем общие расходы для распределения
-    total_logistics = sum(item.get("delivery_rub", 0) for item in report)
-    total_storage = sum(item.get("storage_fee", 0) for item in report)
-    total_revenue_all = sum(item.get("retail_price_withdisc_rub", 0) for item in report)
-
-    # Распределяем логистику и хранение пропорционально выручке
-    logistics_share = (
-        total_logistics * (total_revenue / total_revenue_all)
-        if total_revenue_all
-        else 0
-    )
-    storage_share = (
-        total_storage * (total_revenue / total_revenue_all) if total_revenue_all else 0
-    )
-    print("FLAG3")
-    # Получаем себестоимость
-    session = sessionmaker()(bind=engine)
-    try:
-        product_cost = (
-            session.query(ProductCost)
-            .filter(ProductCost.shop_id == shop_id, ProductCost.article == article)
-            .first()
-        )
-        cost_per_item = product_cost.cost if product_cost else 0
-    finally:
-        session.close()
-
-    total_cost = cost_per_item * total_quantity
-    total_expenses = total_commission + logistics_share + storage_share + total_cost
+async def calculate_profitability_for_article(article, shop_id):
+    """Расчет доходности для конкретного артикула по локальным данным магазина"""
+    return await get_article_profitability(shop_id, article)
 
-    # Рассчитываем прибыль и рентабельность
-    net_profit = total_revenue - total_expenses
-    profitability = (net_profit / total_revenue) * 100 if total_revenue else 0
 
-    return {
-        "revenue": total_revenue,
-        "cost": total_cost,
-        "commission": total_commission,
-        "logistics": logistics_share,
-        "storage": storage_share,
-        "expenses": total_expenses,
-        "net_profit": net_profit,
-        "profitability": profitability,
-        "quantity": total_quantity,
-        "cost_per_item": cost_per_item,
-    }
 def get_comm(comission, category):
     for cat in comission["report"]:
         if cat["parentName"] == category:
@@ -250,7 +103,6 @@ async def show_profitability_report(
     async with state.proxy() as data:
         shop_id = data["shop"]["id"]
         shop_name = data["shop"]["name"] or f"Магазин {shop_id}"
-        api_token = data["shop"]["api_token"]
 
     # Показываем сообщение о загрузке
     await callback.message.edit_text(
@@ -261,7 +113,7 @@ async def show_profitability_report(
     )
 
     # Рассчитываем показатели
-    metrics = await calculate_profitability_for_article(article, shop_id, api_token)
+    metrics = await calculate_profitability_for_article(article, shop_id)
 
     if not metrics:
         await callback.message.edit_text(
@@ -269,13 +121,13 @@ async def show_profitability_report(
             "Возможные причины:\n"
             "1. Нет данных о продажах за последний месяц\n"
             "2. Не загружена себестоимость товара\n"
-            "3. Проблемы с подключением к WB API"
+            "3. Отчет магазина еще не загружен"
         )
         return
 
     # Определяем уровень доходности
     profitability = metrics["profitability"]
-    level = get_profitability_level(profitability)
+    level = PROFITABILITY_LEVELS[metrics["level"]]
 
     # Форматируем отчет
     text = (
@@ -315,67 +167,40 @@ async def show_profitability_report(
     await callback.message.edit_text(text, reply_markup=keyboard)
 
 
-async def get_top_profitable_products(api_token: str, shop_id: int):
-    end_date = datetime.utcnow()
-    start_date = end_date - timedelta(days=30)
-    report = await fetch_full_report(api_token, start_date, end_date)
-    if not report:
-        return []
-
-    session = sessionmaker()(bind=engine)
+async def get_top_profitable_products(shop_id: int, metric="profit", page=0, bottom=False):
+    """Страница рейтинга артикулов за 30 дней: (элементы, есть ли следующая страница)"""
     try:
-        products = {}
-
-        for item in report:
-            article = item.get("sa_name")
-            if not article:
-                continue
-
-            quantity = item.get("quantity", 0)
-            revenue = item.get("retail_price_withdisc_rub", 0) * quantity
-            commission = (
-                item.get("ppvz_sales_commission", 0)
-                + item.get("ppvz_vw", 0)
-                + item.get("ppvz_vw_nds", 0)
-            )
-            logistics = item.get("delivery_rub", 0) / len(report) * quantity + item.get("rebill_logistic_cost", 0) / len(report) * quantity
-            storage = item.get("storage_fee", 0) / len(report) * quantity
-
-            product_cost = (
-                session.query(ProductCost)
-                .filter(ProductCost.shop_id == shop_id, ProductCost.article == article)
-                .first()
-            )
-            cost = product_cost.cost if product_cost else 0
-
-            profit = revenue - (cost * quantity + commission + logistics + storage)
-
-            if article not in products:
-                products[article] = {
-                    "revenue": 0,
-                    "cost": cost,
-                    "quantity": 0,
-                    "profit": 0,
-                }
+        return await get_ranked_products(shop_id, metric, page, bottom=bottom)
+    except Exception as e:
+        logger.error(f"Ошибка расчета рейтинга товаров: {e}")
+        return [], False
 
-            products[article]["revenue"] += revenue
-            products[article]["quantity"] += quantity
-            products[article]["profit"] += profit
 
-        sorted_products = sorted(
-            products.items(), key=lambda x: x[1]["profit"], reverse=True
+def ranking_keyboard(metric, bottom, page, has_more):
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    direction = "b" if bottom else "t"
+    keyboard.add(*[
+        InlineKeyboardButton(
+            f"• {title}" if name == metric else title, callback_data=f"rank:{name}:{direction}:0"
         )
-
-        return sorted_products[:5]
-
-    except Exception as e:
-        logger.error(f"Ошибка расчета топ-5 товаров: {e}")
-        return []
-    finally:
-        session.close()
+        for name, (title, _, _) in RANKING_METRICS.items()
+    ])
+    keyboard.add(InlineKeyboardButton(
+        "⬆️ Лучшие" if bottom else "⬇️ Худшие", callback_data=f"rank:{metric}:{'t' if bottom else 'b'}:0"
+    ))
+    pagination_row = []
+    if page > 0:
+        pagination_row.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"rank:{metric}:{direction}:{page - 1}"))
+    if has_more:
+        pagination_row.append(InlineKeyboardButton("Вперед ➡️", callback_data=f"rank:{metric}:{direction}:{page + 1}"))
+    if pagination_row:
+        keyboard.row(*pagination_row)
+    keyboard.add(InlineKeyboardButton("🔙 Назад", callback_data="analytics"))
+    return keyboard
 
 
 async def top5_products_callback(callback: types.CallbackQuery, state: FSMContext):
+    """Рейтинг товаров: callback top5_products или rank:<метрика>:<t|b>:<страница>"""
     async with state.proxy() as data:
         if "shop" not in data:
             await callback.answer("❌ Сначала выберите магазин", show_alert=True)
@@ -383,52 +208,264 @@ async def top5_products_callback(callback: types.CallbackQuery, state: FSMContex
 
         shop_id = data["shop"]["id"]
         shop_name = data["shop"]["name"] or f"Магазин {shop_id}"
-        api_token = data["shop"]["api_token"]
 
-    await callback.message.edit_text(
-        "⏳ <b>Расчет топ-5 самых прибыльных товаров</b>\n\n"
-        f"Магазин: {shop_name}\n"
-        "Период: последний месяц\n\n"
-        "Подождите, идет расчет..."
-    )
+    metric, bottom, page = "profit", False, 0
+    if callback.data.startswith("rank:"):
+        _, metric, direction, page = callback.data.split(":")
+        bottom, page = direction == "b", int(page)
+    if metric not in RANKING_METRICS:
+        await callback.answer()
+        return
+    title, value_format, _ = RANKING_METRICS[metric]
 
-    top_products = await get_top_profitable_products(api_token, shop_id)
+    top_products, has_more = await get_top_profitable_products(shop_id, metric, page, bottom)
 
-    if not top_products:
+    if not top_products and page == 0:
         await callback.message.edit_text(
             "❌ <b>Не удалось получить данные</b>\n\n"
             "Проверьте, что:\n"
-            "1. У вас есть подключение к интернету\n"
-            "2. API-токен WB действителен\n"
-            "3. Загружены данные себестоимости"
+            "1. Отчет магазина уже загружен\n"
+            "2. За последний месяц были продажи\n"
+            "3. Загружены данные себестоимости",
+            reply_markup=ranking_keyboard(metric, bottom, page, False),
         )
         return
 
     text = (
-        f"🏆 <b>Топ-5 самых прибыльных товаров</b>\n\n"
+        f"🏆 <b>{'Худшие' if bottom else 'Лучшие'} товары: {title.lower()}</b>\n\n"
         f"Магазин: {shop_name}\n"
-        "Период: последний месяц\n\n"
+        f"Период: последний месяц, страница {page + 1}\n\n"
     )
 
-    for i, (article, data) in enumerate(top_products):
-        profit = data["profit"]
-        revenue = data["revenue"]
-        quantity = data["quantity"]
-        cost = data["cost"]
-
+    for item in top_products:
         text += (
-            f"{i+1}. <b>{article}</b>\n"
-            f"   Прибыль: {profit:.2f} руб.\n"
-            f"   Выручка: {revenue:.2f} руб.\n"
-            f"   Продано: {quantity} шт.\n"
-            f"   Себестоимость: {cost:.2f} руб./шт.\n\n"
+            f"{item['place']}. <b>{item['article']}</b> ({item['nm_id']})\n"
+            f"   {title}: {value_format.format(item['value'])}\n"
+            f"   Прибыль: {item['profit']:.2f} руб.\n"
+            f"   Выручка: {item['revenue']:.2f} руб.\n"
+            f"   Продано: {item['quantity']} шт.\n\n"
         )
 
     text += "<i>Примечание: расчет включает себестоимость, комиссии, логистику и хранение</i>"
 
+    try:
+        await callback.message.edit_text(text, reply_markup=ranking_keyboard(metric, bottom, page, has_more))
+    except MessageNotModified:
+        await callback.answer()
+
+
+async def forecast_callback(callback: types.CallbackQuery, state: FSMContext):
+    """Прогноз выручки и прибыли магазина и товаров по тренду последних месяцев"""
+    async with state.proxy() as data:
+        if "shop" not in data:
+            await callback.answer("❌ Сначала выберите магазин", show_alert=True)
+            return
+        shop_id = data["shop"]["id"]
+        shop_name = data["shop"]["name"] or f"Магазин {shop_id}"
+
+    forecast = await get_shop_forecast(shop_id)
     keyboard = InlineKeyboardMarkup()
     keyboard.add(InlineKeyboardButton("🔙 Назад", callback_data="analytics"))
+    if not len(forecast.nm_ids):
+        await callback.message.edit_text("❌ Нет данных отчета для прогноза", reply_markup=keyboard)
+        return
 
+    revenue = forecast.monthly("revenue")
+    profit = forecast.monthly("profit")
+    text = (
+        f"📈 <b>Прогноз: {shop_name}</b>\n\n"
+        f"<u>Следующие 30 дней:</u>\n"
+        f"▫️Выручка: {revenue[-1, 0]:.2f} руб.\n"
+        f"▫️Прибыль: {profit[-1, 0]:.2f} руб.\n\n"
+        f"<u>Следующие 12 месяцев:</u>\n"
+        f"▫️Выручка: {revenue[-1].sum():.2f} руб.\n"
+        f"▫️Прибыль: {profit[-1].sum():.2f} руб.\n\n"
+    )
+
+    # Товары с наибольшим ростом прибыли в следующие 30 дней к последним 30 дням
+    recent = forecast.recent_profit[:-1]
+    growth = profit[:-1, 0] - recent
+    growth[forecast.nm_ids == 0] = -np.inf
+    top = [i for i in heapq.nlargest(5, range(len(growth)), key=growth.__getitem__) if growth[i] > 0]
+    if top:
+        text += "<u>Рост прибыли за 30 дней:</u>\n"
+        for i in top:
+            text += (
+                f"▫️{forecast.articles[i] or forecast.nm_ids[i]}: "
+                f"{recent[i]:.2f} → {profit[i, 0]:.2f} руб.\n"
+            )
+    text += f"\n<i>Примечание: линейный тренд по последним {FORECAST_HISTORY_DAYS} дням отчета</i>"
+    await callback.message.edit_text(text, reply_markup=keyboard)
+
+
+async def anomalies_callback(callback: types.CallbackQuery, state: FSMContext):
+    """Последние выбросы логистики, хранения, удержаний и комиссии по магазину и товарам"""
+    async with state.proxy() as data:
+        if "shop" not in data:
+            await callback.answer("❌ Сначала выберите магазин", show_alert=True)
+            return
+        shop_id = data["shop"]["id"]
+        shop_name = data["shop"]["name"] or f"Магазин {shop_id}"
+
+    anomalies = await get_recent_anomalies(shop_id)
+    keyboard = InlineKeyboardMarkup()
+    keyboard.add(InlineKeyboardButton("🔙 Назад", callback_data="analytics"))
+    if not anomalies:
+        await callback.message.edit_text(
+            f"✅ <b>{shop_name}</b>: необычных расходов не найдено", reply_markup=keyboard
+        )
+        return
+
+    text = f"⚠️ <b>Необычные расходы: {shop_name}</b>\n\n"
+    text += "\n".join(format_anomaly(row) for row in anomalies)
+    text += (
+        "\n\n<i>Примечание: сравнение с обычным уровнем за последние недели; "
+        "уведомления приходят при включённых ежедневных отчётах</i>"
+    )
+    await callback.message.edit_text(text, reply_markup=keyboard)
+
+
+# Срезы куба заказов на экране и в Excel
+ORDER_GEO_DIMENSIONS = {"region": "Регионы", "okrug": "Округа", "warehouse": "Склады"}
+ORDER_GEO_SHEETS = {**ORDER_GEO_DIMENSIONS, "warehouse_type": "Типы складов", "subject": "Предметы", "brand": "Бренды"}
+ORDER_GEO_PERIODS = (7, 30, 90)
+ORDER_GEO_LIMIT = 10
+
+
+def order_geo_keyboard(dimension, days):
+    keyboard = InlineKeyboardMarkup(row_width=3)
+    keyboard.row(*[
+        InlineKeyboardButton(f"• {title}" if name == dimension else title, callback_data=f"geo:{name}:{days}")
+        for name, title in ORDER_GEO_DIMENSIONS.items()
+    ])
+    keyboard.row(*[
+        InlineKeyboardButton(f"• {period} дн." if period == days else f"{period} дн.", callback_data=f"geo:{dimension}:{period}")
+        for period in ORDER_GEO_PERIODS
+    ])
+    keyboard.add(InlineKeyboardButton("📥 Выгрузить в Excel", callback_data=f"geo_xlsx:{days}"))
+    keyboard.add(InlineKeyboardButton("🔙 Назад", callback_data="analytics"))
+    return keyboard
+
+
+async def order_geo_callback(callback: types.CallbackQuery, state: FSMContext):
+    """Заказы, выкупы и отмены по регионам, округам и складам: order_geo или geo:<измерение>:<дней>"""
+    async with state.proxy() as data:
+        if "shop" not in data:
+            await callback.answer("❌ Сначала выберите магазин", show_alert=True)
+            return
+        shop_id = data["shop"]["id"]
+        shop_name = data["shop"]["name"] or f"Магазин {shop_id}"
+
+    dimension, days = "region", 30
+    if callback.data.startswith("geo:"):
+        _, dimension, days = callback.data.split(":")
+        days = int(days)
+    if dimension not in ORDER_GEO_DIMENSIONS:
+        await callback.answer()
+        return
+
+    start_date, end_date = cube_window(days)
+    totals, items = await get_cube_slice(shop_id, dimension, start_date, end_date)
+    keyboard = order_geo_keyboard(dimension, days)
+    if not totals["orders"]:
+        text = f"❌ Нет заказов за последние {days} дн."
+    else:
+        text = (
+            f"🗺 <b>{ORDER_GEO_DIMENSIONS[dimension]}: {shop_name}</b>\n"
+            f"Период: последние {days} дн.\n\n"
+            f"Заказов: {totals['orders']:.0f} на {totals['revenue']:.2f} руб.\n"
+            f"Выкуплено: {totals['buyouts']:.0f} ({totals['buyout_rate']:.1%}), "
+            f"отменено: {totals['cancellations']:.0f} ({totals['cancel_rate']:.1%})\n\n"
+        )
+        for item in items[:ORDER_GEO_LIMIT]:
+            text += (
+                f"▫️<b>{item['name']}</b>: {item['orders']:.0f} зак. "
+                f"({item['orders'] / totals['orders']:.1%}), выкуп {item['buyout_rate']:.1%}, "
+                f"{item['revenue']:.2f} руб.\n"
+            )
+        if len(items) > ORDER_GEO_LIMIT:
+            text += f"\n<i>Ещё {len(items) - ORDER_GEO_LIMIT} — в Excel</i>"
+    try:
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    except MessageNotModified:
+        await callback.answer()
+
+
+async def order_geo_xlsx_callback(callback: types.CallbackQuery, state: FSMContext):
+    """Excel со срезами куба заказов за период: лист на измерение"""
+    async with state.proxy() as data:
+        if "shop" not in data:
+            await callback.answer("❌ Сначала выберите магазин", show_alert=True)
+            return
+        shop_id = data["shop"]["id"]
+        shop_name = data["shop"]["name"] or f"Магазин {shop_id}"
+    days = int(callback.data.split(":")[1])
+
+    await callback.answer("⏳ Формируем файл...")
+    start_date, end_date = cube_window(days)
+    sheets = []
+    for dimension, sheet_title in ORDER_GEO_SHEETS.items():
+        _, items = await get_cube_slice(shop_id, dimension, start_date, end_date)
+        sheets.append((sheet_title, DIMENSION_TITLES[dimension], items))
+    title = f"Заказы: {shop_name}, {start_date:%d.%m.%Y} — {end_date:%d.%m.%Y}"
+    document = await build_workbook(order_cube_workbook, title, sheets)
+    await callback.message.answer_document(
+        InputFile(io.BytesIO(document), filename=f"orders_geo_{shop_id}_{days}d.xlsx"),
+        caption=f"🗺 <b>Заказы по регионам и складам</b>\nПериод: последние {days} дн.",
+    )
+
+
+async def abc_xyz_callback(callback: types.CallbackQuery, state: FSMContext):
+    """ABC по выручке и прибыли и XYZ по стабильности недельных продаж"""
+    async with state.proxy() as data:
+        if "shop" not in data:
+            await callback.answer("❌ Сначала выберите магазин", show_alert=True)
+            return
+        shop_id = data["shop"]["id"]
+        shop_name = data["shop"]["name"] or f"Магазин {shop_id}"
+
+    classification = await get_catalog_classification(shop_id)
+    keyboard = InlineKeyboardMarkup()
+    keyboard.add(InlineKeyboardButton("🔙 Назад", callback_data="analytics"))
+    if not len(classification):
+        await callback.message.edit_text("❌ Нет продаж за последние недели", reply_markup=keyboard)
+        return
+
+    counts, revenue = classification.matrix()
+    total_revenue = revenue.sum() or 1
+    text = (
+        f"🔤 <b>ABC/XYZ анализ: {shop_name}</b>\n"
+        f"Последние {ABC_XYZ_WEEKS} недель, товаров: {len(classification)}\n\n"
+        f"<u>Группы (товаров / доля выручки):</u>\n"
+    )
+    for i, abc in enumerate(ABC):
+        text += "▫️" + "  ".join(
+            f"{abc}{xyz}: {counts[i, j]} / {revenue[i, j] * 100 / total_revenue:.1f}%"
+            for j, xyz in enumerate(XYZ)
+        ) + "\n"
+
+    profit_counts = np.bincount(classification.abc_profit, minlength=3)
+    text += (
+        "\n<u>ABC по прибыли:</u> "
+        + ", ".join(f"{abc} — {profit_counts[i]}" for i, abc in enumerate(ABC))
+        + "\n"
+    )
+
+    for abc, xyz, title in (
+        ("A", "X", "ядро: много выручки, ровный спрос"),
+        ("A", "Z", "много выручки, спрос скачет — держите запас"),
+        ("C", "Z", "кандидаты на вывод"),
+    ):
+        items = classification.group(abc, xyz)
+        if items:
+            text += f"\n<u>{abc}{xyz} — {title}:</u>\n"
+            for article, value in items:
+                text += f"▫️{article}: {value:.2f} руб.\n"
+
+    text += (
+        f"\n<i>A — 80% выручки, B — следующие 15%, C — остальное. "
+        f"X — вариация недельных продаж до {XYZ_CV[0]:.0%}, Y — до {XYZ_CV[1]:.0%}, Z — выше</i>"
+    )
     await callback.message.edit_text(text, reply_markup=keyboard)
 
 
@@ -456,13 +493,25 @@ async def show_articles_page(callback: types.CallbackQuery, state: FSMContext):
             page = data["article_page"]
             analytics_type = data["analytics_type"]
 
-        articles = (
-            session.query(Order.nmId).filter(Order.shop_id == shop_id).distinct().all()
-        )
-
-        articles = [art[0] for art in articles]
+        level = None
+        if analytics_type == "profitability":
+            # Артикулы из таблицы доходности: по убыванию рентабельности, с фильтром по уровню
+            async with state.proxy() as data:
+                level = data.get("profitability_level")
+            rows = await get_profitability_rows(shop_id, level=level, order_by="profitability")
+            articles = [row.nm_id for row in rows]
+            labels = {
+                row.nm_id: f"{PROFITABILITY_LEVELS[row.level]['name'].split()[0]} {row.nm_id} · {row.profitability:.0f}%"
+                for row in rows
+            }
+        else:
+            articles = (
+                session.query(Order.nmId).filter(Order.shop_id == shop_id).distinct().all()
+            )
+            articles = [art[0] for art in articles]
+            labels = {}
 
-        if not articles:
+        if not articles and level is None:
             await callback.answer("❌ Нет данных по артикулам", show_alert=True)
             return
         items_per_page = 7
@@ -475,13 +524,17 @@ async def show_articles_page(callback: types.CallbackQuery, state: FSMContext):
             if analytics_type == "profitability"
             else "🔮 Симулятор «А что если?»"
         )
-        text = f"{title}\n\nВыберите артикул (страница {page + 1}/{total_pages}):"
+        text = f"{title}\n\nВыберите артикул (страница {page + 1}/{max(total_pages, 1)}):"
+        if level is not None:
+            text += f"\nУровень: {PROFITABILITY_LEVELS[level]['name']}"
+            if not articles:
+                text += "\n\nНет артикулов с таким уровнем доходности"
 
         keyboard = InlineKeyboardMarkup(row_width=1)
 
         for article in page_articles:
             keyboard.add(
-                InlineKeyboardButton(article, callback_data=f"select_article_{article}")
+                InlineKeyboardButton(labels.get(article, article), callback_data=f"select_article_{article}")
             )
 
         pagination_row = []
@@ -497,6 +550,18 @@ async def show_articles_page(callback: types.CallbackQuery, state: FSMContext):
         if pagination_row:
             keyboard.row(*pagination_row)
 
+        if analytics_type == "profitability":
+            level_buttons = [
+                InlineKeyboardButton(item["name"].split(" ", 2)[1], callback_data=f"profitability_level_{i}")
+                for i, item in enumerate(PROFITABILITY_LEVELS)
+            ]
+            keyboard.row(*level_buttons[:3])
+            keyboard.row(*level_buttons[3:])
+            if level is not None:
+                keyboard.add(InlineKeyboardButton("Все уровни", callback_data="profitability_level_all"))
+        else:
+            keyboard.add(InlineKeyboardButton("📊 Сетка сценариев по каталогу", callback_data="what_if_grid:c:0"))
+
         keyboard.add(InlineKeyboardButton("🔙 Назад", callback_data="back_to_analytics"))
         await callback.message.delete()
         await callback.message.answer(text, reply_markup=keyboard)
@@ -516,6 +581,16 @@ async def handle_articles_pagination(callback: types.CallbackQuery, state: FSMCo
     await show_articles_page(callback, state)
 
 
+async def profitability_level_callback(callback: types.CallbackQuery, state: FSMContext):
+    """Фильтр списка артикулов по уровню доходности"""
+    level = callback.data.rsplit("_", 1)[1]
+    async with state.proxy() as data:
+        data["profitability_level"] = None if level == "all" else int(level)
+        data["article_page"] = 0
+
+    await show_articles_page(callback, state)
+
+
 async def select_article_callback(callback: types.CallbackQuery, state: FSMContext):
     article = callback.data.split("_", 2)[2]
 
@@ -532,7 +607,10 @@ async def select_article_callback(callback: types.CallbackQuery, state: FSMConte
             f"Выбран артикул: <b>{article}</b>\n\n"
             "Введите новую цену и новую себестоимость через запятую.\n"
             "Формат: <code>цена, себестоимость</code>\n"
-            "Например: <code>1200, 800</code>"
+            "Например: <code>1200, 800</code>\n\n"
+            "Третьим числом можно указать эластичность спроса, например <code>1200, 800, -1.5</code>, "
+            "или посчитать сразу сетку сценариев:",
+            reply_markup=what_if_grid_keyboard("a"),
         )
         await AnalyticsStates.waiting_for_price_and_cost.set()
 
@@ -553,8 +631,23 @@ async def what_if_simulator_callback(callback: types.CallbackQuery, state: FSMCo
     await show_articles_page(callback, state)
 
 
+def what_if_grid_keyboard(scope: str):
+    """Кнопки сетки сценариев: scope a — выбранный артикул, c — весь каталог"""
+    keyboard = InlineKeyboardMarkup(row_width=3)
+    keyboard.add(*[
+        InlineKeyboardButton(title, callback_data=f"what_if_grid:{scope}:{elasticity}")
+        for title, elasticity in (
+            ("📊 Спрос не меняется", "0"),
+            ("📊 Эластичность -1", "-1"),
+            ("📊 Эластичность -2", "-2"),
+        )
+    ])
+    keyboard.add(InlineKeyboardButton("📊 Эластичность по истории заказов", callback_data=f"what_if_grid:{scope}:est"))
+    return keyboard
+
+
 async def process_price_and_cost(message: types.Message, state: FSMContext):
-    """Обработка ввода цены и себестоимости"""
+    """Обработка ввода цены и себестоимости (и, по желанию, эластичности спроса)"""
     try:
         # Пытаемся разобрать ввод
         input_text = message.text.strip()
@@ -565,86 +658,45 @@ async def process_price_and_cost(message: types.Message, state: FSMContext):
         else:
             parts = input_text.split()
 
-        if len(parts) != 2:
+        if len(parts) not in (2, 3):
             raise ValueError
 
         new_price = float(parts[0].strip())
         new_cost = float(parts[1].strip())
+        # Без третьего числа — эластичность, оценённая по истории заказов артикула
+        elasticity = float(parts[2].strip()) if len(parts) == 3 else None
 
         async with state.proxy() as data:
             article = data["selected_article"]
             shop_id = data["shop"]["id"]
-            shop_name = data["shop"]["name"] or f"Магазин {shop_id}"
-            api_token = data["shop"]["api_token"]
 
-        # Получаем исторические данные
-        end_date = datetime.utcnow()
-        start_date = end_date - timedelta(days=30)
-        report = await fetch_full_report(api_token, start_date, end_date)
+        # Текущие показатели — из таблицы доходности за 30 дней
+        result = await run_simulation(simulate_one, shop_id, int(article), new_price, new_cost, elasticity)
 
-        if not report:
-            await message.answer(
-                "❌ Не удалось получить исторические данные для расчета"
-            )
-            return
-
-        # Фильтруем данные по выбранному артикулу
-        article_data = [item for item in report if item.get("sa_name") == article]
-
-        if not article_data:
+        if not result:
             await message.answer(
                 f"❌ Нет данных по артикулу {article} за последний месяц"
             )
             return
 
-        # Рассчитываем текущие показатели
-        current_quantity = sum(item.get("quantity", 0) for item in article_data)
-        current_revenue = sum(
-            item.get("retail_price_withdisc_rub", 0) for item in article_data
-        )
-        current_commission = sum(
-            item.get("ppvz_sales_commission", 0)
-            + item.get("ppvz_vw", 0)
-            + item.get("ppvz_vw_nds", 0)
-            for item in article_data
-        )
-
-        # Получаем текущую себестоимость
-        session = sessionmaker()(bind=engine)
-        try:
-            product_cost = (
-                session.query(ProductCost)
-                .filter(
-                    ProductCost.shop_id == shop_id, ProductCost.article == str(article)
-                )
-                .first()
-            )
-            current_cost = product_cost.cost if product_cost else 0
-        finally:
-            session.close()
-
-        current_profit = (
-            current_revenue - current_commission - (current_cost * current_quantity)
-        )
-
-        # Рассчитываем прогноз
-        forecast_revenue = new_price * current_quantity
-        forecast_profit = (
-            forecast_revenue - current_commission - (new_cost * current_quantity)
-        )
+        current_revenue = result["revenue"]
+        current_profit = result["profit"]
+        forecast_revenue = result["forecast_revenue"]
+        forecast_profit = result["forecast_profit"]
 
         # Формируем результат
         text = (
             f"🔮 <b>Симулятор «А что если?» для артикула {article}</b>\n\n"
             f"<b>Исторические данные (за последний месяц):</b>\n"
-            f"📦 Продано: {current_quantity} шт.\n"
+            f"📦 Продано: {result['quantity']:.0f} шт.\n"
             f"💰 Выручка: {current_revenue:.2f} руб.\n"
             f"💵 Прибыль: {current_profit:.2f} руб.\n"
-            f"🏷️ Текущая цена: {current_revenue / current_quantity:.2f} руб./шт.\n"
-            f"📊 Текущая себестоимость: {current_cost:.2f} руб./шт.\n\n"
+            f"🏷️ Текущая цена: {result['price']:.2f} руб./шт.\n"
+            f"📊 Текущая себестоимость: {result['cost']:.2f} руб./шт.\n\n"
             f"<b>Прогноз при новых параметрах:</b>\n"
             f"🆕 Новая цена: {new_price:.2f} руб./шт.\n"
             f"🆕 Новая себестоимость: {new_cost:.2f} руб./шт.\n"
+            f"📦 Прогноз продаж: {result['forecast_quantity']:.0f} шт.\n"
             f"📈 Прогнозируемая выручка: {forecast_revenue:.2f} руб.\n"
             f"📊 Прогнозируемая прибыль: {forecast_profit:.2f} руб.\n\n"
             f"<b>Изменение:</b>\n"
@@ -652,10 +704,18 @@ async def process_price_and_cost(message: types.Message, state: FSMContext):
             f"({(forecast_revenue / current_revenue - 1) * 100 if current_revenue else 0:+.1f}%)\n"
             f"💵 Прибыль: {forecast_profit - current_profit:+.2f} руб. "
             f"({(forecast_profit / current_profit - 1) * 100 if current_profit else 0:+.1f}%)\n\n"
-            "<i>Примечание: прогноз основан на историческом количестве продаж без учета изменения спроса</i>"
         )
+        if elasticity:
+            text += f"<i>Примечание: прогноз учитывает эластичность спроса {elasticity:g}</i>"
+        elif result["elasticity"]:
+            text += (
+                f"<i>Примечание: прогноз учитывает эластичность спроса {result['elasticity']:.2f}, "
+                "оцененную по истории заказов</i>"
+            )
+        else:
+            text += "<i>Примечание: прогноз основан на историческом количестве продаж без учета изменения спроса</i>"
 
-        keyboard = InlineKeyboardMarkup()
+        keyboard = what_if_grid_keyboard("a")
         keyboard.add(
             InlineKeyboardButton("🔄 Новый расчет", callback_data="what_if_simulator")
         )
@@ -664,7 +724,8 @@ async def process_price_and_cost(message: types.Message, state: FSMContext):
         )
 
         await message.answer(text, reply_markup=keyboard)
-        await state.finish()
+        # Магазин и артикул остаются в данных: по ним работают кнопки сетки сценариев
+        await state.reset_state(with_data=False)
 
     except (ValueError, IndexError):
         await message.answer(
@@ -679,6 +740,44 @@ async def process_price_and_cost(message: types.Message, state: FSMContext):
         await state.finish()
 
 
+async def what_if_grid_callback(callback: types.CallbackQuery, state: FSMContext):
+    """Сетка сценариев (цена x себестоимость) для артикула или всего каталога в Excel"""
+    _, scope, elasticity = callback.data.split(":")
+    elasticity = None if elasticity == "est" else float(elasticity)
+    async with state.proxy() as data:
+        if "shop" not in data:
+            await callback.answer("❌ Сначала выберите магазин", show_alert=True)
+            return
+        shop_id = data["shop"]["id"]
+        shop_name = data["shop"]["name"] or f"Магазин {shop_id}"
+        article = data.get("selected_article") if scope == "a" else None
+    if scope == "a" and article is None:
+        await callback.answer("❌ Сначала выберите артикул", show_alert=True)
+        return
+
+    await callback.answer("⏳ Считаем сценарии...")
+    summary = await run_simulation(simulate_grid, shop_id, int(article) if article else None, elasticity)
+    if not summary:
+        await callback.message.answer("❌ Нет продаж за последний месяц для расчета сценариев")
+        return
+
+    subject = f"артикул {article}" if article else "весь каталог"
+    elasticity_text = "по истории заказов" if elasticity is None else f"{elasticity:g}"
+    title = f"Сценарии цены и себестоимости: {shop_name}, {subject}, эластичность {elasticity_text}"
+    document = await build_workbook(scenario_workbook, title, summary)
+    price_step, cost_step, best_profit = summary["best"]
+    caption = (
+        f"🔮 <b>Сетка сценариев: {subject}</b>\n"
+        f"Сценариев: {summary['scenarios']}\n"
+        f"Прибыль сейчас: {summary['baseline']:.2f} руб.\n"
+        f"Лучший сценарий: цена {price_step:+d}%, себестоимость {cost_step:+d}% — {best_profit:.2f} руб."
+    )
+    await callback.message.answer_document(
+        InputFile(io.BytesIO(document), filename=f"scenarios_{shop_id}_{article or 'all'}.xlsx"),
+        caption=caption,
+    )
+
+
 async def product_analytics_callback(callback: types.CallbackQuery, state: FSMContext,start_date,end_date):
     print("product_analytics_callback")
     async with state.proxy() as data:
@@ -700,37 +799,50 @@ async def product_analytics_callback(callback: types.CallbackQuery, state: FSMCo
         "Подождите, идет сбор и обработка данных..."
     )
 
-    # Получаем данные и генерируем отчет
-    try:
-        wb = await generate_product_analytics_report(api_token, shop_id,start_date,end_date)
-        if not wb:
-            await message2.edit_text(
-                "❌ <b>Не удалось сгенерировать отчет</b>\n\n"
-                "Возможные причины:\n"
-                "1. Нет данных о продажах за последний месяц\n"
-                "2. Проблемы с подключением к WB API\n"
-                "3. Отсутствуют данные себестоимости"
-            )
-            return
+    # Тяжёлый расчёт — в фоновой задаче; повторное нажатие присоединяется к ней
+    key = job_key(callback.from_user.id, shop_id, "product_analytics", start_date.date(), end_date.date())
+    params = {
+        "api_token": api_token,
+        "shop_id": shop_id,
+        "shop_name": shop_name,
+        "start_date": start_date.isoformat(),
+        "end_date": end_date.isoformat(),
+    }
+    await report_jobs.run(key, "product_analytics", params, callback.message.chat.id, message2)
 
-        # Сохраняем в буфер
-        file_stream = io.BytesIO()
-        wb.save(file_stream)
-        file_stream.seek(0)
-
-        # Отправляем файл
-        await message2.delete()
-        file = InputFile(file_stream, filename=f"товарная_аналитика_{shop_name}.xlsx")
-        await callback.message.answer_document(
-            file,
-            caption=f"Товарная аналитика за последний месяц\nМагазин: {shop_name}",
-        )
 
-    except Exception as e:
-        logger.error(f"Ошибка генерации отчета: {e}")
-        await callback.message.edit_text(
-            "❌ Произошла ошибка при генерации отчета. Попробуйте позже."
-        )
+@job_runner("product_analytics")
+async def product_analytics_job(params, context, progress):
+    """Фоновая генерация Excel с товарной аналитикой"""
+    shop_name = params["shop_name"]
+    progress(
+        "<b>Генерация товарной аналитики</b>\n\n"
+        f"Магазин: {shop_name}\n\n"
+        "⏳ Считаю показатели по артикулам..."
+    )
+    start_date = datetime.fromisoformat(params["start_date"])
+    end_date = datetime.fromisoformat(params["end_date"])
+    # Отчёт за закрытый период отдаём из кэша артефактов, если данные не менялись
+    document, file_id, artifact_id = await cached_report(
+        params["shop_id"], "product_analytics", start_date, end_date,
+        lambda: generate_product_analytics_report(params["api_token"], params["shop_id"], start_date, end_date),
+    )
+    if not document and not file_id:
+        return JobResult(text=(
+            "❌ <b>Не удалось сгенерировать отчет</b>\n\n"
+            "Возможные причины:\n"
+            "1. Нет данных о продажах за последний месяц\n"
+            "2. Проблемы с подключением к WB API\n"
+            "3. Отсутствуют данные себестоимости"
+        ))
+
+    return JobResult(
+        document=document,
+        file_id=file_id,
+        artifact_id=artifact_id,
+        filename=f"товарная_аналитика_{shop_name}.xlsx",
+        caption=f"Товарная аналитика за последний месяц\nМагазин: {shop_name}",
+    )
 
 #Вызывает календарь когда тригерится функция с эксель отчётом
 async def start_analytics_report(callback: types.CallbackQuery, state: FSMContext):
@@ -738,44 +850,125 @@ async def start_analytics_report(callback: types.CallbackQuery, state: FSMContex
     await state.update_data(report_type="product_analytics")
     await custom_period_callback(callback, state)  # Показываем выбор периода
 
+def new_article_data(subject_name, nm_id):
+    return {
+        "subject_name": subject_name,
+        "orders": 0,
+        "sales": 0,
+        "returns": 0,
+        "cancellations": 0,
+        "sales_rub": 0,
+        "returns_rub": 0,
+        "commission": 0,
+        "logistics": 0,
+        "storage": 0,
+        "return_logistics": 0,
+        "nm_id": nm_id,
+        "deduction": 0
+    }
+
+
+def aggregate_articles(report_data):
+    """Показатели по артикулам продавца из фрейма отчёта (одним проходом по массивам)"""
+    sa_codes = report_data.codes["sa_name"].copy()
+    nm_ids = report_data.nm_id
+
+    # Строки без артикула продавца относим к артикулу с тем же nm_id
+    has_article = sa_codes != 0
+    missing = ~has_article & (nm_ids != 0)
+    if missing.any() and has_article.any():
+        known_nm, first = np.unique(nm_ids[has_article], return_index=True)
+        known_sa = sa_codes[has_article][first]
+        pos = np.minimum(np.searchsorted(known_nm, nm_ids[missing]), len(known_nm) - 1)
+        sa_codes[missing] = np.where(known_nm[pos] == nm_ids[missing], known_sa[pos], 0)
+
+    keep = sa_codes != 0
+    frame = report_data.take(keep)
+    codes = sa_codes[keep]
+    if not len(frame):
+        return {}
+    unique, first, inverse = np.unique(codes, return_index=True, return_inverse=True)
+
+    def total(values):
+        return np.bincount(inverse, weights=values, minlength=len(unique))
+
+    quantity = frame.col("quantity")
+    price = frame.col("retail_price_withdisc_rub")
+    is_sale = frame.contains("doc_type_name", "продажа", "sale")
+    is_return = frame.contains("doc_type_name", "возврат", "return") & ~is_sale
+    is_cancel = frame.contains("doc_type_name", "отмена", "cancellation") & ~is_sale & ~is_return
+
+    columns = {
+        "orders": total(quantity),
+        "sales": total(quantity * is_sale),
+        "returns": total(quantity * is_return),
+        "cancellations": total(quantity * is_cancel),
+        "sales_rub": total(price * quantity * is_sale),
+        "returns_rub": total(price * is_return),
+        "commission": total(
+            price
+            - frame.col("ppvz_for_pay")
+            - frame.col("ppvz_reward")
+            - frame.col("ppvz_sales_commission")
+        ),
+        "logistics": total(frame.col("delivery_rub")),
+        "storage": total(frame.col("storage_fee")),
+        "deduction": total(frame.col("deduction")),
+    }
+    counters = ("orders", "sales", "returns", "cancellations")
+    subjects = frame.strings("subject_name")[first]
+    names = report_data.vocabs["sa_name"].values
+
+    # Порядок строк — по первому появлению артикула в отчёте
+    articles_data = {}
+    for i in np.argsort(first, kind="stable"):
+        data = new_article_data(subjects[i], int(frame.nm_id[first[i]]))
+        for name, values in columns.items():
+            data[name] = int(round(values[i])) if name in counters else float(values[i])
+        articles_data[names[unique[i]]] = data
+    return articles_data
+
+
+def distribute_shop_expenses(report_data, articles_data):
+    """Распределяет строки отчёта без nm_id (удержания, хранение) по артикулам"""
+    shop_rows = report_data.take(report_data.nm_id == 0).without("bonus_type_name", PROMOTION_BONUS_TYPE)
+    amount_articles = len(articles_data)
+
+    # Вознаграждение ПВЗ относим к артикулу из строки с тем же srid
+    rewarded = shop_rows.col("ppvz_reward") != 0
+    if rewarded.any():
+        with_article = report_data.codes["sa_name"] != 0
+        known_srid, first = np.unique(report_data.srid[with_article], return_index=True)
+        article_codes = report_data.codes["sa_name"][with_article][first]
+        names = report_data.vocabs["sa_name"].values
+        for srid, reward in zip(shop_rows.srid[rewarded], shop_rows.col("ppvz_reward")[rewarded]):
+            pos = np.searchsorted(known_srid, srid)
+            if pos < len(known_srid) and known_srid[pos] == srid:
+                articles_data[names[article_codes[pos]]]["commission"] -= float(reward)
+
+    if amount_articles > 0:
+        deduction = shop_rows.sum("deduction") / amount_articles
+        storage = shop_rows.sum("storage_fee") / amount_articles
+        for article, data in articles_data.items():
+            data["deduction"] += deduction
+            data["storage"] += storage
+
+
 async def generate_product_analytics_report(api_token: str, shop_id: int, start_date, end_date):
-    """Генерация Excel-отчета с товарной аналитикой"""
-    # Получаем кэшированные данные
-    session = sessionmaker(bind=engine)()
-    cashed_data = (
-        session.query(CashedShopData)
-        .filter(CashedShopData.shop_id == shop_id)
-        .first()
-    )
-    
-    if not cashed_data or not cashed_data.cashed_all:
+    """Генерация Excel-отчета с товарной аналитикой (bytes xlsx или None)"""
+    # Данные магазина из колоночного кэша
+    shop_frame = await get_shop_frame(shop_id)
+    if not len(shop_frame):
         print("no cashed_data")
-        session.close()
         return None
 
     # Фильтруем данные по выбранному периоду
-    report_data = []
-    for item in cashed_data.cashed_all:
-        try:
-            sale_date = datetime.strptime(item.get("sale_dt", "")[:10], "%Y-%m-%d")
-            if start_date <= sale_date <= end_date:
-                report_data.append(item)
-        except (ValueError, TypeError):
-            continue
-
-    if not report_data:
+    report_data = shop_frame.between(start_date, end_date)
+    if not len(report_data):
         print("no report_data")
-        session.close()
         return None
 
-    # Создаем Excel-книгу
-    try:
-        wb = load_workbook("template.xlsx")
-    except FileNotFoundError:
-        wb = openpyxl.Workbook()
-    
-    ws = wb.active
-    ws.title = "Товарная аналитика"
+    session = sessionmaker(bind=engine)()
 
     headers = [
         "Артикул",
@@ -801,16 +994,14 @@ async def generate_product_analytics_report(api_token: str, shop_id: int, start_
         "Прибыль без рекламы",
         "Удержания",
         "Налог",
+        "ABC по выручке",
+        "ABC по прибыли",
+        "XYZ",
+        "Вариация продаж",
+        "% отмен",
+        "% возвратов",
     ]
 
-    # Добавляем заголовки
-    for col_num, header in enumerate(headers, 1):
-        cell = ws.cell(row=1, column=col_num, value=header)
-        #cell.font = Font(bold=True)
-        #cell.fill = PatternFill(
-        #    start_color="DDEBF7", end_color="DDEBF7", fill_type="solid"
-        #)
-
     # Рассчитываем регулярные расходы за период
     regular_expenses = 0
     days_in_period = (end_date - start_date).days + 1
@@ -825,57 +1016,7 @@ async def generate_product_analytics_report(api_token: str, shop_id: int, start_
             regular_expenses += expense.amount * (days_in_period / 30)
 
     # Собираем данные по артикулам
-    articles_data = {}
-    for item in report_data:  # Используем report_data вместо report
-        article = item.get("sa_name")
-        if not article:
-            if item.get("nm_id", 0):
-                # Ищем артикул по nm_id
-                for article2, item2 in articles_data.items():
-                    if item2.get("nm_id") == item.get("nm_id"):
-                        article = article2
-                        break
-        if not article:
-            continue
-
-        if article not in articles_data:
-            articles_data[article] = {
-                "subject_name": item.get("subject_name", ""),
-                "orders": 0,
-                "sales": 0,
-                "returns": 0,
-                "cancellations": 0,
-                "sales_rub": 0,
-                "returns_rub": 0,
-                "commission": 0,
-                "logistics": 0,
-                "storage": 0,
-                "return_logistics": 0,
-                "nm_id": item.get("nm_id", 0),
-                "deduction": 0
-            }
-
-        doc_type = item.get("doc_type_name", "")
-        quantity = item.get("quantity", 0)
-        price = item.get("retail_price_withdisc_rub", 0)
-        retail_price = item.get("retail_price_withdisc_rub", 0)
-
-        if "продажа" in doc_type.lower() or "sale" in doc_type.lower():
-            articles_data[article]["sales"] += quantity
-            articles_data[article]["sales_rub"] += price * quantity
-        elif "возврат" in doc_type.lower() or "return" in doc_type.lower():
-            articles_data[article]["returns"] += quantity
-            articles_data[article]["returns_rub"] += price
-        elif "отмена" in doc_type.lower() or "cancellation" in doc_type.lower():
-            articles_data[article]["cancellations"] += quantity
-        
-        articles_data[article]["deduction"] += item.get('deduction', 0)
-        articles_data[article]["commission"] += retail_price - item.get("ppvz_for_pay", 0)
-        articles_data[article]["commission"] -= item.get("ppvz_reward", 0)
-        articles_data[article]["commission"] -= item.get("ppvz_sales_commission", 0)
-        articles_data[article]["logistics"] += item.get("delivery_rub", 0)
-        articles_data[article]["storage"] += item.get("storage_fee", 0)
-        articles_data[article]["orders"] += quantity
+    articles_data = aggregate_articles(report_data)
 
     # Добавляем данные из заказов за период
     orders = (
@@ -890,21 +1031,7 @@ async def generate_product_analytics_report(api_token: str, shop_id: int, start_
 
     for order in orders:
         if order.supplierArticle not in articles_data:
-            articles_data[order.supplierArticle] = {
-                "subject_name": order.supplierArticle,
-                "orders": 0,
-                "sales": 0,
-                "returns": 0,
-                "cancellations": 0,
-                "sales_rub": 0,
-                "returns_rub": 0,
-                "commission": 0,
-                "logistics": 0,
-                "storage": 0,
-                "return_logistics": 0,
-                "nm_id": order.nmId,
-                "deduction": 0
-            }
+            articles_data[order.supplierArticle] = new_article_data(order.supplierArticle, order.nmId)
         articles_data[order.supplierArticle]["sales_rub"] += order.priceWithDisc
         articles_data[order.supplierArticle]["sales"] += 1
         articles_data[order.supplierArticle]["orders"] += 1
@@ -913,21 +1040,7 @@ async def generate_product_analytics_report(api_token: str, shop_id: int, start_
     amount_articles = len(articles_data)
 
     # Обрабатываем общие удержания и хранение
-    for item in report_data:  # Используем report_data вместо report
-        if item.get("nm_id", 0) == 0:
-            if item.get('bonus_type_name', '') == "Оказание услуг «ВБ.Продвижение»":
-                continue
-            if item.get("ppvz_reward", 0):
-                for item2 in report_data:  # Используем report_data
-                    if item2.get("srid") == item.get("srid"):
-                        if item2.get("sa_name"):
-                            articles_data[item2.get("sa_name")]["commission"] -= item.get("ppvz_reward")
-                            break
-            deduction = item.get("deduction", 0) / amount_articles if amount_articles > 0 else 0
-            storage = item.get("storage_fee", 0) / amount_articles if amount_articles > 0 else 0
-            for article, data in articles_data.items():
-                data["deduction"] += deduction
-                data["storage"] += storage
+    distribute_shop_expenses(report_data, articles_data)
 
     regular_expenses_for_article = regular_expenses / amount_articles if amount_articles > 0 else 0
 
@@ -961,13 +1074,49 @@ async def generate_product_analytics_report(api_token: str, shop_id: int, start_
         logger.error(f"Ошибка получения налоговых настроек: {e}")
         tax_rate = 0.0
 
+    # Реклама и штрафы одним запросом на весь период
+    try:
+        adverts_by_nm = dict(
+            session.query(Advertisement.nmId, func.sum(Advertisement.amount))
+            .filter(Advertisement.shop_id == shop_id)
+            .filter(Advertisement.date >= start_date)
+            .filter(Advertisement.date <= end_date)
+            .group_by(Advertisement.nmId)
+            .all()
+        )
+    except Exception as e:
+        logger.error(f"Ошибка получения рекламных расходов: {e}")
+        adverts_by_nm = {}
+    try:
+        penalties_by_nm = dict(
+            session.query(Penalty.nm_id, func.sum(Penalty.sum))
+            .filter(Penalty.shop_id == shop_id)
+            .filter(Penalty.date >= start_date)
+            .filter(Penalty.date <= end_date)
+            .group_by(Penalty.nm_id)
+            .all()
+        )
+    except Exception as e:
+        logger.error(f"Ошибка получения штрафов: {e}")
+        penalties_by_nm = {}
+
+    # Группы ABC/XYZ за тот же период (кэш по версии отчёта и себестоимости)
+    classification = await get_catalog_classification(shop_id, start_date, end_date)
+    # Воронка заказов периода по srid: выкупы, отмены и возвраты
+    funnel = funnel_metrics(session, shop_id, start_date, end_date)
+
     # Заполняем данные в таблицу
-    row_num = 2
+    rows = []
     for article, data in articles_data.items():
         # Основные показатели
         revenue = data["sales_rub"] - data["returns_rub"]
         total_sales = data["sales"] - data["returns"]
-        buyout_rate = (total_sales / data["orders"]) if data["orders"] else 0
+        # Выкуп, отмены и возвраты — по воронке заказов; без неё выкуп оцениваем по отчёту
+        article_funnel = funnel.get(int(data["nm_id"] or 0))
+        if article_funnel is not None:
+            buyout_rate = article_funnel["buyout_rate"]
+        else:
+            buyout_rate = (total_sales / data["orders"]) if data["orders"] else 0
 
         # Комиссии
         commission_percent = (data["commission"] / revenue) if revenue else 0
@@ -998,33 +1147,9 @@ async def generate_product_analytics_report(api_token: str, shop_id: int, start_
             revenue - abs(total_cost) - abs(total_deductions) - abs(tax) - abs(regular_expenses_for_article)
         )
 
-        # Рекламные расходы за период
-        try:
-            advertisement = sum(
-                i.amount
-                for i in session.query(Advertisement)
-                .filter(Advertisement.nmId == int(data["nm_id"]))
-                .filter(Advertisement.date >= start_date)
-                .filter(Advertisement.date <= end_date)
-                .all()
-            )
-        except Exception as e:
-            logger.error(f"Ошибка получения рекламных расходов: {e}")
-            advertisement = 0
-
-        # Штрафы за период
-        try:
-            penalty = sum(
-                i.sum
-                for i in session.query(Penalty)
-                .filter(Penalty.nm_id == data["nm_id"])
-                .filter(Penalty.date >= start_date)
-                .filter(Penalty.date <= end_date)
-                .all()
-            )
-        except Exception as e:
-            logger.error(f"Ошибка получения штрафов: {e}")
-            penalty = 0
+        # Рекламные расходы и штрафы за период
+        advertisement = adverts_by_nm.get(int(data["nm_id"] or 0)) or 0
+        penalty = penalties_by_nm.get(int(data["nm_id"] or 0)) or 0
 
         profit_with_ads = (
             revenue
@@ -1040,102 +1165,38 @@ async def generate_product_analytics_report(api_token: str, shop_id: int, start_
         profitability_cpm = (profit_without_ads / total_cost) * 100 if total_cost else 0
         profitability_sales = (profit_with_ads / revenue) * 100 if revenue else 0
 
-        # Заполняем строку
-        ws.cell(row=row_num, column=1, value=article)
-        ws.cell(row=row_num, column=2, value=data["subject_name"])
-        ws.cell(row=row_num, column=3, value=abs(revenue))
-        ws.cell(row=row_num, column=4, value=profit_with_ads)
-        ws.cell(row=row_num, column=5, value=profitability_sales)
-        ws.cell(row=row_num, column=6, value=profitability_cpm)
-        ws.cell(row=row_num, column=7, value=abs(data["orders"]))
-        ws.cell(row=row_num, column=8, value=abs(data["sales"]))
-        ws.cell(row=row_num, column=9, value=abs(data["returns"]))
-        ws.cell(row=row_num, column=10, value=abs(data["returns_rub"]))
-        ws.cell(row=row_num, column=11, value=abs(buyout_rate))
-        ws.cell(row=row_num, column=12, value=data["commission"])
-        ws.cell(row=row_num, column=13, value=abs(commission_percent))
-        ws.cell(row=row_num, column=14, value=abs(data["logistics"]))
-        ws.cell(row=row_num, column=15, value=abs(logistics_per_unit))
-        ws.cell(row=row_num, column=16, value=abs(logistics_percent))
-        ws.cell(row=row_num, column=17, value=abs(total_deductions))
-        ws.cell(row=row_num, column=18, value=abs(deductions_percent))
-        ws.cell(row=row_num, column=19, value=advertisement)
-        ws.cell(row=row_num, column=20, value=(advertisement / revenue * 100) if revenue else 0)
-        ws.cell(row=row_num, column=21, value=profit_without_ads)
-        ws.cell(row=row_num, column=22, value=data["deduction"])
-        ws.cell(row=row_num, column=23, value=abs(tax))
-
-        row_num += 1
-
-
-        # Итоговая строка
-    last_row = ws.max_row + 1
-    ws.cell(row=last_row, column=1, value="ИТОГО")
-    for col in range(3, 24):  # Начиная с колонки "Заказы (шт)" до "Рентабельность CPM"
-        col_letter = get_column_letter(col)
-        if col in [5, 6, 11, 13, 16, 18, 20, 24]:  # Столбцы для средних значений
-            ws.cell(row=last_row, column=col, value=f"=AVERAGE({col_letter}2:{col_letter}{last_row - 1})")
-        else:  # Сумма по остальным столбцам
-            ws.cell(row=last_row, column=col, value=f"=SUM({col_letter}2:{col_letter}{last_row - 1})")
-    # Форматирование
-    apply_excel_formatting(ws)
-    
-    session.close()
-    return wb
-
-def apply_excel_formatting(ws):
-    """Применяет форматирование к Excel-листу"""
-    # Устанавливаем ширину столбцов
-    for col in ws.columns:
-        max_length = 0
-        column = col[0].column_letter
-        for cell in col:
-            try:
-                if len(str(cell.value)) > max_length:
-                    max_length = len(str(cell.value))
-            except:
-                pass
-        adjusted_width = (max_length + 2) * 1.2
-        ws.column_dimensions[column].width = adjusted_width
-
-    # Форматирование чисел
-    for row in ws.iter_rows(
-        min_row=2, max_row=ws.max_row, min_col=3, max_col=ws.max_column
-    ):
-        for cell in row:
-            if isinstance(cell.value, (int, float)):
-                # Проценты
-                if cell.column_letter in ["E", "K", "M", "P", "T"]:
-                    cell.number_format = "0.00%"
-                elif (
-                    cell.column >= 7
-                    and cell.column <= 24
-                    and cell.column not in [10, 11]
-                ):
-                    cell.number_format = "#,##0.00"
-                else:
-                    cell.number_format = "#,##0"
-
-    # Границы
-    thin_border = Border(
-        left=Side(style="thin"),
-        right=Side(style="thin"),
-        top=Side(style="thin"),
-        bottom=Side(style="thin"),
-    )
-
-    for row in ws.iter_rows(
-        min_row=1, max_row=ws.max_row, min_col=1, max_col=ws.max_column
-    ):
-        for cell in row:
-            cell.border = thin_border
+        # Строка листа (книгу собирает пул процессов)
+        rows.append([
+            article,
+            data["subject_name"],
+            abs(revenue),
+            profit_with_ads,
+            profitability_sales,
+            profitability_cpm,
+            abs(data["orders"]),
+            abs(data["sales"]),
+            abs(data["returns"]),
+            abs(data["returns_rub"]),
+            abs(buyout_rate),
+            data["commission"],
+            abs(commission_percent),
+            abs(data["logistics"]),
+            abs(logistics_per_unit),
+            abs(logistics_percent),
+            abs(total_deductions),
+            abs(deductions_percent),
+            advertisement,
+            (advertisement / revenue * 100) if revenue else 0,
+            profit_without_ads,
+            data["deduction"],
+            abs(tax),
+            *(classification.labels(int(data["nm_id"] or 0), article) or ("", "", "", None)),
+            article_funnel["cancel_rate"] if article_funnel else None,
+            article_funnel["return_rate"] if article_funnel else None,
+        ])
 
-    # Выравнивание заголовков
-    for cell in ws[1]:
-        cell.alignment = Alignment(horizontal="center", vertical="center")
-
-    # Фиксируем заголовки
-    ws.freeze_panes = "A2"
+    session.close()
+    return await build_workbook(product_analytics_workbook, headers, rows)
 
 
 async def back_to_analytics(callback: types.CallbackQuery, state: FSMContext):
@@ -1194,37 +1255,37 @@ async def calculate_metrics_from_report(report_data, shop_id, start_date, end_da
         cost_of_goods = 0
         deduction = 0
         ppvz_reward = 0
+        # Услуги «ВБ.Продвижение» в отчёте не учитываем
+        report_data = report_data.without("bonus_type_name", PROMOTION_BONUS_TYPE)
+        retail_price = report_data.col("retail_price_withdisc_rub")
+        quantity = report_data.col("quantity")
+
+        # Выручка
+        revenue = float((retail_price * quantity).sum())
+
+        # Логистика
+        logistics = report_data.sum("delivery_rub")
+        # logistics += report_data.sum("rebill_logistic_cost")
+
+        # Хранение
+        storage_fee = report_data.sum("storage_fee")
+
+        # Комиссия WB
+        ppvz_reward = report_data.sum("ppvz_reward")
+        commission = float(
+            (
+                retail_price
+                - report_data.col("ppvz_for_pay")
+                - report_data.col("ppvz_reward")
+                - report_data.col("ppvz_sales_commission")
+            ).sum()
+        )
+        deduction = report_data.sum("deduction")
+
         # Собираем артикулы для расчета себестоимости
-        articles = {}
-        for item in report_data:
-            # Выручка
-            if item.get('bonus_type_name', '') == "Оказание услуг «ВБ.Продвижение»":
-                continue
-            retail_price = item.get("retail_price_withdisc_rub", 0)
-            quantity = item.get("quantity", 0)
-            revenue += retail_price * quantity
-
-            # Логистика
-            logistics += item.get("delivery_rub", 0)
-            # logistics += item.get("rebill_logistic_cost", 0)
-
-            # Хранение
-            storage_fee += item.get("storage_fee", 0)
-
-            # Комиссия WB
-            # print(item.get('ppvz_sales_commission'), item.get('ppvz_vw'), item.get('ppvz_vw_nds'))
-            commission += retail_price - item.get("ppvz_for_pay")
-            commission -= item.get("ppvz_reward", 0)
-            ppvz_reward += item.get("ppvz_reward", 0)
-            commission -= item.get("ppvz_sales_commission", 0)
-            deduction += item.get("deduction", 0)
-
-            # Собираем данные для себестоимости
-            article = item.get("nm_id")
-            if article:
-                if article not in articles:
-                    articles[article] = 0
-                articles[article] += quantity
+        with_nm = report_data.take(report_data.nm_id != 0)
+        nm_ids, quantities = with_nm.group_sum("nm_id", with_nm.col("quantity"))
+        articles = dict(zip(nm_ids.tolist(), quantities.tolist()))
         # print(shop_id)
         print(commission, ppvz_reward)
         if calculate_current_week:
@@ -1246,20 +1307,22 @@ async def calculate_metrics_from_report(report_data, shop_id, start_date, end_da
                     articles[article] += 1
 
 
-        # Себестоимость
+        # Себестоимость: артикулы продавца и цены одним запросом на всё
+        supplier_articles = {}
+        for nm_id, supplier_article in (
+            session.query(Order.nmId, Order.supplierArticle)
+            .filter(Order.shop_id == shop_id)
+            .distinct()
+        ):
+            supplier_articles.setdefault(nm_id, supplier_article)
+        cost_map = {
+            pc.article: pc.cost
+            for pc in session.query(ProductCost).filter(ProductCost.shop_id == shop_id)
+        }
         for article, quantity in articles.items():
-            print(article, quantity)
-            try:
-                supp_article = session.query(Order).filter(Order.nmId == int(article)).first().supplierArticle
-                product_cost = (
-                    session.query(ProductCost)
-                    .filter(ProductCost.shop_id == shop_id, ProductCost.article == supp_article)
-                    .first()
-                )
-                if product_cost:
-                    cost_of_goods += product_cost.cost * quantity
-            except:
-                pass
+            cost = cost_map.get(supplier_articles.get(int(article)))
+            if cost:
+                cost_of_goods += cost * quantity
         # Налоговая ставка
         tax_setting = (
             session.query(TaxSystemSetting)
@@ -1350,48 +1413,13 @@ async def calculate_metrics_from_report(report_data, shop_id, start_date, end_da
         )
         total_one_time = sum(expense.amount for expense in one_time_expenses)
 
-        # НОВЫЙ РАСЧЕТ СРОКА ОКУПАЕМОСТИ С ЛИНЕЙНОЙ РЕГРЕССИЕЙ
-        import numpy as np
-        from collections import defaultdict
-
-        # 1. Собираем прибыль по каждому месяцу
-        profits_by_month = defaultdict(float)
-
-        orders = (
-            session.query(Order)
-            .filter(Order.shop_id == shop_id)
-            .filter(Order.is_bouhght.is_(True))
-            .filter(Order.isCancel.is_(False))
-            .order_by(Order.date.asc())
-            .all()
-        )
-
-        for order in orders:
-            month_key = order.date.strftime("%Y-%m")
-            profit = order.priceWithDisc - (order.forPay or 0)
-            profits_by_month[month_key] += profit
-
-        if profits_by_month and total_one_time > 0:
-            # 2. Преобразуем данные в формат для регрессии
-            sorted_months = sorted(profits_by_month.items())
-            X = np.arange(len(sorted_months)).reshape(-1, 1)  # Месяцы: 0, 1, 2, ...
-            y = np.array([profit for _, profit in sorted_months])  # Прибыль
-
-            # 3. Строим линейную регрессию y = kx + b
-            coeffs = np.polyfit(X.flatten(), y, 1)  # 1 степень = линейная
-            k, b = coeffs
-
-            # 4. Прогнозируем прибыль на следующие месяцы, пока не окупится
-            total_cumulative_profit = sum(y)
-            month_idx = len(X)  # начинаем прогноз после последнего известного месяца
-            while total_cumulative_profit < total_one_time and month_idx < 120:  # ограничение 10 лет
-                predicted_profit = k * month_idx + b
-                predicted_profit = max(predicted_profit, 0)  # чтобы не было отрицательной прибыли
-                total_cumulative_profit += predicted_profit
-                month_idx += 1
-
-            if total_cumulative_profit >= total_one_time:
-                payback_period = f"{month_idx} месяцев"
+        # Срок окупаемости: накопленная прибыль плюс прогноз магазина по тренду
+        forecast = await get_shop_forecast(shop_id)
+        forecast_year_profit = float(forecast.shop_monthly("profit").sum())
+        if total_one_time > 0 and forecast.history_months:
+            months = forecast.payback_months(total_one_time)
+            if months is not None:
+                payback_period = f"{months} месяцев"
             else:
                 payback_period = "не определен (даже при прогнозе на 10 лет)"
         else:
@@ -1408,6 +1436,10 @@ async def calculate_metrics_from_report(report_data, shop_id, start_date, end_da
             roi = f"{roi_value:.1f}%"
             if roi_value > 100:
                 roi += " ✅ Поздравляем, вы окупили вложения!"
+        # ROI по прогнозу прибыли на 12 месяцев вперёд
+        forecast_roi = "не определен"
+        if total_one_time > 0:
+            forecast_roi = f"{forecast_year_profit / total_one_time * 100:.1f}%"
 
         try:
             ros_value = (net_profit / revenue) * 100
@@ -1425,6 +1457,8 @@ async def calculate_metrics_from_report(report_data, shop_id, start_date, end_da
             "profitability": profitability,
             "payback_period": payback_period,
             "roi": roi,
+            "forecast_roi": forecast_roi,
+            "forecast_year_profit": forecast_year_profit,
             "total_one_time": total_one_time,
             "advert": advert,
             "stops": stops,
@@ -1435,6 +1469,19 @@ async def calculate_metrics_from_report(report_data, shop_id, start_date, end_da
         session.close()
 
 
+def last_months_report(report):
+    """Отчёт за последние месяцы подряд с продажами (окна по 30 дней, не больше 12)"""
+    now = datetime.now()
+    months = 0
+    for i in range(12):
+        if not report.count_between(now - timedelta(days=31 + i * 30), now - timedelta(days=i * 30)):
+            break
+        months += 1
+    if not months:
+        return 0, report.take(slice(0, 0))
+    return months, report.between(now - timedelta(days=31 + (months - 1) * 30), now)
+
+
 async def select_anal_period_callback(callback: types.CallbackQuery, state: FSMContext):
 
 
@@ -1495,263 +1542,196 @@ async def select_anal_period_callback(callback: types.CallbackQuery, state: FSMC
             type_datalol = "week"
             period_name = f"{current_start.strftime('%d.%m')}-{now.strftime('%d.%m')}"
 
-    # Загружаем или получаем кэш
-    session = sessionmaker(bind=engine)()
-    cashed = session.query(CashedShopData).filter(CashedShopData.shop_id == shop_id).first()
-    if cashed is None:
-        # Ваш код загрузки данных из API и кэширования (оставляем без изменений)
-        # ...
-        session.close()
-        session = sessionmaker(bind=engine)()
-        cashed = session.query(CashedShopData).filter(CashedShopData.shop_id == shop_id).first()
-
-
-
-
-    # Фильтруем отчет по периоду
-    #if period_type == "custom" or period_type.startswith("custom_"):
-    #    current_report = []
-    #    for item in cashed.cashed_all or []:
-    #        try:
-    #            sale_date = datetime.strptime(item.get("sale_dt", "")[:10], "%Y-%m-%d")
-    #            if current_start <= sale_date <= current_end:
-    #                current_report.append(item)
-    #        except Exception:
-    #            continue
-    #if period_type == "custom" or period_type.startswith("custom_"):
-    if True:
-        loop = asyncio.get_event_loop()
-        current_report = await loop.run_in_executor(
-            None,
-            fetch_report_detail_by_period,
-            api_token,
-            current_start,
-            current_end
-        )
-    else:
-        if period_type == "week":
-            current_report = cashed.cashed_week or []
-        elif period_type == "month":
-            current_report = cashed.cashed_month or []
-        elif period_type == "year":
-            current_report = cashed.cashed_year or []
-        else:
-            current_report = cashed.cashed_all or []
-
-    # Если нет данных и период не неделя — предупреждаем
-    if not current_report and period_type != "week":
-        await callback.answer(
-            "❌ Не удалось получить данные за текущий период, подождите около 1-2 минуты и попробуйте снова",
-            show_alert=True,
-        )
-        return
-
-
-    async with state.proxy() as data:
-        shop_id = data["shop"]["id"]
-        shop_name = data["shop"]["name"] or f"Магазин {shop_id}"
-        api_token = data["shop"]["api_token"]
-        an_type = data["an_type"]
-        type_data = int(an_type.split("_")[1])  # <-- ПЕРЕНЕСИТЕ СЮДА
+    # Повторное нажатие, пока идёт такой же расчёт, не запускает его второй раз
+    key = job_key(callback.from_user.id, shop_id, an_type, period_type, current_start.date(), current_end.date())
+    async with report_jobs.single_flight(key) as duplicate:
+        if duplicate:
+            await message.edit_text("⏳ Этот расчёт уже выполняется — результат появится в предыдущем сообщении")
+            return
 
-               
-    
-        
-    if type_data == 3:
-        current_report = cashed.cashed_month or []
-        current_start = datetime(now.year, now.month, 1)
-        current_end = now
-        type_datalol = "month"
-
-    # обработка type_data 5 только если НЕ кастомный период
-    if type_data == 5:
-        current_report = []
-        start_now = datetime.now() - timedelta(days=365)
-        if cashed.cashed_all:
-            for i in cashed.cashed_all:
-                if isinstance(i, dict) and "sale_dt" in i:
-                    try:
-                        if datetime.strptime(i["sale_dt"][:10], "%Y-%m-%d") >= start_now:
-                            current_report.append(i)
-                    except (ValueError, TypeError):
-                        continue
-
-
-    if not current_report and period_type != "week":
-        await callback.answer(
-            "❌ Не удалось получить данные за текущий период, подождите около 1-2 минуты и попробуйте снова",
-            show_alert=True,
-        )
-        return
-    # print(an_type)
-    logger.info(f"Create AN report. AN-type: {an_type}")
-    report = cashed.cashed_all
-    await message.edit_text(text="Осталось совсем чуть-чуть ...")
+        # Колоночный отчёт магазина из памяти бота
+        report = await get_shop_frame(shop_id)
 
-    # Рассчитываем показатели
-    if an_type != "an_5":
-        current_metrics = await calculate_metrics_from_report(
-            current_report, shop_id, current_start, current_end, type_datalol
-        )
+        async with state.proxy() as data:
+            type_data = int(an_type.split("_")[1])
+            custom_start_date = data.get("custom_start_date")
+            custom_end_date = data.get("custom_end_date")
+
+        # Свежие данные WB ждём не дольше дедлайна, иначе отвечаем локальными
+        # и обновляем сообщение, когда WB ответит
+        pending = None
+        stale_at = None
+        if type_data == 3:
+            current_start = datetime(now.year, now.month, 1)
+            current_report = report.between(current_start, now)
+            current_end = now
+            type_datalol = "month"
+        elif type_data == 5:
+            # обработка type_data 5 только если НЕ кастомный период
+            start_now = datetime.now() - timedelta(days=365)
+            current_report = report.between(start_now, datetime.max)
+        else:
+            current_report, stale_at, pending = await fetch_report_with_deadline(
+                api_token, shop_id, current_start, current_end
+            )
+            if pending is not None and not current_report:
+                # Локально за период ничего нет — показывать нечего, ждём WB
+                current_report = await wait_fresh_report(pending, report.vocabs) or report.take(slice(0, 0))
+                pending = None
+                stale_at = None
+
+        # Если нет данных и период не неделя — предупреждаем
+        if not current_report and period_type != "week":
+            await callback.answer(
+                "❌ Не удалось получить данные за текущий период, подождите около 1-2 минуты и попробуйте снова",
+                show_alert=True,
+            )
+            return
+        # print(an_type)
+        logger.info(f"Create AN report. AN-type: {an_type}")
+        await message.edit_text(text="Осталось совсем чуть-чуть ...")
+
+        async def render(current_report, note=""):
+            # Рассчитываем показатели
+            if an_type != "an_5":
+                current_metrics = await calculate_metrics_from_report(
+                    current_report, shop_id, current_start, current_end, type_datalol
+                )
 
-    else:
-        amount_good_months = 0
-        net_profit = 0
-        report_data = []
-        type_data = "year"
-        for i in range(12):
-            start_now = datetime.now() - timedelta(days=31 + i * 30)
-            end_now = datetime.now() - timedelta(days=i * 30)
-            new_report = []
-            for report_str in report:
-                if (start_now <= datetime.strptime(report_str["sale_dt"][:10], "%Y-%m-%d") <= end_now):
-                    new_report.append(report_str)
-            if new_report != []:
-                amount_good_months += 1
-                report_data += new_report
             else:
-                break
-        start_now = datetime.now() - timedelta(days=31 + amount_good_months * 30)
-        end_now = datetime.now()
-        current_metrics = await calculate_metrics_from_report(
-            report_data, shop_id, start_now, end_now, type_datalol
-        )
+                amount_good_months = 0
+                net_profit = 0
+                type_data = "year"
+                amount_good_months, report_data = last_months_report(report)
+                start_now = datetime.now() - timedelta(days=31 + amount_good_months * 30)
+                end_now = datetime.now()
+                current_metrics = await calculate_metrics_from_report(
+                    report_data, shop_id, start_now, end_now, type_datalol
+                )
 
-    # Рассчитываем динамику
-    # revenue_change = current_metrics["revenue"] - (previous_metrics["revenue"] if previous_metrics else 0)
-    # profit_change = current_metrics["net_profit"] - (previous_metrics["net_profit"] if previous_metrics else 0)
-
-    # revenue_indicator = "🟢▲" if revenue_change >= 0 else "🔴▼"
-    # profit_indicator = "🟢▲" if profit_change >= 0 else "🔴▼"
-    if an_type =="an_1":
-        if period_type == "week":
-            date_start = current_start - timedelta(days=7)
-            date_end = date_start + timedelta(days=7)
-            new_report = []
-            for report_str in report:
-                if (date_start <= datetime.strptime(report_str["sale_dt"][:10], "%Y-%m-%d") <= date_end):
-                    new_report.append(report_str)
-            last_metrics = await calculate_metrics_from_report(new_report, shop_id, date_start, date_end, "week", False)
-        elif period_type == "month":
-            date_start = current_start - timedelta(days=30)
-            date_end = date_start + timedelta(days=30)
-            new_report = []
-            for report_str in report:
-                if (date_start <= datetime.strptime(report_str["sale_dt"][:10], "%Y-%m-%d") <= date_end):
-                    new_report.append(report_str)
-            last_metrics = await calculate_metrics_from_report(new_report, shop_id, date_start, date_end, "month", False)
-        elif period_type == "year":
-            date_start = current_start - timedelta(days=365)
-            date_end = date_start + timedelta(days=365)
-            new_report = []
-            for report_str in report:
-                if (date_start <= datetime.strptime(report_str["sale_dt"][:10], "%Y-%m-%d") <= date_end):
-                    new_report.append(report_str)
-            last_metrics = await calculate_metrics_from_report(new_report, shop_id, date_start, date_end, "year", False)
-        elif period_type == "custom":
-            # Получаем кастомные даты из state
-            async with state.proxy() as data:
-                date_start = data.get("custom_start_date")
-                date_end = data.get("custom_end_date")
-            
-            if date_start and date_end:
-                new_report = []
-                for report_str in report:
-                    if (date_start <= datetime.strptime(report_str["sale_dt"][:10], "%Y-%m-%d") <= date_end):
-                        new_report.append(report_str)
-                last_metrics = await calculate_metrics_from_report(new_report, shop_id, date_start, date_end, "custom", False)
-            else:
-                # Fallback если кастомные даты не найдены
-                date_start = current_start - timedelta(days=30)
-                date_end = date_start + timedelta(days=30)
-                new_report = []
-                for report_str in report:
-                    if (date_start <= datetime.strptime(report_str["sale_dt"][:10], "%Y-%m-%d") <= date_end):
-                        new_report.append(report_str)
-                last_metrics = await calculate_metrics_from_report(new_report, shop_id, date_start, date_end, "month", False)
+            # Рассчитываем динамику
+            # revenue_change = current_metrics["revenue"] - (previous_metrics["revenue"] if previous_metrics else 0)
+            # profit_change = current_metrics["net_profit"] - (previous_metrics["net_profit"] if previous_metrics else 0)
+
+            # revenue_indicator = "🟢▲" if revenue_change >= 0 else "🔴▼"
+            # profit_indicator = "🟢▲" if profit_change >= 0 else "🔴▼"
+            if an_type =="an_1":
+                if period_type == "week":
+                    date_start = current_start - timedelta(days=7)
+                    date_end = date_start + timedelta(days=7)
+                    new_report = report.between(date_start, date_end)
+                    last_metrics = await calculate_metrics_from_report(new_report, shop_id, date_start, date_end, "week", False)
+                elif period_type == "month":
+                    date_start = current_start - timedelta(days=30)
+                    date_end = date_start + timedelta(days=30)
+                    new_report = report.between(date_start, date_end)
+                    last_metrics = await calculate_metrics_from_report(new_report, shop_id, date_start, date_end, "month", False)
+                elif period_type == "year":
+                    date_start = current_start - timedelta(days=365)
+                    date_end = date_start + timedelta(days=365)
+                    new_report = report.between(date_start, date_end)
+                    last_metrics = await calculate_metrics_from_report(new_report, shop_id, date_start, date_end, "year", False)
+                elif period_type == "custom":
+                    # Кастомные даты прочитаны из state до расчёта
+                    date_start = custom_start_date
+                    date_end = custom_end_date
+
+                    if date_start and date_end:
+                        new_report = report.between(date_start, date_end)
+                        last_metrics = await calculate_metrics_from_report(new_report, shop_id, date_start, date_end, "custom", False)
+                    else:
+                        # Fallback если кастомные даты не найдены
+                        date_start = current_start - timedelta(days=30)
+                        date_end = date_start + timedelta(days=30)
+                        new_report = report.between(date_start, date_end)
+                        last_metrics = await calculate_metrics_from_report(new_report, shop_id, date_start, date_end, "month", False)
             
 
-    # Форматируем отчет
-    text = ""
+            # Форматируем отчет
+            text = ""
+
+            #
+            #         f"💵 Чистая прибыль: {current_metrics['net_profit']:.2f} руб. \n"
+            #         f"📈 Рентабельность: {current_metrics['profitability']:.1f}%\n"
+            #         f"⏳ Срок окупаемости: {current_metrics['payback_period']}\n"
+            #         f"📊 ROI: {current_metrics['roi']}\n\n"
+            if an_type == "an_1":
+                # Блок an_1
+                destanation = f"▲ {last_metrics['net_profit']:.2f} руб." if last_metrics['net_profit'] < current_metrics['net_profit'] else f"▼ {last_metrics['net_profit']:.2f} руб."
+                text = (
+                    f"Период: <b>({period_name})</b>\n\n"
+                    "<u>Основные показатели:</u>\n"
+                    f"▫️Выручка: {current_metrics['revenue']:.2f} руб.\n"
+                    f"▫️Комиссии: {current_metrics['commission']:.2f} руб. <b>{current_metrics['commission']/current_metrics['revenue']*100:.1f}%</b>\n"
+                    f"▫️Логистика: {current_metrics['logistics']:.2f} руб. <b>{current_metrics['logistics']/current_metrics['revenue']*100:.1f}%</b>\n"
+                    f"▫️Хранение: {current_metrics['storage']:.2f} руб. <b>{current_metrics['storage']/current_metrics['revenue']*100:.1f}%</b>\n"
+                    f"▫️Себестоимость: {current_metrics['cost_of_goods']:.2f} руб. <b>{current_metrics['cost_of_goods']/current_metrics['revenue']*100:.1f}%</b>\n"
+                    f"▫️Налог: {current_metrics['tax']:.2f} руб. <b>{current_metrics['tax']/current_metrics['revenue']*100:.1f}%</b>\n"
+                    f"▫️Регулярные затраты: {current_metrics['regular_expenses']:.2f} руб. <b>{current_metrics['regular_expenses']/current_metrics['revenue']*100:.1f}%</b>\n"
+                    f"▫️Рекламные затраты: {current_metrics['advert']} руб. <b>{current_metrics['advert']/current_metrics['revenue']*100:.1f}%</b>\n"
+                    f"▫️Прочие удержания: {current_metrics['deduction']} руб. <b>{current_metrics['deduction']/current_metrics['revenue']*100:.1f}%</b>\n"
+                    f"▫️Штрафы: {current_metrics['stops']} руб. <b>{current_metrics['stops']/current_metrics['revenue']*100:.1f}%</b>\n\n"
+                    f"〽️ Чистая прибыль: {current_metrics['net_profit']:.2f} руб. ({destanation}) <b>{current_metrics['net_profit']/current_metrics['revenue']*100:.1f}%</b>\n\n"
+                )
 
-    #
-    #         f"💵 Чистая прибыль: {current_metrics['net_profit']:.2f} руб. \n"
-    #         f"📈 Рентабельность: {current_metrics['profitability']:.1f}%\n"
-    #         f"⏳ Срок окупаемости: {current_metrics['payback_period']}\n"
-    #         f"📊 ROI: {current_metrics['roi']}\n\n"
-    async with state.proxy() as data:
-        an_type = data["an_type"]
-    if an_type == "an_1":
-        # Блок an_1
-        destanation = f"▲ {last_metrics['net_profit']:.2f} руб." if last_metrics['net_profit'] < current_metrics['net_profit'] else f"▼ {last_metrics['net_profit']:.2f} руб."
-        text = (
-            f"Период: <b>({period_name})</b>\n\n"
-            "<u>Основные показатели:</u>\n"
-            f"▫️Выручка: {current_metrics['revenue']:.2f} руб.\n"
-            f"▫️Комиссии: {current_metrics['commission']:.2f} руб. <b>{current_metrics['commission']/current_metrics['revenue']*100:.1f}%</b>\n"
-            f"▫️Логистика: {current_metrics['logistics']:.2f} руб. <b>{current_metrics['logistics']/current_metrics['revenue']*100:.1f}%</b>\n"
-            f"▫️Хранение: {current_metrics['storage']:.2f} руб. <b>{current_metrics['storage']/current_metrics['revenue']*100:.1f}%</b>\n"
-            f"▫️Себестоимость: {current_metrics['cost_of_goods']:.2f} руб. <b>{current_metrics['cost_of_goods']/current_metrics['revenue']*100:.1f}%</b>\n"
-            f"▫️Налог: {current_metrics['tax']:.2f} руб. <b>{current_metrics['tax']/current_metrics['revenue']*100:.1f}%</b>\n"
-            f"▫️Регулярные затраты: {current_metrics['regular_expenses']:.2f} руб. <b>{current_metrics['regular_expenses']/current_metrics['revenue']*100:.1f}%</b>\n"
-            f"▫️Рекламные затраты: {current_metrics['advert']} руб. <b>{current_metrics['advert']/current_metrics['revenue']*100:.1f}%</b>\n"
-            f"▫️Прочие удержания: {current_metrics['deduction']} руб. <b>{current_metrics['deduction']/current_metrics['revenue']*100:.1f}%</b>\n"
-            f"▫️Штрафы: {current_metrics['stops']} руб. <b>{current_metrics['stops']/current_metrics['revenue']*100:.1f}%</b>\n\n"
-            f"〽️ Чистая прибыль: {current_metrics['net_profit']:.2f} руб. ({destanation}) <b>{current_metrics['net_profit']/current_metrics['revenue']*100:.1f}%</b>\n\n"
-        )
+                # Блок an_3 (окупаемость)
+                text += (
+                    "<u>Срок окупаемости:</u>\n"
+                    f"▫️Разовые вложения: {current_metrics['total_one_time']:.2f} руб.\n"
+                    f"▫️Чистая прибыль за месяц: {current_metrics['net_profit']:.2f} руб.\n"
+                    f"🧮 Срок окупаемости = {current_metrics['payback_period']}\n\n"
+                )
 
-        # Блок an_3 (окупаемость)
-        text += (
-            "<u>Срок окупаемости:</u>\n"
-            f"▫️Разовые вложения: {current_metrics['total_one_time']:.2f} руб.\n"
-            f"▫️Чистая прибыль за месяц: {current_metrics['net_profit']:.2f} руб.\n"
-            f"🧮 Срок окупаемости = {current_metrics['payback_period']}\n\n"
-        )
+                # Блок an_4 (рентабельность)
+                text += (
+                    "<u>Рентабельность инвестиций:</u>\n"
+                    f"▫️Выручка: {current_metrics['revenue']:.2f} руб.\n"
+                    f"▫️Чистая прибыль: {current_metrics['net_profit']:.2f} руб.\n"
+                    f"▫️Разовые вложения: {current_metrics['total_one_time']:.2f} руб.\n"
+                    f"📊 ROI: {current_metrics['roi']}\n"
+                    f"📈 ROI по прогнозу на 12 мес.: {current_metrics['forecast_roi']}\n\n"
+                )
 
-        # Блок an_4 (рентабельность)
-        text += (
-            "<u>Рентабельность инвестиций:</u>\n"
-            f"▫️Выручка: {current_metrics['revenue']:.2f} руб.\n"
-            f"▫️Чистая прибыль: {current_metrics['net_profit']:.2f} руб.\n"
-            f"▫️Разовые вложения: {current_metrics['total_one_time']:.2f} руб.\n"
-            f"📊 ROI: {current_metrics['roi']}\n\n"
-        )
+                # Блок an_5 (годовая доходность)
+                amount_good_months = 0
+                net_profit = 0
+                amount_good_months, report_data = last_months_report(report)
+                start_now = datetime.now() - timedelta(days=31 + amount_good_months * 30)
+                end_now = datetime.now()
+                metrics_for_an_5 = await calculate_metrics_from_report(
+                    report_data, shop_id, start_now, end_now, "year"
+                )
+                text += (
+                    "<u>Годовая доходность:</u>\n"
+                    f"▫️Чистая прибыль за {amount_good_months} мес.: {metrics_for_an_5['net_profit']:.2f} руб.\n"
+                    f"▫️Годовая доходность: {metrics_for_an_5['roi']}\n"
+                    f"▫️Прогноз прибыли на 12 мес.: {metrics_for_an_5['forecast_year_profit']:.2f} руб.\n"
+                )
 
-        # Блок an_5 (годовая доходность)
-        amount_good_months = 0
-        net_profit = 0
-        report_data = []
-        for i in range(12):
-            start_now = datetime.now() - timedelta(days=31 + i * 30)
-            end_now = datetime.now() - timedelta(days=i * 30)
-            new_report = []
-            for report_str in report:
-                if (start_now <= datetime.strptime(report_str["sale_dt"][:10], "%Y-%m-%d") <= end_now):
-                    new_report.append(report_str)
-            if new_report:
-                amount_good_months += 1
-                report_data += new_report
-            else:
-                break
-        start_now = datetime.now() - timedelta(days=31 + amount_good_months * 30)
-        end_now = datetime.now()
-        metrics_for_an_5 = await calculate_metrics_from_report(
-            report_data, shop_id, start_now, end_now, "year"
-        )
-        text += (
-            "<u>Годовая доходность:</u>\n"
-            f"▫️Чистая прибыль за {amount_good_months} мес.: {metrics_for_an_5['net_profit']:.2f} руб.\n"
-            f"▫️Годовая доходность: {metrics_for_an_5['roi']}\n"
-        )
+                text += f"\n<i>Примечание: расчеты основаны на данных WB API</i>"
 
-        text += f"\n<i>Примечание: расчеты основаны на данных WB API</i>"
 
-        await message.edit_text(text)
-    
-    keyboard = InlineKeyboardMarkup()
-    keyboard.add(InlineKeyboardButton("🔙 Назад", callback_data="main_menu"))
-    # await message.delete()
-    await message.edit_text(text, reply_markup=keyboard)
+            text += note
+            keyboard = InlineKeyboardMarkup()
+            keyboard.add(InlineKeyboardButton("🔙 Назад", callback_data="main_menu"))
+            # await message.delete()
+            await message.edit_text(text, reply_markup=keyboard)
+
+        if pending is not None or stale_at is not None:
+            await render(current_report, freshness_note(stale_at, refreshing=pending is not None))
+        else:
+            await render(current_report)
+
+        if pending is not None:
+            async def refresh_when_ready():
+                try:
+                    fresh_report = await wait_fresh_report(pending, report.vocabs)
+                    if fresh_report is not None:
+                        await render(fresh_report)
+                except Exception as e:
+                    logger.error(f"Ошибка обновления аналитики свежими данными: {e}")
+
+            asyncio.create_task(refresh_when_ready())
     # await state.finish()
     # kb.add(InlineKeyboardButton("Чистая прибыль", callback_data="an_1"))
     # kb.add(InlineKeyboardButton("ROS(Рентабльность продаж)", callback_data="an_2"))
@@ -2080,9 +2060,25 @@ def register_analytics_handlers(dp: Dispatcher):
     dp.register_callback_query_handler(
         top5_products_callback, text="top5_products", state="*"
     )
+    dp.register_callback_query_handler(
+        top5_products_callback, lambda c: c.data.startswith("rank:"), state="*"
+    )
+    dp.register_callback_query_handler(
+        what_if_grid_callback, lambda c: c.data.startswith("what_if_grid:"), state="*"
+    )
     dp.register_callback_query_handler(
         what_if_simulator_callback, text="what_if_simulator", state="*"
     )
+    dp.register_callback_query_handler(forecast_callback, text="forecast", state="*")
+    dp.register_callback_query_handler(anomalies_callback, text="anomalies", state="*")
+    dp.register_callback_query_handler(abc_xyz_callback, text="abc_xyz", state="*")
+    dp.register_callback_query_handler(order_geo_callback, text="order_geo", state="*")
+    dp.register_callback_query_handler(
+        order_geo_callback, lambda c: c.data.startswith("geo:"), state="*"
+    )
+    dp.register_callback_query_handler(
+        order_geo_xlsx_callback, lambda c: c.data.startswith("geo_xlsx:"), state="*"
+    )
     dp.register_callback_query_handler(
         product_analytics_callback, text="product_analytics", state="*"
     )
@@ -2094,6 +2090,11 @@ def register_analytics_handlers(dp: Dispatcher):
         lambda c: c.data in ["prev_articles_page", "next_articles_page"],
         state=AnalyticsStates.waiting_for_article,
     )
+    dp.register_callback_query_handler(
+        profitability_level_callback,
+        lambda c: c.data.startswith("profitability_level_"),
+        state=AnalyticsStates.waiting_for_article,
+    )
     dp.register_callback_query_handler(
         select_article_callback,
         lambda c: c.data.startswith("select_article_"),
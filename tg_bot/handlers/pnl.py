@@ -1,20 +1,22 @@
 import logging
 import asyncio
 import openpyxl
-from openpyxl import load_workbook
 import io
 from datetime import datetime, timedelta
 from aiogram import types
 from aiogram.dispatcher import FSMContext
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InputFile
 from tg_bot.models import sessionmaker, engine
-from tg_bot.models import Shop, CashedShopData, Advertisement, Penalty
+from tg_bot.models import Shop, Advertisement, Penalty
 from tg_bot.models import (
     TaxSystemType, TaxSystemSetting,
     ProductCost, RegularExpense, OneTimeExpense
 )
 from tg_bot.keyboards.pnl_menu import pnl_period_keyboard
-from tg_bot.services.wb_api import fetch_full_report, fetch_report_detail_by_period
+from tg_bot.services.shop_dataset import get_shop_frame
+from tg_bot.services.fresh_fetch import fetch_report_with_deadline, wait_fresh_report, freshness_note
+from tg_bot.services.jobs import report_jobs, job_runner, job_key, JobResult
+from tg_bot.services.workbooks import build_workbook, pnl_workbook
 from tg_bot.states.pnl_states import PNLStates
 from dateutil.relativedelta import relativedelta
 
@@ -36,33 +38,22 @@ async def pnl_callback(callback: types.CallbackQuery, state: FSMContext):
     )
     await PNLStates.waiting_for_period.set()
 
-async def generate_pnl_excel_report(shop_id: int, shop_api_token: str, start_date: datetime, end_date: datetime, shop_name: str):
-    """Генерация Excel-отчета PNL"""
+async def generate_pnl_excel_report(shop_id: int, shop_api_token: str, start_date: datetime, end_date: datetime, shop_name: str, report_data=None):
+    """Генерация Excel-отчета PNL: bytes xlsx или None (report_data — уже полученный ReportFrame периода)"""
 
 
     session = sessionmaker()(bind=engine)
     # Получаем свежие данные из WB API
-
-    if True:
-        loop = asyncio.get_event_loop()
-        report_data = await loop.run_in_executor(
-            None,
-            fetch_report_detail_by_period,
-            shop_api_token,
-            start_date,
-            end_date
-        )    
-    #report_data = await fetch_report_detail_by_period(shop_api_token, start_date, end_date)
-    if not report_data:
+    if report_data is None:
+        report_data, _, _ = await fetch_report_with_deadline(
+            shop_api_token, shop_id, start_date, end_date, deadline=None
+        )
+    if not len(report_data):
         return None
     try:
         # Получаем кэшированные данные
-        cashed_data = (
-            session.query(CashedShopData)
-            .filter(CashedShopData.shop_id == shop_id)
-            .first()
-        )
-        if not cashed_data or not cashed_data.cashed_all:
+        shop_frame = await get_shop_frame(shop_id)
+        if not len(shop_frame):
             return None
 
 
@@ -73,13 +64,8 @@ async def generate_pnl_excel_report(shop_id: int, shop_api_token: str, start_dat
         )
 
         if is_year_report:
-            try:
-                wb = load_workbook("pnl_template_year.xlsx")
-            except FileNotFoundError:
-                wb = openpyxl.Workbook()
-                ws = wb.active
-                ws.title = "P&L Year"
-            ws = wb.active
+            # Значения ячеек шаблона; книгу собирает пул процессов
+            cells = {}
 
             year = start_date.year
             # Период текущего года: с 1 января по end_date
@@ -90,17 +76,8 @@ async def generate_pnl_excel_report(shop_id: int, shop_api_token: str, start_dat
             prev_year_end = datetime(year - 1, 12, 31)
 
             # Данные за текущий и прошлый год
-            current_year_data = []
-            prev_year_data = []
-            for item in report_data:
-                try:
-                    sale_date = datetime.strptime(item.get("sale_dt", "")[:10], "%Y-%m-%d")
-                    if year_start <= sale_date <= year_end:
-                        current_year_data.append(item)
-                    elif prev_year_start <= sale_date <= prev_year_end:
-                        prev_year_data.append(item)
-                except (ValueError, TypeError):
-                    continue
+            current_year_data = report_data.between(year_start, year_end)
+            prev_year_data = report_data.between(prev_year_start, prev_year_end)
 
             current_metrics = await calculate_metrics_from_report(
                 current_year_data, shop_id, year_start, year_end
@@ -138,16 +115,16 @@ async def generate_pnl_excel_report(shop_id: int, shop_api_token: str, start_dat
 
             # C3–C13: метрики за год
             for i, value in enumerate(current_values, 3):
-                ws[f'C{i}'] = value
+                cells[f'C{i}'] = value
 
             # E3–E13: динамика год к году
             for i in range(3, 14):
                 curr = current_values[i-3]
                 prev = previous_values[i-3]
                 if prev != 0:
-                    ws[f'E{i}'] = (curr - prev) / prev
+                    cells[f'E{i}'] = (curr - prev) / prev
                 else:
-                    ws[f'E{i}'] = 0 if curr == 0 else 1
+                    cells[f'E{i}'] = 0 if curr == 0 else 1
 
             # F3–Q13: метрики по месяцам (F — январь, ..., Q — декабрь)
             for month in range(1, 13):
@@ -160,11 +137,8 @@ async def generate_pnl_excel_report(shop_id: int, shop_api_token: str, start_dat
                     month_end = end_date
                 if month_start > end_date:
                     continue
-                month_data = [
-                    item for item in current_year_data
-                    if month_start <= datetime.strptime(item.get("sale_dt", "")[:10], "%Y-%m-%d") <= month_end
-                ]
-                if not month_data:
+                month_data = current_year_data.between(month_start, month_end)
+                if not len(month_data):
                     continue  # Если данных нет, ячейки остаются пустыми
                 month_metrics = await calculate_metrics_from_report(month_data, shop_id, month_start, month_end)
                 month_values = [
@@ -182,9 +156,9 @@ async def generate_pnl_excel_report(shop_id: int, shop_api_token: str, start_dat
                 ]
                 col_letter = openpyxl.utils.get_column_letter(6 + month - 1)  # F=6, ..., Q=17
                 for row, value in enumerate(month_values, 3):
-                    ws[f'{col_letter}{row}'] = value
+                    cells[f'{col_letter}{row}'] = value
 
-            return wb
+            return await build_workbook(pnl_workbook, "pnl_template_year.xlsx", "P&L Year", cells)
 
         # --- ДОБАВЛЕНО: Недельный отчёт ---
         is_week_report = (
@@ -194,13 +168,7 @@ async def generate_pnl_excel_report(shop_id: int, shop_api_token: str, start_dat
 
 
         if is_week_report:
-            try:
-                wb = load_workbook("pnl_template.xlsx")
-            except FileNotFoundError:
-                wb = openpyxl.Workbook()
-                ws = wb.active
-                ws.title = "P&L Отчет"
-            ws = wb.active
+            cells = {}
 
             # Метрики за текущую и прошлую неделю
             week_start = start_date
@@ -209,17 +177,8 @@ async def generate_pnl_excel_report(shop_id: int, shop_api_token: str, start_dat
             prev_week_end = week_end - timedelta(days=7)
 
             # Данные за текущую и прошлую неделю
-            current_week_data = []
-            prev_week_data = []
-            for item in report_data:
-                try:
-                    sale_date = datetime.strptime(item.get("sale_dt", "")[:10], "%Y-%m-%d")
-                    if week_start <= sale_date <= week_end:
-                        current_week_data.append(item)
-                    elif prev_week_start <= sale_date <= prev_week_end:
-                        prev_week_data.append(item)
-                except (ValueError, TypeError):
-                    continue
+            current_week_data = report_data.between(week_start, week_end)
+            prev_week_data = report_data.between(prev_week_start, prev_week_end)
 
             current_metrics = await calculate_metrics_from_report(
                 current_week_data, shop_id, week_start, week_end
@@ -257,27 +216,24 @@ async def generate_pnl_excel_report(shop_id: int, shop_api_token: str, start_dat
 
             # C3–C13: метрики за неделю
             for i, value in enumerate(current_values, 3):
-                ws[f'C{i}'] = value
+                cells[f'C{i}'] = value
 
             # E3–E13: динамика неделя к неделе
             for i in range(3, 14):
                 curr = current_values[i-3]
                 prev = previous_values[i-3]
                 if prev != 0:
-                    ws[f'E{i}'] = (curr - prev) / prev
+                    cells[f'E{i}'] = (curr - prev) / prev
                 else:
-                    ws[f'E{i}'] = 0 if curr == 0 else 1
+                    cells[f'E{i}'] = 0 if curr == 0 else 1
 
             # F3–L13: метрики по дням недели (F=понедельник, ..., L=воскресенье)
             for day_offset in range(7):
                 day_date = week_start + timedelta(days=day_offset)
                 if day_date > week_end:
                     break
-                day_data = [
-                    item for item in current_week_data
-                    if datetime.strptime(item.get("sale_dt", "")[:10], "%Y-%m-%d").date() == day_date.date()
-                ]
-                if not day_data:
+                day_data = current_week_data.on_day(day_date)
+                if not len(day_data):
                     continue  # Если данных нет, ячейки остаются пустыми
                 day_metrics = await calculate_metrics_from_report(day_data, shop_id, day_date, day_date)
                 day_values = [
@@ -295,9 +251,9 @@ async def generate_pnl_excel_report(shop_id: int, shop_api_token: str, start_dat
                 ]
                 col_letter = openpyxl.utils.get_column_letter(6 + day_offset)  # F=6, ..., L=12
                 for row, value in enumerate(day_values, 3):
-                    ws[f'{col_letter}{row}'] = value
+                    cells[f'{col_letter}{row}'] = value
             print("week report is active")
-            return wb
+            return await build_workbook(pnl_workbook, "pnl_template.xlsx", "P&L Отчет", cells)
 
 
 
@@ -309,37 +265,16 @@ async def generate_pnl_excel_report(shop_id: int, shop_api_token: str, start_dat
         previous_end = start_date - timedelta(days=1)
 
         # Фильтруем данные за текущий период
-        current_report_data = []
-        for item in report_data:
-            try:
-                sale_date = datetime.strptime(item.get("sale_dt", "")[:10], "%Y-%m-%d")
-                if start_date <= sale_date <= end_date:
-                    current_report_data.append(item)
-            except (ValueError, TypeError):
-                continue
+        current_report_data = report_data.between(start_date, end_date)
 
         # Фильтруем данные за предыдущий период (для расчета динамики)
-        previous_report_data = []
-        for item in cashed_data.cashed_all:
-            try:
-                sale_date = datetime.strptime(item.get("sale_dt", "")[:10], "%Y-%m-%d")
-                if previous_start <= sale_date <= previous_end:
-                    previous_report_data.append(item)
-            except (ValueError, TypeError):
-                continue
+        previous_report_data = shop_frame.between(previous_start, previous_end)
 
-        if not current_report_data:
+        if not len(current_report_data):
             return None
 
-        # Загружаем шаблон
-        try:
-            wb = load_workbook("pnl_template.xlsx")
-        except FileNotFoundError:
-            wb = openpyxl.Workbook()
-            ws = wb.active
-            ws.title = "P&L Отчет"
-        
-        ws = wb.active
+        # Значения ячеек шаблона pnl_template.xlsx
+        cells = {}
 
         # Рассчитываем метрики за текущий месяц
         current_metrics = await calculate_metrics_from_report(current_report_data, shop_id, start_date, end_date)
@@ -379,7 +314,7 @@ async def generate_pnl_excel_report(shop_id: int, shop_api_token: str, start_dat
 
         # Заполняем ячейки C3-C13 (текущий период)
         for i, value in enumerate(current_values, 3):
-            ws[f'C{i}'] = value
+            cells[f'C{i}'] = value
 
             # Рассчитываем и заполняем динамику в ячейки E3-E13
             # Формула: (текущий - предыдущий) / предыдущий
@@ -389,14 +324,14 @@ async def generate_pnl_excel_report(shop_id: int, shop_api_token: str, start_dat
                 
                 if previous_val != 0:
                     dynamic = (current_val - previous_val) / previous_val
-                    ws[f'E{i}'] = dynamic
+                    cells[f'E{i}'] = dynamic
                 else:
                     # Если предыдущее значение равно 0, устанавливаем 0 или 1
-                    ws[f'E{i}'] = 0 if current_val == 0 else 1
+                    cells[f'E{i}'] = 0 if current_val == 0 else 1
 
             # ВОССТАНАВЛИВАЕМ: Заполняем ячейки C3-C13 (текущий период)
             for i, value in enumerate(current_values, 3):
-                ws[f'C{i}'] = value
+                cells[f'C{i}'] = value
 
             # ДОБАВЛЯЕМ: Заполняем данные по дням месяца (F3-F13, G3-G13, и т.д.)
             # Собираем уникальные даты с данными
@@ -420,14 +355,7 @@ async def generate_pnl_excel_report(shop_id: int, shop_api_token: str, start_dat
             # Заполняем данные только для дней с данными
             for day_index, current_date in enumerate(sorted_dates):
                 # Фильтруем данные за конкретный день
-                daily_data = []
-                for item in cashed_data.cashed_all:
-                    try:
-                        sale_date = datetime.strptime(item.get("sale_dt", "")[:10], "%Y-%m-%d")
-                        if sale_date.date() == current_date:
-                            daily_data.append(item)
-                    except (ValueError, TypeError):
-                        continue
+                daily_data = shop_frame.on_day(current_date)
                 
                 # Рассчитываем метрики за день
                 daily_metrics = await calculate_metrics_from_report(daily_data, shop_id, current_date, current_date)
@@ -452,9 +380,9 @@ async def generate_pnl_excel_report(shop_id: int, shop_api_token: str, start_dat
                 ]
                 
                 for i, value in enumerate(daily_values, 3):
-                    ws[f'{column_letter}{i}'] = value
+                    cells[f'{column_letter}{i}'] = value
 
-            return wb
+            return await build_workbook(pnl_workbook, "pnl_template.xlsx", "P&L Отчет", cells)
         
     except Exception as e:
         logger.error(f"Ошибка генерации PNL отчета: {e}")
@@ -467,53 +395,36 @@ async def generate_pnl_excel_report(shop_id: int, shop_api_token: str, start_dat
 async def calculate_metrics_from_report(report_data, shop_id, start_date, end_date):
     session = sessionmaker()(bind=engine)
     try:
-        # Основные показатели
-        revenue = 0
-        logistics = 0
-        storage_fee = 0
-        commission = 0
+        # Основные показатели (report_data — ReportFrame)
+        quantity = report_data.col("quantity")
+
+        # Выручка
+        revenue = float((report_data.col("retail_price_withdisc_rub") * quantity).sum())
+
+        # Заказы и продажи
+        sales = int(round(quantity[report_data.contains("doc_type_name", "продажа", "sale")].sum()))
+        orders = int(round(quantity.sum()))
+
+        # Логистика и хранение
+        logistics = report_data.sum("delivery_rub")
+        storage_fee = report_data.sum("storage_fee")
+
+        # Комиссия WB
+        commission = report_data.sum("ppvz_sales_commission") + report_data.sum("ppvz_vw") + report_data.sum("ppvz_vw_nds")
+
+        # Себестоимость: количество по nm_id и себестоимости магазина одним запросом
+        with_nm = report_data.take(report_data.nm_id != 0)
+        nm_ids, quantities = with_nm.group_sum("nm_id", with_nm.col("quantity"))
+        costs = dict(
+            session.query(ProductCost.article, ProductCost.cost)
+            .filter(ProductCost.shop_id == shop_id)
+            .all()
+        )
         cost_of_goods = 0
-        orders = 0
-        sales = 0
-        
-        # Собираем артикулы для расчета себестоимости
-        articles = {}
-        for item in report_data:
-            # Выручка
-            retail_price = item.get('retail_price_withdisc_rub', 0)
-            quantity = item.get('quantity', 0)
-            revenue += retail_price * quantity
-            
-            # Заказы и продажи
-            doc_type = item.get("doc_type_name", "")
-            if "продажа" in doc_type.lower() or "sale" in doc_type.lower():
-                sales += quantity
-            orders += quantity
-            
-            # Логистика
-            logistics += item.get('delivery_rub', 0)
-            
-            # Хранение
-            storage_fee += item.get('storage_fee', 0)
-            
-            # Комиссия WB
-            commission += item.get('ppvz_sales_commission', 0) + item.get('ppvz_vw', 0) + item.get('ppvz_vw_nds', 0)
-            
-            # Собираем данные для себестоимости
-            article = item.get('nm_id')
-            if article:
-                if article not in articles:
-                    articles[article] = 0
-                articles[article] += quantity
-        
-        # Себестоимость
-        for article, quantity in articles.items():
-            product_cost = session.query(ProductCost).filter(
-                ProductCost.shop_id == shop_id,
-                ProductCost.article == article
-            ).first()
-            if product_cost:
-                cost_of_goods += product_cost.cost * quantity
+        for nm_id, article_quantity in zip(nm_ids, quantities):
+            cost = costs.get(str(nm_id))
+            if cost is not None:
+                cost_of_goods += cost * float(article_quantity)
         
         # Налоговая ставка с поддержкой кастомного процента
         tax_setting = session.query(TaxSystemSetting).filter(
@@ -612,6 +523,48 @@ async def calculate_metrics_from_report(report_data, shop_id, start_date, end_da
         session.close()
         session.close()
 
+def pnl_filename(shop_name):
+    safe_shop_name = "".join(c for c in shop_name if c.isalnum() or c in (' ', '-', '_')).rstrip()
+    return f"pnl_{safe_shop_name}_{datetime.now().strftime('%Y%m%d%H%M')}.xlsx"
+
+
+def pnl_workbook_file(document: bytes, shop_name):
+    """Книга PNL (bytes) в InputFile для отправки"""
+    return InputFile(io.BytesIO(document), filename=pnl_filename(shop_name))
+
+
+@job_runner("pnl_excel")
+async def pnl_excel_job(params, context, progress):
+    """Фоновая генерация PNL Excel; context — уже полученный отчёт (нет после рестарта)"""
+    shop_name = params["shop_name"]
+    progress(
+        f"📊 <b>Генерация PNL отчета</b>\n\n"
+        f"Магазин: {shop_name}\n"
+        f"Период: за {params['period_name']}\n\n"
+        "⏳ Считаю показатели и заполняю шаблон..."
+    )
+    start_date = datetime.fromisoformat(params["start_date"])
+    end_date = datetime.fromisoformat(params["end_date"])
+    document = await generate_pnl_excel_report(
+        params["shop_id"], params["api_token"], start_date, end_date, shop_name,
+        (context or {}).get("report_data"),
+    )
+    if not document:
+        return JobResult(text=(
+            "❌ <b>Не удалось сгенерировать отчет</b>\n\n"
+            "Возможные причины:\n"
+            "1. Нет данных за выбранный период\n"
+            "2. Проблемы с подключением к базе данных\n"
+            "3. Файл шаблона pnl_template.xlsx не найден"
+        ))
+
+    caption = f"📊 PNL отчет за {params['period_name']}\nМагазин: {shop_name}"
+    return JobResult(
+        document=document,
+        filename=pnl_filename(shop_name),
+        caption=caption + (context or {}).get("note", ""),
+    )
+
 # Обработка выбора периода
 # Обработка выбора периода
 async def select_pnl_period_callback(callback: types.CallbackQuery, state: FSMContext):
@@ -661,36 +614,53 @@ async def select_pnl_period_callback(callback: types.CallbackQuery, state: FSMCo
         shop_name = data['shop']['name'] or f"Магазин {shop_id}"
         shop_api_token = data['shop']['api_token']
 
-
-    
-    # Генерируем Excel отчет
-    wb = await generate_pnl_excel_report(shop_id, shop_api_token, start_date, end_date, shop_name)
-    
-    if not wb:
-        await callback.message.edit_text(
-            "❌ <b>Не удалось сгенерировать отчет</b>\n\n"
-            "Возможные причины:\n"
-            "1. Нет данных за выбранный период\n"
-            "2. Проблемы с подключением к базе данных\n"
-            "3. Файл шаблона pnl_template.xlsx не найден"
-        )
-        return
-    
-    # Сохраняем в буфер
-    file_stream = io.BytesIO()
-    wb.save(file_stream)
-    file_stream.seek(0)
-    
-    # Формируем имя файла
-    safe_shop_name = "".join(c for c in shop_name if c.isalnum() or c in (' ', '-', '_')).rstrip()
-    filename = f"pnl_{safe_shop_name}_{datetime.now().strftime('%Y%m%d%H%M')}.xlsx"
-    
-    # Отправляем файл
-    file = InputFile(file_stream, filename=filename)
-    await callback.message.answer_document(
-        file,
-        caption=f"📊 PNL отчет за {period_name}\nМагазин: {shop_name}"
+    # Свежие данные WB ждём не дольше дедлайна, иначе считаем по локальным
+    report_data, stale_at, pending = await fetch_report_with_deadline(
+        shop_api_token, shop_id, start_date, end_date
     )
+    if pending is not None and not len(report_data):
+        report_data = await wait_fresh_report(pending) or report_data
+        pending = None
+        stale_at = None
+
+    # Генерируем Excel отчет в фоновой задаче; повторное нажатие присоединяется к ней
+    caption = f"📊 PNL отчет за {period_name}\nМагазин: {shop_name}"
+    note = freshness_note(stale_at, refreshing=pending is not None) if pending is not None or stale_at else ""
+    key = job_key(callback.from_user.id, shop_id, "pnl_excel", start_date.date(), end_date.date())
+    params = {
+        "shop_id": shop_id,
+        "api_token": shop_api_token,
+        "shop_name": shop_name,
+        "period_name": period_name,
+        "start_date": start_date.isoformat(),
+        "end_date": end_date.isoformat(),
+    }
+    document = await report_jobs.run(
+        key, "pnl_excel", params, callback.message.chat.id, callback.message,
+        context={"report_data": report_data, "note": note},
+    )
+    if document is None or not document.document:
+        # Ошибка уже показана, либо отчёт доставлен задачей, к которой мы присоединились
+        return
+
+    if pending is not None:
+        async def refresh_when_ready():
+            # WB ответил после дедлайна — заменяем файл пересчитанным
+            try:
+                fresh_report = await wait_fresh_report(pending)
+                if fresh_report is None:
+                    return
+                fresh_document = await generate_pnl_excel_report(
+                    shop_id, shop_api_token, start_date, end_date, shop_name, fresh_report
+                )
+                if fresh_document:
+                    await document.edit_media(
+                        types.InputMediaDocument(pnl_workbook_file(fresh_document, shop_name), caption=caption)
+                    )
+            except Exception as e:
+                logger.error(f"Ошибка обновления PNL отчета свежими данными: {e}")
+
+        asyncio.create_task(refresh_when_ready())
     
     # Возвращаемся к меню PNL
     keyboard = InlineKeyboardMarkup()
@@ -745,10 +715,8 @@ async def pnl_excel_callback(callback: types.CallbackQuery, state: FSMContext):
         )
         return
     
-    # Сохраняем в буфер
-    file_stream = io.BytesIO()
-    wb.save(file_stream)
-    file_stream.seek(0)
+    # Книга уже сериализована в пуле процессов
+    file_stream = io.BytesIO(wb)
     
     # Формируем имя файла
     safe_shop_name = "".join(c for c in shop_name if c.isalnum() or c in (' ', '-', '_')).rstrip()
@@ -1,16 +1,20 @@
 import logging
-import io
-import openpyxl
+import asyncio
 from aiogram import types
 from aiogram.dispatcher import FSMContext
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InputFile
-from tg_bot.models import Shop, sessionmaker, engine, User, Order
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from tg_bot.models import Shop, sessionmaker, engine, User
 from tg_bot.models import (
     TaxSystemSetting, TaxSystemType,
     ProductCost,
     RegularExpense, RegularExpenseFrequency,
     OneTimeExpense
 )
+from tg_bot.services.workbooks import build_workbook, cost_workbook
+from tg_bot.services.cost_import import import_cost_file, COST_FILE_EXTENSIONS
+from tg_bot.services.articles import articles_version, shop_articles
+from tg_bot.services.artifacts import answer_cached_document
+from tg_bot.services.data_versions import get_data_version
 from tg_bot.states.settings_states import SettingsStates
 from tg_bot.keyboards.settings_menu import (
     tax_system_keyboard,
@@ -243,30 +247,31 @@ async def product_cost_callback(callback: types.CallbackQuery):
         reply_markup=keyboard
     )
 
-async def download_cost_template_callback(callback: types.CallbackQuery):
-    # Создаем шаблон Excel
+async def download_cost_template_callback(callback: types.CallbackQuery, state: FSMContext):
     session = sessionmaker(bind=engine)()
-    shop = session.query(Shop).filter(Shop.user_id==session.query(User).filter(User.telegram_id==callback.from_user.id).first().id).first()
-    articles = [str(item[0]) for item in session.query(Order.supplierArticle).filter(Order.shop_id==shop.id).distinct().all()]
-
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "Себестоимость"
-    ws.append(["Артикул", "Себестоимость"])
-
-    # Заполняем артикулы
-    for i, article in enumerate(articles, 2):
-        ws[f'A{i}'] = article
-
-    # Сохраняем временный файл
-    temp_file = io.BytesIO()
-    wb.save(temp_file)
-    temp_file.seek(0)
+    try:
+        async with state.proxy() as data:
+            shop_id = data['shop']['id'] if 'shop' in data else None
+        if shop_id is None:
+            shop_id = (
+                session.query(Shop.id)
+                .join(User, Shop.user_id == User.id)
+                .filter(User.telegram_id == callback.from_user.id)
+                .scalar()
+            )
+        if shop_id is None:
+            await callback.answer("❌ Сначала выберите магазин", show_alert=True)
+            return
 
-    # Отправляем файл
-    file = InputFile(temp_file, filename="шаблон_себестоимость.xlsx")
-    await callback.message.answer_document(file, caption="📝 Шаблон для заполнения себестоимости")
-    await callback.answer()
+        # Шаблон строится из справочника артикулов и кэшируется до появления новых артикулов
+        await answer_cached_document(
+            callback.message, shop_id, "cost_template", articles_version(session, shop_id),
+            lambda: build_workbook(cost_workbook, [(article,) for article in shop_articles(session, shop_id)]),
+            "шаблон_себестоимость.xlsx", "📝 Шаблон для заполнения себестоимости"
+        )
+    finally:
+        session.close()
+        await callback.answer()
 
 async def download_cost_excel_callback(callback: types.CallbackQuery, state: FSMContext):
     session = sessionmaker()(bind=engine)
@@ -274,29 +279,20 @@ async def download_cost_excel_callback(callback: types.CallbackQuery, state: FSM
         async with state.proxy() as data:
             shop_id = data['shop']['id']
         
-        costs = session.query(ProductCost).filter(ProductCost.shop_id == shop_id).all()
-        
-        if not costs:
+        if not session.query(ProductCost.id).filter(ProductCost.shop_id == shop_id).first():
             await callback.answer("❌ Нет данных для выгрузки", show_alert=True)
             return
         
-        # Создаем Excel файл
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.title = "Себестоимость"
-        ws.append(["Артикул", "Себестоимость"])
-        
-        for cost in costs:
-            ws.append([cost.article, cost.cost])
-        
-        # Сохраняем в BytesIO
-        file_stream = io.BytesIO()
-        wb.save(file_stream)
-        file_stream.seek(0)
-        
-        # Отправляем файл
-        file = InputFile(file_stream, filename="себестоимость_артикулов.xlsx")
-        await callback.message.answer_document(file, caption="📊 Текущие данные по себестоимости")
+        # Выгрузка кэшируется до следующего импорта себестоимости
+        await answer_cached_document(
+            callback.message, shop_id, "cost_export", get_data_version(session, shop_id, "cost")[0],
+            lambda: build_workbook(cost_workbook, [
+                (article, cost) for article, cost in session.query(ProductCost.article, ProductCost.cost)
+                .filter(ProductCost.shop_id == shop_id)
+                .order_by(ProductCost.article)
+            ]),
+            "себестоимость_артикулов.xlsx", "📊 Текущие данные по себестоимости"
+        )
     except Exception as e:
         logger.error(f"Ошибка выгрузки себестоимости: {e}")
         await callback.answer("❌ Произошла ошибка при выгрузке данных")
@@ -307,7 +303,7 @@ async def download_cost_excel_callback(callback: types.CallbackQuery, state: FSM
 async def upload_cost_excel_callback(callback: types.CallbackQuery):
     await callback.message.answer(
         "️ <b>Загрузка данных себестоимости</b>\n\n"
-        "Пожалуйста, отправьте Excel-файл в формате:\n"
+        "Пожалуйста, отправьте Excel-файл (.xlsx) или CSV/TSV в формате:\n"
         "Колонка A: Артикул\n"
         "Колонка B: Себестоимость\n\n"
         "<i>Вы можете скачать шаблон для заполнения</i>"
@@ -319,11 +315,14 @@ async def process_cost_file(message: types.Message, state: FSMContext):
         await message.answer("❌ Пожалуйста, отправьте файл в формате Excel")
         return
     
-    if not message.document.file_name.endswith(('.xlsx', '.xls')):
-        await message.answer("❌ Неверный формат файла. Отправьте файл Excel (.xlsx или .xls)")
+    file_name = message.document.file_name or ""
+    if file_name.lower().endswith(".xls"):
+        await message.answer("❌ Формат .xls не поддерживается. Сохраните файл как .xlsx или .csv")
+        return
+    if not file_name.lower().endswith(COST_FILE_EXTENSIONS):
+        await message.answer("❌ Неверный формат файла. Отправьте файл Excel (.xlsx), CSV или TSV")
         return
     
-    session = sessionmaker()(bind=engine)
     try:
         async with state.proxy() as data:
             shop_id = data['shop']['id']
@@ -334,45 +333,27 @@ async def process_cost_file(message: types.Message, state: FSMContext):
         file_path = file.file_path
         downloaded_file = await message.bot.download_file(file_path)
         
-        # Парсим Excel
-        wb = openpyxl.load_workbook(io.BytesIO(downloaded_file.read()))
-        ws = wb.active
-        
-        # Собираем данные
-        cost_data = {}
-        for row in ws.iter_rows(min_row=2, values_only=True):  # Пропускаем заголовок
-            if row[0] and row[1]:
-                article = row[0]
-                try:
-                    cost = row[1]
-                    cost_data[article] = cost
-                except (ValueError, TypeError):
-                    continue
-        
-        if not cost_data:
+        # Разбор и запись пачками — в пуле потоков, чтобы не блокировать бота
+        loop = asyncio.get_running_loop()
+        imported, error_count, errors = await loop.run_in_executor(
+            None, import_cost_file, shop_id, file_name, downloaded_file.read()
+        )
+        
+        if not imported and not error_count:
             await message.answer("❌ В файле не найдены корректные данные")
             return
         
-        # Обновляем базу данных
-        existing_costs = {cost.article: cost for cost in session.query(ProductCost)
-            .filter(ProductCost.shop_id == shop_id)
-            .filter(ProductCost.article.in_(cost_data.keys()))
-            .all()}
-        
-        for article, cost_value in cost_data.items():
-            if article in existing_costs:
-                existing_costs[str(article)].cost = cost_value
-            else:
-                new_cost = ProductCost(shop_id=shop_id, article=article, cost=cost_value)
-                session.add(new_cost)
-        
-        session.commit()
-        await message.answer(f"✅ Успешно обработано: {len(cost_data)} записей")
+        text = f"✅ Успешно обработано: {imported} записей"
+        if error_count:
+            text += f"\n\n⚠️ Пропущено строк с ошибками: {error_count}\n"
+            text += "\n".join(f"Строка {row}: {error}" for row, error in errors)
+            if error_count > len(errors):
+                text += "\n..."
+        await message.answer(text)
     except Exception as e:
         logger.error(f"Ошибка обработки файла: {e}")
         await message.answer("❌ Произошла ошибка при обработке файла. Проверьте формат.")
     finally:
-        session.close()
         await SettingsStates.product_cost.set()
         await product_cost_callback_helper(message)
 
@@ -12,6 +12,7 @@ from tg_bot.handlers.start import start_command
 from threading import Thread as th
 import requests
 from loader2 import get_all_penalties, sync_wb_advertisements
+from tg_bot.services.backfill import start_backfill
 logger = logging.getLogger(__name__)
 
 async def add_shop_callback(callback: types.CallbackQuery, state: FSMContext):
@@ -131,6 +132,9 @@ async def process_api_token(message: types.Message, state: FSMContext):
             await message.answer(f"✅ Магазин <b>{seller_name}</b> добавлен! <u>‼️ Важно: необходимо подождать около 2-3х минут, чтобы я получил все данные по Вашему магазину и все функции бота работали корректно.</u>")
         else:
             await message.answer(f"✅ Магазин <b>{seller_name}</b> успешно добавлен! <u>‼️ Важно: необходимо подождать около 2-3х минут, чтобы я получил все данные по Вашему магазину и все функции бота работали корректно.</u>")
+        # История отчётов грузится в фоне, свежие периоды — первыми
+        progress = await message.answer("⏳ Загружаю историю продаж...")
+        start_backfill(shop.id, progress)
         await start_command(message, state)
     except Exception as e:
         logger.error(f"Ошибка при добавлении магазина: {e}")
@@ -4,8 +4,12 @@ def analytics_menu_keyboard():
     keyboard = InlineKeyboardMarkup(row_width=1)
     keyboard.add(
         InlineKeyboardButton("📊 Оценка доходности", callback_data="profitability_estimation"),
-        InlineKeyboardButton("🏆 Топ-5 товаров", callback_data="top5_products"),
+        InlineKeyboardButton("🏆 Рейтинг товаров", callback_data="top5_products"),
         InlineKeyboardButton("🔮 Симулятор «А что если?»", callback_data="what_if_simulator"),
+        InlineKeyboardButton("📈 Прогноз выручки и прибыли", callback_data="forecast"),
+        InlineKeyboardButton("⚠️ Необычные расходы", callback_data="anomalies"),
+        InlineKeyboardButton("🔤 ABC/XYZ анализ", callback_data="abc_xyz"),
+        InlineKeyboardButton("🗺 Заказы по регионам и складам", callback_data="order_geo"),
         InlineKeyboardButton("📋 Отчет по товарам .xl", callback_data="product_analytics"),
         InlineKeyboardButton("🔙 Назад", callback_data="main_menu")
     )
@@ -2,6 +2,7 @@ from sqlalchemy.orm import sessionmaker
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import String, Integer, ForeignKey, Boolean, Column, Integer, DateTime, BigInteger, Float, Enum, Text, JSON
+from sqlalchemy import LargeBinary, UniqueConstraint, Date, Index
 from sqlalchemy.orm import relationship
 from sqlalchemy import func
 import enum
@@ -65,6 +66,289 @@ class CashedShopData(Base):
     cashed_week = Column(JSON)
 
 
+class DataVersion(Base):
+    """Версия данных магазина: увеличивается при каждой записи новых данных"""
+    __tablename__ = "data_versions"
+
+    id = Column(Integer, primary_key=True)
+    shop_id = Column(Integer, index=True)
+    name = Column(String(30), default="report")  # report / cost / ...
+    version = Column(Integer, default=0)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+class ReportRow(Base):
+    """Строка детального отчёта WB — только поля, которые читает аналитика.
+    Денежные поля в копейках, day — порядковый номер дня sale_dt."""
+    __tablename__ = "report_rows"
+    __table_args__ = (UniqueConstraint("shop_id", "rrd_id"),)
+
+    id = Column(Integer, primary_key=True)
+    shop_id = Column(Integer, nullable=False)
+    rrd_id = Column(BigInteger, nullable=False)
+    day = Column(Integer, index=True)
+    nm_id = Column(BigInteger)
+    quantity = Column(Integer, default=0)
+    retail_price_withdisc_rub = Column(BigInteger, default=0)
+    ppvz_for_pay = Column(BigInteger, default=0)
+    ppvz_reward = Column(BigInteger, default=0)
+    ppvz_sales_commission = Column(BigInteger, default=0)
+    ppvz_vw = Column(BigInteger, default=0)
+    ppvz_vw_nds = Column(BigInteger, default=0)
+    delivery_rub = Column(BigInteger, default=0)
+    rebill_logistic_cost = Column(BigInteger, default=0)
+    storage_fee = Column(BigInteger, default=0)
+    deduction = Column(BigInteger, default=0)
+    sa_name = Column(String(75), default="")
+    subject_name = Column(String(100), default="")
+    doc_type_name = Column(String(50), default="")
+    bonus_type_name = Column(String(200), default="")
+    srid = Column(String(100), default="")
+
+
+class ReportDaily(Base):
+    """Дневные агрегаты отчёта магазина (деньги в копейках), пересчитываются при загрузке"""
+    __tablename__ = "report_daily"
+    __table_args__ = (UniqueConstraint("shop_id", "day"),)
+
+    id = Column(Integer, primary_key=True)
+    shop_id = Column(Integer, nullable=False)
+    day = Column(Integer, nullable=False)
+    rows = Column(Integer, default=0)
+    quantity = Column(Integer, default=0)
+    sales_quantity = Column(Integer, default=0)
+    returns_quantity = Column(Integer, default=0)
+    retail_amount = Column(BigInteger, default=0)
+    for_pay = Column(BigInteger, default=0)
+    delivery = Column(BigInteger, default=0)
+    storage = Column(BigInteger, default=0)
+    deduction = Column(BigInteger, default=0)
+
+
+class ReportArchive(Base):
+    """Исходные строки отчёта WB, сжатые zlib (включается REPORT_ARCHIVE_RAW=1)"""
+    __tablename__ = "report_archives"
+
+    id = Column(Integer, primary_key=True)
+    shop_id = Column(Integer, index=True)
+    rrd_from = Column(BigInteger)
+    rrd_to = Column(BigInteger)
+    payload = Column(LargeBinary)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class IngestCheckpoint(Base):
+    """Позиция постраничной загрузки: (магазин, метод API, диапазон дат) -> последний rrd_id.
+    date_to = NULL — открытый диапазон до текущего дня."""
+    __tablename__ = "ingest_checkpoints"
+
+    id = Column(Integer, primary_key=True)
+    shop_id = Column(Integer, index=True)
+    endpoint = Column(String(50))
+    date_from = Column(Date)
+    date_to = Column(Date, nullable=True)
+    last_rrd_id = Column(BigInteger, default=0)
+    pages = Column(Integer, default=0)
+    rows = Column(Integer, default=0)
+    completed = Column(Boolean, default=False)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+class ApiRateBudget(Base):
+    """Бюджет запросов токена WB, общий для всех процессов: время следующего свободного запроса.
+    key — sha256 токена, сам токен здесь не хранится."""
+    __tablename__ = "api_rate_budgets"
+
+    id = Column(Integer, primary_key=True)
+    key = Column(String(64), unique=True)
+    next_at = Column(Float, default=0)
+
+
+class ReportJob(Base):
+    """Фоновая задача генерации отчёта (для повторного запуска после рестарта бота)"""
+    __tablename__ = "report_jobs"
+
+    id = Column(Integer, primary_key=True)
+    key = Column(String(200), index=True)
+    kind = Column(String(50))
+    chat_id = Column(BigInteger)
+    params = Column(JSON)
+    status = Column(String(20), default="queued")  # queued/running/done/failed
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+class ReportArtifact(Base):
+    """Готовый файл отчёта: xlsx на диске и file_id Telegram после первой отправки"""
+    __tablename__ = "report_artifacts"
+    __table_args__ = (UniqueConstraint("shop_id", "kind", "period", "version"),)
+
+    id = Column(Integer, primary_key=True)
+    shop_id = Column(Integer, index=True)
+    kind = Column(String(50))
+    period = Column(String(50))
+    version = Column(String(40))
+    path = Column(String(255), nullable=True)
+    size = Column(Integer, default=0)
+    file_id = Column(String(255), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, default=datetime.utcnow)
+
+
+class Article(Base):
+    """Справочник артикулов магазина (для шаблона себестоимости)"""
+    __tablename__ = "articles"
+    __table_args__ = (UniqueConstraint("shop_id", "article"),)
+
+    id = Column(Integer, primary_key=True)
+    shop_id = Column(Integer, index=True)
+    article = Column(String(75))
+    nm_id = Column(BigInteger, nullable=True)
+    subject = Column(String(50), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class ArticleProfitability(Base):
+    """Доходность артикула за окно (30 дней / текущий месяц), пересчитывается после загрузки"""
+    __tablename__ = "article_profitability"
+    __table_args__ = (
+        UniqueConstraint("shop_id", "period", "nm_id"),
+        Index("ix_article_profitability_level", "shop_id", "period", "level"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    shop_id = Column(Integer)
+    period = Column(String(10))  # 30d / month
+    nm_id = Column(BigInteger)
+    article = Column(String(75), nullable=True)
+    quantity = Column(Integer, default=0)
+    sales = Column(Integer, default=0)
+    returns = Column(Integer, default=0)
+    revenue = Column(Float, default=0)
+    cost = Column(Float, default=0)
+    cost_per_item = Column(Float, default=0)
+    advert = Column(Float, default=0)
+    commission = Column(Float, default=0)
+    logistics = Column(Float, default=0)
+    storage = Column(Float, default=0)
+    net_profit = Column(Float, default=0)
+    profitability = Column(Float, default=0)
+    level = Column(Integer, default=0)  # индекс в PROFITABILITY_LEVELS
+    # Версии данных и день, на которые посчитана таблица
+    report_version = Column(Integer, default=0)
+    cost_version = Column(Integer, default=0)
+    computed_on = Column(Date)
+
+
+class ArticleElasticity(Base):
+    """Эластичность спроса по цене для nm_id: накопленные суммы регрессии ln(шт) ~ ln(цена) по дням заказов"""
+    __tablename__ = "article_elasticity"
+    __table_args__ = (UniqueConstraint("shop_id", "nm_id"),)
+
+    id = Column(Integer, primary_key=True)
+    shop_id = Column(Integer)
+    nm_id = Column(BigInteger)
+    days = Column(Integer, default=0)
+    sum_x = Column(Float, default=0)
+    sum_y = Column(Float, default=0)
+    sum_xx = Column(Float, default=0)
+    sum_xy = Column(Float, default=0)
+    sum_yy = Column(Float, default=0)
+    elasticity = Column(Float, default=0)
+    std_error = Column(Float, nullable=True)
+    r2 = Column(Float, nullable=True)
+    last_day = Column(Date)  # последний учтённый день заказов
+    updated_at = Column(DateTime, default=datetime.utcnow)
+
+
+class MetricStat(Base):
+    """Скользящая статистика (EWMA среднего и дисперсии) дневной метрики магазина (nm_id = 0) или товара"""
+    __tablename__ = "metric_stats"
+    __table_args__ = (UniqueConstraint("shop_id", "nm_id", "metric"),)
+
+    id = Column(Integer, primary_key=True)
+    shop_id = Column(Integer)
+    nm_id = Column(BigInteger)
+    metric = Column(String(20))
+    count = Column(Integer, default=0)
+    mean = Column(Float, default=0)
+    var = Column(Float, default=0)
+    streak = Column(Integer, default=0)  # выбросы подряд: > 0 — вверх, < 0 — вниз
+    last_day = Column(Integer)  # последний учтённый день (порядковый номер, как report_daily.day)
+
+
+class MetricAnomaly(Base):
+    """Выброс дневной метрики: значение против ожидаемого по скользящей статистике"""
+    __tablename__ = "metric_anomalies"
+    __table_args__ = (
+        UniqueConstraint("shop_id", "nm_id", "metric", "day"),
+        Index("ix_metric_anomalies_notified", "notified", "shop_id"),
+    )
+
+    id = Column(Integer, primary_key=True)
+    shop_id = Column(Integer)
+    nm_id = Column(BigInteger)  # 0 — магазин целиком
+    article = Column(String(75), nullable=True)
+    metric = Column(String(20))
+    day = Column(Integer)
+    value = Column(Float)
+    expected = Column(Float)
+    z_score = Column(Float)
+    notified = Column(Boolean, default=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class DimensionValue(Base):
+    """Словарь значений измерений куба заказов: (измерение, строка) -> код (id)"""
+    __tablename__ = "dimension_values"
+    __table_args__ = (UniqueConstraint("dimension", "value"),)
+
+    id = Column(Integer, primary_key=True)
+    dimension = Column(String(20))
+    value = Column(String(200))
+
+
+class OrderCubeCell(Base):
+    """Агрегаты заказов: день x nm_id x склад x регион. Измерения — коды dimension_values
+    (0 — не указано); округ, тип склада, категория, предмет и бренд — атрибуты ячейки."""
+    __tablename__ = "order_cube"
+    __table_args__ = (UniqueConstraint("shop_id", "day", "nm_id", "warehouse", "region"),)
+
+    id = Column(Integer, primary_key=True)
+    shop_id = Column(Integer)
+    day = Column(Integer)  # порядковый номер дня заказа
+    nm_id = Column(BigInteger)
+    warehouse = Column(Integer, default=0)
+    region = Column(Integer, default=0)
+    okrug = Column(Integer, default=0)
+    warehouse_type = Column(Integer, default=0)
+    category = Column(Integer, default=0)
+    subject = Column(Integer, default=0)
+    brand = Column(Integer, default=0)
+    orders = Column(Integer, default=0)
+    cancellations = Column(Integer, default=0)
+    buyouts = Column(Integer, default=0)
+    revenue = Column(Float, default=0)  # сумма заказов (цена со скидкой продавца)
+    buyout_revenue = Column(Float, default=0)
+
+
+class FunnelCell(Base):
+    """Воронка заказов nm_id по дню заказа: заказано -> отменено / выкуплено -> возвращено.
+    Статус srid — из orders и строк отчёта с тем же srid."""
+    __tablename__ = "order_funnel"
+    __table_args__ = (UniqueConstraint("shop_id", "day", "nm_id"),)
+
+    id = Column(Integer, primary_key=True)
+    shop_id = Column(Integer)
+    day = Column(Integer)  # порядковый номер дня заказа
+    nm_id = Column(BigInteger)
+    ordered = Column(Integer, default=0)
+    cancelled = Column(Integer, default=0)
+    bought = Column(Integer, default=0)
+    returned = Column(Integer, default=0)
+
+
 class Penalty(Base):
     __tablename__ = "penalties"
 
@@ -186,4 +470,11 @@ class OneTimeExpense(Base):
     
     shop = relationship("Shop", back_populates="one_time_expenses")
 
-Base.metadata.create_all(bind=engine)
\ No newline at end of file
+Base.metadata.create_all(bind=engine)
+
+# Индекс под импорт себестоимости; create_all не добавляет индексы в уже существующие таблицы
+Index("ix_product_costs_shop_article", ProductCost.shop_id, ProductCost.article).create(bind=engine, checkfirst=True)
+# Пересчёт куба заказов за затронутые дни
+Index("ix_orders_shop_date", Order.shop_id, Order.date).create(bind=engine, checkfirst=True)
+# Поиск строк отчёта по srid для воронки заказов
+Index("ix_report_rows_shop_srid", ReportRow.shop_id, ReportRow.srid).create(bind=engine, checkfirst=True)
@@ -4,5 +4,17 @@ from .DBSM import (
     ProductCost,
     RegularExpense, RegularExpenseFrequency,
     OneTimeExpense,
-    Payment
+    Payment,
+    DataVersion,
+    ReportRow, ReportDaily, ReportArchive,
+    IngestCheckpoint,
+    ApiRateBudget,
+    ReportJob,
+    ReportArtifact,
+    Article,
+    ArticleProfitability,
+    ArticleElasticity,
+    MetricStat, MetricAnomaly,
+    DimensionValue, OrderCubeCell,
+    FunnelCell
 )
@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from tg_bot.models import sessionmaker, engine
+from tg_bot.services.data_versions import get_data_version
+from tg_bot.services.shop_dataset import shop_datasets, day_ordinal
+from tg_bot.services.profitability import shop_costs
+from tg_bot.services.forecast import report_amounts
+
+logger = logging.getLogger(__name__)
+
+# ABC: A — товары, дающие первые 80% суммы, B — следующие 15%, C — остальные и убыточные
+ABC_SHARES = (0.8, 0.95)
+# XYZ: коэффициент вариации недельных продаж (X — до 10%, Y — до 25%, Z — выше или нет продаж)
+XYZ_CV = (0.1, 0.25)
+# Окно классификации в боте — последние полные недели
+ABC_XYZ_WEEKS = 13
+# Сколько классификаций (магазин, период) держать в памяти
+ABC_XYZ_CACHE_SIZE = 64
+
+ABC = "ABC"
+XYZ = "XYZ"
+
+
+def abc_classes(values):
+    """Класс ABC (0, 1, 2) по вкладу в сумму: сортировка и накопленная доля одним проходом"""
+    classes = np.full(len(values), 2, dtype=np.int8)
+    positive = np.maximum(values, 0)
+    total = positive.sum()
+    if total <= 0:
+        return classes
+    order = np.argsort(-positive, kind="stable")
+    ordered = positive[order]
+    # Доля до товара: товар, который пересекает 80%, ещё входит в A
+    before = (np.cumsum(ordered) - ordered) / total
+    classes[order] = np.searchsorted(ABC_SHARES, before, side="right")
+    classes[positive <= 0] = 2
+    return classes
+
+
+def variation(weekly, started):
+    """Коэффициент вариации недельных продаж с первой недели продаж товара (inf — продаж нет)"""
+    weeks = started.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = (weekly * started).sum(axis=1) / weeks
+        var = (((weekly - mean[:, None]) ** 2) * started).sum(axis=1) / weeks
+        cv = np.sqrt(var) / mean
+    return np.where((weeks >= 2) & (mean > 0), cv, np.inf)
+
+
+class CatalogClassification:
+    """ABC по выручке и прибыли и XYZ по недельным продажам для всех nm_id за период"""
+
+    def __init__(self, frame, costs, start_date, end_date):
+        first_day, last_day = day_ordinal(start_date), day_ordinal(end_date)
+        window = frame.take((frame.day >= first_day) & (frame.day <= last_day))
+        amounts = report_amounts(window, costs)
+        inverse = amounts["inverse"]
+        series = len(amounts["nm_ids"])
+
+        # Полные недели считаются от конца периода; неполная неделя в начале в XYZ не входит
+        self.weeks = max((last_day - first_day + 1) // 7, 1)
+        week = self.weeks - 1 - (last_day - window.day) // 7
+        full = week >= 0
+        weekly = np.bincount(
+            inverse[full] * self.weeks + week[full],
+            weights=amounts["quantity"][full],
+            minlength=series * self.weeks,
+        ).reshape(series, self.weeks)
+
+        def total(values):
+            return np.bincount(inverse, weights=values, minlength=series)
+
+        # Строки без товара (хранение, удержания магазина) в классификацию не входят
+        item = amounts["nm_ids"] != 0
+        self.nm_ids = amounts["nm_ids"][item]
+        self.articles = amounts["articles"][item]
+        self.revenue = total(amounts["revenue"])[item]
+        self.profit = total(amounts["profit"])[item]
+        self.quantity = total(amounts["quantity"])[item]
+        weekly = weekly[item]
+        self.cv = variation(weekly, np.maximum.accumulate(weekly != 0, axis=1))
+
+        self.abc_revenue = abc_classes(self.revenue)
+        self.abc_profit = abc_classes(self.profit)
+        self.xyz = np.searchsorted(XYZ_CV, self.cv, side="left").astype(np.int8)
+        self._by_article = {article: i for i, article in enumerate(self.articles) if article}
+
+    def __len__(self):
+        return len(self.nm_ids)
+
+    def index(self, nm_id=None, article=None):
+        """Позиция товара по nm_id, иначе по артикулу продавца (None — нет в периоде)"""
+        if nm_id:
+            position = int(np.searchsorted(self.nm_ids, nm_id))
+            if position < len(self.nm_ids) and self.nm_ids[position] == nm_id:
+                return position
+        return self._by_article.get(article)
+
+    def labels(self, nm_id=None, article=None):
+        """(ABC по выручке, ABC по прибыли, XYZ, коэффициент вариации) или None"""
+        i = self.index(nm_id, article)
+        if i is None:
+            return None
+        cv = float(self.cv[i])
+        return (
+            ABC[self.abc_revenue[i]],
+            ABC[self.abc_profit[i]],
+            XYZ[self.xyz[i]],
+            cv if np.isfinite(cv) else None,
+        )
+
+    def matrix(self):
+        """Число товаров и выручка по группам: массивы (3 x 3), строки — ABC по выручке, столбцы — XYZ"""
+        cells = self.abc_revenue.astype(np.int64) * 3 + self.xyz
+        counts = np.bincount(cells, minlength=9).reshape(3, 3)
+        revenue = np.bincount(cells, weights=self.revenue, minlength=9).reshape(3, 3)
+        return counts, revenue
+
+    def group(self, abc, xyz, limit=5):
+        """Товары группы по убыванию выручки"""
+        members = np.flatnonzero((self.abc_revenue == ABC.index(abc)) & (self.xyz == XYZ.index(xyz)))
+        members = members[np.argsort(-self.revenue[members], kind="stable")][:limit]
+        return [(self.articles[i] or str(self.nm_ids[i]), float(self.revenue[i])) for i in members]
+
+
+def default_window(now=None):
+    """Последние ABC_XYZ_WEEKS полных недель до вчерашнего дня"""
+    end = (now or datetime.utcnow()) - timedelta(days=1)
+    return end - timedelta(days=ABC_XYZ_WEEKS * 7 - 1), end
+
+
+class ClassificationStore:
+    """Классификации по (магазин, период), действительные для версии отчёта и себестоимости"""
+
+    def __init__(self, capacity=ABC_XYZ_CACHE_SIZE):
+        self.capacity = capacity
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, shop_id: int, start_date, end_date) -> CatalogClassification:
+        key = (shop_id, day_ordinal(start_date), day_ordinal(end_date))
+        session = sessionmaker(bind=engine)()
+        try:
+            versions = (
+                get_data_version(session, shop_id)[0],
+                get_data_version(session, shop_id, "cost")[0],
+            )
+            with self._lock:
+                cached = self._entries.get(key)
+                if cached is not None and cached[0] == versions:
+                    self._entries.move_to_end(key)
+                    return cached[1]
+            classification = CatalogClassification(
+                shop_datasets.get(shop_id), shop_costs(session, shop_id), start_date, end_date
+            )
+        finally:
+            session.close()
+        with self._lock:
+            self._entries[key] = (versions, classification)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+        logger.info(f"Shop {shop_id}: ABC/XYZ v{versions[0]} ({len(classification)} articles)")
+        return classification
+
+
+classification_store = ClassificationStore()
+
+
+def classify_catalog(shop_id: int, start_date=None, end_date=None) -> CatalogClassification:
+    if start_date is None or end_date is None:
+        start_date, end_date = default_window()
+    return classification_store.get(shop_id, start_date, end_date)
+
+
+async def get_catalog_classification(shop_id: int, start_date=None, end_date=None) -> CatalogClassification:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, classify_catalog, shop_id, start_date, end_date)
@@ -0,0 +1,290 @@
+import os
+import asyncio
+import logging
+from datetime import date
+
+import numpy as np
+from sqlalchemy import func
+
+from tg_bot.models import sessionmaker, engine, Shop, User, MetricStat, MetricAnomaly
+from tg_bot.services.shop_dataset import shop_datasets
+
+logger = logging.getLogger(__name__)
+
+# Отслеживаемые дневные метрики: название и единица
+ANOMALY_METRICS = {
+    "logistics": ("Логистика", "руб."),
+    "storage": ("Хранение", "руб."),
+    "deduction": ("Удержания и штрафы", "руб."),
+    "commission": ("Комиссия WB", "%"),
+}
+# Вес нового дня в EWMA (память ~ 2 недели) и сколько дней ряд копит статистику до проверок
+ANOMALY_ALPHA = 0.1
+ANOMALY_WARMUP_DAYS = 14
+# Порог |z| и минимальное отклонение от ожидаемого (абсолютное и доля), чтобы не поднимать шум
+ANOMALY_Z = float(os.getenv("ANOMALY_Z", 4))
+ANOMALY_MIN_DELTA = {
+    "logistics": (300.0, 0.25),
+    "storage": (300.0, 0.25),
+    "deduction": (300.0, 0.25),
+    "commission": (3.0, 0.0),
+}
+# Выброс входит в статистику обрезанным до mean ± ANOMALY_CLIP·σ (устойчивость к всплескам);
+# столько выбросов подряд в одну сторону — новый уровень, статистика переходит на него
+ANOMALY_CLIP = 3.0
+ANOMALY_SHIFT_DAYS = 3
+# При первом запуске статистика прогревается на последних днях отчёта; старые выбросы не рассылаются
+ANOMALY_HISTORY_DAYS = 120
+ANOMALY_NOTIFY_DAYS = 7
+ANOMALY_PUSH_LIMIT = 10
+
+_STATE = ("count", "mean", "var", "streak")
+
+
+def daily_metrics(frame, keys, first_day, days):
+    """Дневные значения метрик: матрицы (ряды x дни) и маски дней, когда ряд наблюдается.
+
+    keys — отсортированные nm_id рядов, keys[0] = 0 — магазин целиком (все строки отчёта).
+    """
+    window = frame.take((frame.day >= first_day) & (frame.day < first_day + days))
+    day = (window.day - first_day).astype(np.int64)
+    item = window.nm_id != 0
+    cells = np.searchsorted(keys, window.nm_id[item]) * days + day[item]
+
+    def matrix(values):
+        result = np.bincount(cells, weights=values[item], minlength=len(keys) * days).reshape(len(keys), days)
+        result[0] = np.bincount(day, weights=values, minlength=days)
+        return result
+
+    is_sale = window.contains("doc_type_name", "продажа", "sale")
+    retail = matrix(window.col("retail_price_withdisc_rub") * window.col("quantity") * is_sale)
+    for_pay = matrix(window.col("ppvz_for_pay") * is_sale)
+    rows = matrix(np.ones(len(window.day))) > 0
+
+    values = {
+        "logistics": matrix(window.col("delivery_rub")),
+        "storage": matrix(window.col("storage_fee")),
+        "deduction": matrix(window.col("deduction")),
+        "commission": np.divide(
+            (retail - for_pay) * 100, retail, out=np.zeros_like(retail), where=retail > 0
+        ),
+    }
+    # Комиссия определена только в дни продаж
+    observed = {"commission": retail > 0, "amounts": rows}
+    return values, observed
+
+
+def update_series(stat, values, observed, min_delta):
+    """Проход по новым дням: O(1) на ряд и день, сразу для всех рядов.
+
+    stat — массивы count/mean/var/streak по рядам, меняются на месте.
+    Возвращает выбросы (ряд, день, значение, ожидаемое, z).
+    """
+    count, mean, var, streak = stat["count"], stat["mean"], stat["var"], stat["streak"]
+    min_abs, min_share = min_delta
+    flagged = []
+    for j in range(values.shape[1]):
+        x, seen = values[:, j], observed[:, j]
+        std = np.sqrt(var)
+        deviation = x - mean
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z = np.where(std > 0, deviation / std, np.sign(deviation) * np.inf)
+        outlier = (
+            seen
+            & (count >= ANOMALY_WARMUP_DAYS)
+            & (np.abs(z) >= ANOMALY_Z)
+            & (np.abs(deviation) >= np.maximum(min_abs, min_share * np.abs(mean)))
+        )
+        for i in np.flatnonzero(outlier):
+            flagged.append((int(i), j, float(x[i]), float(mean[i]), float(z[i])))
+
+        # Пока ряд прогревается — обычное среднее, дальше EWMA по обрезанному значению
+        alpha = np.maximum(ANOMALY_ALPHA, 1 / (count + 1))
+        clipped = np.where(
+            count >= ANOMALY_WARMUP_DAYS,
+            np.clip(x, mean - ANOMALY_CLIP * std, mean + ANOMALY_CLIP * std),
+            x,
+        )
+        delta = clipped - mean
+        direction = np.sign(deviation) * outlier
+        streak[:] = np.where(
+            seen,
+            np.where(outlier & (np.sign(streak) == direction), streak + direction, direction),
+            streak,
+        )
+        shifted = np.abs(streak) >= ANOMALY_SHIFT_DAYS
+        mean[:] = np.where(seen, np.where(shifted, x, mean + alpha * delta), mean)
+        var[:] = np.where(seen & ~shifted, (1 - alpha) * (var + alpha * delta * delta), var)
+        streak[shifted] = 0
+        count += seen
+    return flagged
+
+
+def refresh_anomalies(session, shop_id: int, frame=None):
+    """Добавляет в статистику дни отчёта после последнего учтённого и записывает выбросы.
+
+    Ряды — магазин (nm_id = 0) и каждый nm_id по всем ANOMALY_METRICS. История не
+    пересчитывается: читается только состояние рядов и новые дни. Коммит делает
+    вызывающий код. Возвращает число новых выбросов.
+    """
+    frame = frame if frame is not None else shop_datasets.get(shop_id)
+    days_present = frame.day[frame.day > 0]
+    if not len(days_present):
+        return 0
+    last_day = int(days_present.max())
+
+    processed = (
+        session.query(func.max(MetricStat.last_day))
+        .filter(MetricStat.shop_id == shop_id)
+        .scalar()
+    )
+    if processed is not None and processed >= last_day:
+        return 0
+    stats = session.query(MetricStat).filter(MetricStat.shop_id == shop_id).all()
+    first_day = processed + 1 if processed is not None else last_day - ANOMALY_HISTORY_DAYS + 1
+    days = last_day - first_day + 1
+
+    keys = np.union1d(
+        np.array([row.nm_id for row in stats] + [0], dtype=np.int64),
+        np.unique(frame.nm_id[frame.day >= first_day]).astype(np.int64),
+    )
+    state = {
+        metric: {name: np.zeros(len(keys)) for name in _STATE}
+        for metric in ANOMALY_METRICS
+    }
+    for row in stats:
+        if row.metric in state:
+            position = np.searchsorted(keys, row.nm_id)
+            for name in _STATE:
+                state[row.metric][name][position] = getattr(row, name) or 0
+
+    values, observed = daily_metrics(frame, keys, first_day, days)
+    # Ряд товара начинается с первого дня, когда по нему были строки отчёта
+    started = np.maximum.accumulate(observed["amounts"], axis=1)
+    started[0] = True
+
+    nm_ids, first = np.unique(frame.nm_id, return_index=True)
+    names = np.asarray(frame.vocabs["sa_name"].values, dtype=object)
+    articles = dict(zip(nm_ids.tolist(), names[frame.codes["sa_name"][first]])) if len(first) else {}
+
+    notify_from = last_day - ANOMALY_NOTIFY_DAYS + 1
+    anomalies = []
+    for metric, arrays in state.items():
+        if metric in observed:
+            seen = observed[metric]
+        else:
+            seen = started | (arrays["count"] > 0)[:, None]
+        flagged = update_series(arrays, values[metric], seen, ANOMALY_MIN_DELTA[metric])
+        for i, j, value, expected, z in flagged:
+            nm_id = int(keys[i])
+            anomalies.append({
+                "shop_id": shop_id,
+                "nm_id": nm_id,
+                "article": articles.get(nm_id) if nm_id else None,
+                "metric": metric,
+                "day": first_day + j,
+                "value": value,
+                "expected": expected,
+                "z_score": z if np.isfinite(z) else None,
+                "notified": first_day + j < notify_from,
+            })
+
+    records = [
+        {
+            "shop_id": shop_id,
+            "nm_id": int(nm_id),
+            "metric": metric,
+            "count": int(arrays["count"][i]),
+            "mean": float(arrays["mean"][i]),
+            "var": float(arrays["var"][i]),
+            "streak": int(arrays["streak"][i]),
+            "last_day": last_day,
+        }
+        for metric, arrays in state.items()
+        for i, nm_id in enumerate(keys)
+        if arrays["count"][i] > 0 or i == 0
+    ]
+    session.query(MetricStat).filter(MetricStat.shop_id == shop_id).delete(synchronize_session=False)
+    session.bulk_insert_mappings(MetricStat, records)
+    session.query(MetricAnomaly).filter(
+        MetricAnomaly.shop_id == shop_id, MetricAnomaly.day >= first_day
+    ).delete(synchronize_session=False)
+    if anomalies:
+        session.bulk_insert_mappings(MetricAnomaly, anomalies)
+    logger.info(f"Shop {shop_id}: anomalies +{days} days, {len(keys)} series, {len(anomalies)} flagged")
+    return len(anomalies)
+
+
+def format_anomaly(row) -> str:
+    name, unit = ANOMALY_METRICS.get(row.metric, (row.metric, ""))
+    subject = (row.article or str(row.nm_id)) if row.nm_id else "Магазин"
+    direction = "📈" if row.value > row.expected else "📉"
+    return (
+        f"{direction} {date.fromordinal(row.day):%d.%m.%Y} {subject}: {name} "
+        f"{row.value:.2f} {unit} (обычно ~{row.expected:.2f} {unit})"
+    )
+
+
+def recent_anomalies(shop_id: int, limit: int = 20):
+    """Последние выбросы магазина, новые сверху"""
+    session = sessionmaker(bind=engine)()
+    try:
+        rows = (
+            session.query(MetricAnomaly)
+            .filter(MetricAnomaly.shop_id == shop_id)
+            .order_by(MetricAnomaly.day.desc(), MetricAnomaly.nm_id)
+            .limit(limit)
+            .all()
+        )
+        session.expunge_all()
+        return rows
+    finally:
+        session.close()
+
+
+async def get_recent_anomalies(shop_id: int, limit: int = 20):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, recent_anomalies, shop_id, limit)
+
+
+async def push_anomalies(bot):
+    """Рассылает новые выбросы владельцам магазинов с включёнными ежедневными отчётами.
+
+    Остальные выбросы помечаются отправленными — они доступны в разделе аналитики.
+    """
+    session = sessionmaker(bind=engine)()
+    try:
+        pending = (
+            session.query(MetricAnomaly, Shop, User)
+            .join(Shop, Shop.id == MetricAnomaly.shop_id)
+            .join(User, User.id == Shop.user_id)
+            .filter(MetricAnomaly.notified.is_(False))
+            .order_by(MetricAnomaly.shop_id, MetricAnomaly.day.desc())
+            .all()
+        )
+        messages = {}
+        for anomaly, shop, user in pending:
+            if user.is_active and user.daily_reports_enabled:
+                messages.setdefault((user.telegram_id, shop.name or f"Магазин {shop.id}"), []).append(anomaly)
+        # Отмечаются только выбранные строки: загрузчик может добавить новые между запросами
+        fetched = [anomaly.id for anomaly, _, _ in pending]
+        for start in range(0, len(fetched), 500):
+            session.query(MetricAnomaly).filter(MetricAnomaly.id.in_(fetched[start:start + 500])).update(
+                {MetricAnomaly.notified: True}, synchronize_session=False
+            )
+        texts = []
+        for (chat_id, shop_name), rows in messages.items():
+            text = f"⚠️ <b>Необычные расходы: {shop_name}</b>\n\n"
+            text += "\n".join(format_anomaly(row) for row in rows[:ANOMALY_PUSH_LIMIT])
+            if len(rows) > ANOMALY_PUSH_LIMIT:
+                text += f"\n\n...и ещё {len(rows) - ANOMALY_PUSH_LIMIT} в разделе «Аналитика»"
+            texts.append((chat_id, text))
+        session.commit()
+    finally:
+        session.close()
+
+    for chat_id, text in texts:
+        try:
+            await bot.send_message(chat_id, text)
+        except Exception as e:
+            logger.error(f"Failed to send anomalies to {chat_id}: {e}")
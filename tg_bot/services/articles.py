@@ -0,0 +1,76 @@
+import logging
+
+from sqlalchemy import select, func
+from sqlalchemy.dialects.sqlite import insert
+
+from tg_bot.models import Article, Order
+from tg_bot.services.data_versions import bump_data_version, get_data_version
+
+logger = logging.getLogger(__name__)
+
+# Отметка о первичном заполнении справочника из заказов; её поднимает только
+# sync_articles_from_orders (версию "articles" поднимает и register_articles)
+SEED_VERSION = "articles_seed"
+
+
+def register_articles(session, shop_id: int, rows):
+    """Добавляет новые артикулы (article, nm_id, subject) в справочник.
+
+    Версия "articles" поднимается, только если артикул действительно новый.
+    Коммит делает вызывающий код. Возвращает число добавленных.
+    """
+    values = {}
+    for article, nm_id, subject in rows:
+        if article:
+            values.setdefault(str(article), {
+                "shop_id": shop_id, "article": str(article), "nm_id": nm_id, "subject": subject
+            })
+    if not values:
+        return 0
+    result = session.execute(
+        insert(Article).values(list(values.values())).on_conflict_do_nothing(
+            index_elements=["shop_id", "article"]
+        )
+    )
+    if result.rowcount:
+        bump_data_version(session, shop_id, "articles")
+    return result.rowcount
+
+
+def sync_articles_from_orders(session, shop_id: int):
+    """Первичное заполнение справочника из заказов магазина (одним INSERT ... SELECT)"""
+    source = (
+        select(
+            Order.shop_id,
+            Order.supplierArticle,
+            func.max(Order.nmId),
+            func.max(Order.subject),
+        )
+        .where(Order.shop_id == shop_id, Order.supplierArticle.isnot(None))
+        .group_by(Order.shop_id, Order.supplierArticle)
+    )
+    result = session.execute(
+        insert(Article)
+        .from_select(["shop_id", "article", "nm_id", "subject"], source)
+        .on_conflict_do_nothing(index_elements=["shop_id", "article"])
+    )
+    if result.rowcount:
+        bump_data_version(session, shop_id, "articles")
+    bump_data_version(session, shop_id, SEED_VERSION)
+    session.commit()
+    return result.rowcount
+
+
+def articles_version(session, shop_id: int) -> int:
+    """Версия справочника; при первом обращении справочник строится из всех заказов магазина"""
+    if get_data_version(session, shop_id, SEED_VERSION)[0] == 0:
+        sync_articles_from_orders(session, shop_id)
+    return get_data_version(session, shop_id, "articles")[0]
+
+
+def shop_articles(session, shop_id: int):
+    return [
+        article for (article,) in session.query(Article.article)
+        .filter(Article.shop_id == shop_id)
+        .order_by(Article.article)
+    ]
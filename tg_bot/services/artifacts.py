@@ -0,0 +1,238 @@
+import io
+import os
+import hashlib
+import logging
+from datetime import datetime, timedelta
+
+from aiogram.types import InputFile
+from aiogram.utils.exceptions import BadRequest
+from sqlalchemy import func, case
+
+from tg_bot.models import (
+    sessionmaker, engine, ReportArtifact,
+    Order, Advertisement, Penalty, ProductCost,
+    RegularExpense, OneTimeExpense, TaxSystemSetting
+)
+from tg_bot.services.data_versions import get_data_version
+
+logger = logging.getLogger(__name__)
+
+# Каталог готовых отчётов (общий том) и его предельный размер
+ARTIFACT_DIR = os.getenv("ARTIFACT_DIR", "artifacts")
+ARTIFACT_CACHE_BYTES = int(os.getenv("ARTIFACT_CACHE_MB", 512)) * 1024 * 1024
+# Записи только с file_id (файл уже вытеснен) живут столько без обращений
+ARTIFACT_TTL = timedelta(days=30)
+
+
+def is_closed_period(end_date) -> bool:
+    """Период закончился до сегодняшнего дня — отчёт за него можно кэшировать"""
+    return end_date.date() < datetime.now().date()
+
+
+def period_key(start_date, end_date) -> str:
+    return f"{start_date:%Y-%m-%d}_{end_date:%Y-%m-%d}"
+
+
+def artifact_version(session, shop_id: int, start_date, end_date) -> str:
+    """Версия данных, от которых зависит отчёт за период.
+
+    Версия отчёта WB плюс дешёвые агрегаты по таблицам, которые пишут загрузчики
+    и настройки (заказы, реклама, штрафы, себестоимость, расходы, налог):
+    любое изменение в них даёт новый ключ кэша.
+    """
+    parts = [get_data_version(session, shop_id)[0]]
+    parts.append(
+        session.query(
+            func.count(Order.srid),
+            func.sum(Order.priceWithDisc),
+            func.sum(Order.forPay),
+            func.sum(case((Order.is_bouhght.is_(True), 1), else_=0)),
+            func.sum(case((Order.isCancel.is_(True), 1), else_=0)),
+            func.max(Order.lastChangeDate),
+        )
+        .filter(Order.shop_id == shop_id, Order.date >= start_date, Order.date <= end_date)
+        .one()
+    )
+    for model, amount in ((Advertisement, Advertisement.amount), (Penalty, Penalty.sum)):
+        parts.append(
+            session.query(func.count(model.id), func.sum(amount), func.max(model.id))
+            .filter(model.shop_id == shop_id, model.date >= start_date, model.date <= end_date)
+            .one()
+        )
+    for model, amount in (
+        (ProductCost, ProductCost.cost),
+        (RegularExpense, RegularExpense.amount),
+        (OneTimeExpense, OneTimeExpense.amount),
+    ):
+        parts.append(
+            session.query(func.count(model.id), func.sum(amount * model.id), func.max(model.id))
+            .filter(model.shop_id == shop_id)
+            .one()
+        )
+    parts.append(
+        session.query(TaxSystemSetting.tax_system, TaxSystemSetting.custom_percent)
+        .filter(TaxSystemSetting.shop_id == shop_id)
+        .first()
+    )
+    return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+
+def find_artifact(session, shop_id: int, kind: str, period: str, version: str):
+    """Готовый отчёт из кэша: (id, xlsx bytes или None, file_id) или None"""
+    artifact = (
+        session.query(ReportArtifact)
+        .filter(
+            ReportArtifact.shop_id == shop_id,
+            ReportArtifact.kind == kind,
+            ReportArtifact.period == period,
+            ReportArtifact.version == version,
+        )
+        .first()
+    )
+    if artifact is None:
+        return None
+    data = None
+    if artifact.path:
+        try:
+            with open(artifact.path, "rb") as f:
+                data = f.read()
+        except OSError:
+            artifact.path = None
+            artifact.size = 0
+    if data is None and not artifact.file_id:
+        session.delete(artifact)
+        session.commit()
+        return None
+    artifact.last_used_at = datetime.utcnow()
+    session.commit()
+    return artifact.id, data, artifact.file_id
+
+
+def store_artifact(session, shop_id: int, kind: str, period: str, version: str, data: bytes):
+    """Сохраняет xlsx на диск и в индекс; возвращает id записи"""
+    os.makedirs(ARTIFACT_DIR, exist_ok=True)
+    path = os.path.join(ARTIFACT_DIR, f"{shop_id}_{kind}_{period}_{version[:12]}.xlsx")
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+    artifact = (
+        session.query(ReportArtifact)
+        .filter(
+            ReportArtifact.shop_id == shop_id,
+            ReportArtifact.kind == kind,
+            ReportArtifact.period == period,
+            ReportArtifact.version == version,
+        )
+        .first()
+    )
+    if artifact is None:
+        artifact = ReportArtifact(shop_id=shop_id, kind=kind, period=period, version=version)
+        session.add(artifact)
+    artifact.path = path
+    artifact.size = len(data)
+    artifact.last_used_at = datetime.utcnow()
+    session.commit()
+    evict_artifacts(session)
+    return artifact.id
+
+
+def remember_file_id(artifact_id: int, file_id: str):
+    """file_id первой отправки: повторные запросы отправляются без загрузки файла"""
+    session = sessionmaker(bind=engine)()
+    try:
+        session.query(ReportArtifact).filter(ReportArtifact.id == artifact_id).update(
+            {ReportArtifact.file_id: file_id}, synchronize_session=False
+        )
+        session.commit()
+    finally:
+        session.close()
+
+
+def forget_file_id(artifact_id: int):
+    """Telegram не принял сохранённый file_id"""
+    remember_file_id(artifact_id, None)
+
+
+def evict_artifacts(session):
+    """Вытесняет давно не использованные файлы, пока кэш больше ARTIFACT_CACHE_BYTES.
+
+    Запись с file_id остаётся: отчёт по-прежнему отправляется по file_id.
+    """
+    total = session.query(func.sum(ReportArtifact.size)).scalar() or 0
+    if total > ARTIFACT_CACHE_BYTES:
+        for artifact in (
+            session.query(ReportArtifact)
+            .filter(ReportArtifact.path.isnot(None))
+            .order_by(ReportArtifact.last_used_at)
+        ):
+            if total <= ARTIFACT_CACHE_BYTES:
+                break
+            try:
+                os.remove(artifact.path)
+            except OSError as e:
+                logger.warning(f"Failed to remove artifact {artifact.path}: {e}")
+            total -= artifact.size or 0
+            artifact.path = None
+            artifact.size = 0
+            if not artifact.file_id:
+                session.delete(artifact)
+
+    session.query(ReportArtifact).filter(
+        ReportArtifact.path.is_(None),
+        ReportArtifact.last_used_at < datetime.utcnow() - ARTIFACT_TTL,
+    ).delete(synchronize_session=False)
+    session.commit()
+
+
+async def cached_report(shop_id: int, kind: str, start_date, end_date, build):
+    """Отчёт за закрытый период из кэша, иначе await build() с сохранением в кэш.
+
+    Возвращает (xlsx bytes или None, file_id или None, id записи кэша или None).
+    """
+    if not is_closed_period(end_date):
+        return await build(), None, None
+    session = sessionmaker(bind=engine)()
+    try:
+        version = artifact_version(session, shop_id, start_date, end_date)
+        period = period_key(start_date, end_date)
+        cached = find_artifact(session, shop_id, kind, period, version)
+        if cached is not None:
+            artifact_id, data, file_id = cached
+            logger.info(f"Shop {shop_id}: {kind} {period} served from artifact cache")
+            return data, file_id, artifact_id
+        data = await build()
+        if not data:
+            return data, None, None
+        return data, None, store_artifact(session, shop_id, kind, period, version, data)
+    finally:
+        session.close()
+
+
+async def answer_cached_document(message, shop_id: int, kind: str, version, build, filename: str, caption: str):
+    """Отправляет файл магазина из кэша артефактов (по file_id, если он есть).
+
+    build() — корутина, собирающая xlsx bytes при промахе кэша; version — версия
+    данных, от которых зависит файл (при её смене файл собирается заново).
+    """
+    session = sessionmaker(bind=engine)()
+    try:
+        version = str(version)
+        cached = find_artifact(session, shop_id, kind, "all", version)
+        artifact_id, data, file_id = cached if cached is not None else (None, None, None)
+        if file_id is not None:
+            try:
+                return await message.answer_document(file_id, caption=caption)
+            except BadRequest as e:
+                logger.warning(f"Cached file_id rejected, uploading again: {e}")
+                forget_file_id(artifact_id)
+        if data is None:
+            data = await build()
+            artifact_id = store_artifact(session, shop_id, kind, "all", version, data)
+        sent = await message.answer_document(InputFile(io.BytesIO(data), filename=filename), caption=caption)
+        if sent.document is not None:
+            remember_file_id(artifact_id, sent.document.file_id)
+        return sent
+    finally:
+        session.close()
@@ -0,0 +1,140 @@
+import os
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from aiogram.utils.exceptions import MessageNotModified
+
+from tg_bot.models import sessionmaker, engine, Shop
+from tg_bot.services.checkpoints import get_checkpoint
+from tg_bot.services.data_versions import bump_data_version
+from tg_bot.services.report_ingest import (
+    ingest_shop_report, backfill_checkpoints, REPORT_HISTORY_START, REPORT_ENDPOINT
+)
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_WINDOW_DAYS = 28
+# Окно без движения дольше этого считается брошенным (рестарт бота, ошибка) — его догружает загрузчик
+BACKFILL_STALE_HOURS = float(os.getenv("BACKFILL_STALE_HOURS", 6))
+
+
+def backfill_windows(start, end, days: int = BACKFILL_WINDOW_DAYS):
+    """Окна истории по days дней — от самого свежего к самому старому"""
+    windows = []
+    window_end = end
+    while window_end >= start:
+        window_start = max(start, window_end - timedelta(days=days - 1))
+        windows.append((window_start, window_end))
+        window_end = window_start - timedelta(days=1)
+    return windows
+
+
+def plan_backfill(shop_id: int):
+    """Окна истории магазина; их чекпоинты создаются сразу, чтобы незавершённые были видны загрузчику"""
+    windows = backfill_windows(REPORT_HISTORY_START.date(), datetime.now().date())
+    session = sessionmaker(bind=engine)()
+    try:
+        for window in windows:
+            get_checkpoint(session, shop_id, REPORT_ENDPOINT, *window)
+        session.commit()
+    finally:
+        session.close()
+    return windows
+
+
+def _ingest_window(shop_id: int, window):
+    """Загрузка одного окна в своей сессии (чекпоинт окна делает её идемпотентной)"""
+    session = sessionmaker(bind=engine)()
+    try:
+        shop = session.query(Shop).filter(Shop.id == shop_id).first()
+        if shop is None:
+            return 0
+        loaded = ingest_shop_report(session, shop, *window)
+        if loaded:
+            # Окно загружено — аналитика видит его сразу
+            bump_data_version(session, shop_id)
+            session.commit()
+        return loaded
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+async def _show_progress(message, text):
+    if message is None:
+        return
+    try:
+        await message.edit_text(text)
+    except MessageNotModified:
+        pass
+    except Exception as e:
+        logger.warning(f"Failed to update backfill progress: {e}")
+
+
+def resume_backfill(session, shop) -> int:
+    """Догружает брошенные окна истории магазина (вызывается загрузчиком); возвращает число строк"""
+    stale = backfill_checkpoints(session, shop.id, datetime.utcnow() - timedelta(hours=BACKFILL_STALE_HOURS))
+    rows = 0
+    for checkpoint in stale:
+        logger.info(f"Shop {shop.id}: resuming backfill window {checkpoint.date_from} - {checkpoint.date_to}")
+        rows += ingest_shop_report(session, shop, checkpoint.date_from, checkpoint.date_to)
+    return rows
+
+
+async def run_backfill(shop_id: int, progress_message=None):
+    """Загрузка истории нового магазина по окнам, свежие окна — первыми.
+
+    Окна идут по очереди: запросы токена ограничены общим для всех процессов
+    бюджетом, параллельные окна его бы только делили. Строки пишутся upsert-ом
+    по rrd_id, поэтому повторный запуск безопасен.
+    """
+    loop = asyncio.get_running_loop()
+    windows = await loop.run_in_executor(None, plan_backfill, shop_id)
+
+    done = 0
+    failed = 0
+    rows = 0
+    for window in windows:
+        try:
+            rows += await loop.run_in_executor(None, _ingest_window, shop_id, window)
+        except Exception as e:
+            failed += 1
+            logger.error(f"Shop {shop_id}: backfill window failed: {e}")
+        done += 1
+        await _show_progress(
+            progress_message,
+            f"⏳ Загружаю историю продаж: {done}/{len(windows)} периодов, {rows} строк отчёта\n"
+            "Последние недели уже доступны в аналитике."
+        )
+
+    logger.info(f"Shop {shop_id}: backfill finished, {rows} rows, {failed} failed windows")
+    if failed:
+        await _show_progress(
+            progress_message,
+            f"⚠️ История продаж загружена частично ({len(windows) - failed}/{len(windows)} периодов). "
+            "Остальное догрузится автоматически."
+        )
+    else:
+        await _show_progress(progress_message, f"✅ История продаж загружена ({rows} строк отчёта)")
+    return rows
+
+
+# Ссылки на запущенные загрузки: без них задачу может собрать сборщик мусора
+_backfill_tasks = set()
+
+
+def _backfill_done(task):
+    _backfill_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Backfill failed: {task.exception()!r}")
+
+
+def start_backfill(shop_id: int, progress_message=None):
+    """Запускает run_backfill в фоне"""
+    task = asyncio.create_task(run_backfill(shop_id, progress_message))
+    _backfill_tasks.add(task)
+    task.add_done_callback(_backfill_done)
+    return task
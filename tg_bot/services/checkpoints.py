@@ -0,0 +1,48 @@
+from datetime import datetime
+
+from tg_bot.models import IngestCheckpoint
+
+
+def _day(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+def get_checkpoint(session, shop_id: int, endpoint: str, date_from, date_to=None) -> IngestCheckpoint:
+    """Чекпоинт загрузки (создаётся при первом обращении, коммит делает вызывающий код)"""
+    date_from, date_to = _day(date_from), _day(date_to)
+    query = session.query(IngestCheckpoint).filter(
+        IngestCheckpoint.shop_id == shop_id,
+        IngestCheckpoint.endpoint == endpoint,
+        IngestCheckpoint.date_from == date_from,
+    )
+    if date_to is None:
+        query = query.filter(IngestCheckpoint.date_to.is_(None))
+    else:
+        query = query.filter(IngestCheckpoint.date_to == date_to)
+    checkpoint = query.first()
+    if checkpoint is None:
+        checkpoint = IngestCheckpoint(
+            shop_id=shop_id,
+            endpoint=endpoint,
+            date_from=date_from,
+            date_to=date_to,
+            last_rrd_id=0,
+            pages=0,
+            rows=0,
+            completed=False,
+        )
+        session.add(checkpoint)
+    return checkpoint
+
+
+def advance_checkpoint(checkpoint: IngestCheckpoint, rrd_id: int, rows: int):
+    """Сдвигает позицию после страницы; коммитится вместе со строками страницы"""
+    checkpoint.last_rrd_id = rrd_id
+    checkpoint.pages = (checkpoint.pages or 0) + 1
+    checkpoint.rows = (checkpoint.rows or 0) + rows
+    checkpoint.updated_at = datetime.utcnow()
+
+
+def complete_checkpoint(checkpoint: IngestCheckpoint):
+    checkpoint.completed = True
+    checkpoint.updated_at = datetime.utcnow()
@@ -0,0 +1,158 @@
+import io
+import csv
+import logging
+
+import openpyxl
+from sqlalchemy import insert, update, bindparam
+
+from tg_bot.models import sessionmaker, engine, ProductCost
+from tg_bot.services.data_versions import bump_data_version
+
+logger = logging.getLogger(__name__)
+
+COST_IMPORT_CHUNK = 1000
+# Сколько ошибок с номерами строк показывать пользователю
+MAX_REPORTED_ERRORS = 20
+COST_FILE_EXTENSIONS = (".xlsx", ".csv", ".tsv", ".txt")
+
+
+def _xlsx_rows(data: bytes):
+    wb = openpyxl.load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    try:
+        for row in wb.active.iter_rows(values_only=True):
+            yield row
+    finally:
+        wb.close()
+
+
+def _text_rows(data: bytes, delimiter=None):
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        text = data.decode("cp1251")
+    if delimiter is None:
+        try:
+            delimiter = csv.Sniffer().sniff(text[:4096], delimiters=",;\t").delimiter
+        except csv.Error:
+            delimiter = ";"
+    return csv.reader(io.StringIO(text), delimiter=delimiter)
+
+
+def iter_cost_rows(filename: str, data: bytes):
+    """Строки файла себестоимости по одной: xlsx (read-only), csv, tsv"""
+    name = filename.lower()
+    if name.endswith(".xlsx"):
+        return _xlsx_rows(data)
+    if name.endswith(".tsv"):
+        return _text_rows(data, "\t")
+    return _text_rows(data)
+
+
+def parse_article(value):
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    article = str(value).strip()
+    return article or None
+
+
+def parse_cost(value):
+    """Себестоимость из ячейки: число, «1 234,50» или None"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    if value is None:
+        return None
+    text = str(value).strip().replace(" ", "").replace(" ", "").replace(",", ".")
+    if not text:
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def _flush(session, shop_id: int, chunk: dict):
+    """Upsert пачки по (shop_id, article): UPDATE существующих, INSERT новых"""
+    existing = {
+        article for (article,) in session.query(ProductCost.article)
+        .filter(ProductCost.shop_id == shop_id, ProductCost.article.in_(list(chunk)))
+    }
+    table = ProductCost.__table__
+    if existing:
+        # executemany на уровне Core: ключ — (shop_id, article), а не id
+        session.execute(
+            update(table)
+            .where(table.c.shop_id == shop_id, table.c.article == bindparam("b_article"))
+            .values(cost=bindparam("b_cost")),
+            [{"b_article": article, "b_cost": chunk[article]} for article in existing],
+        )
+    new = [
+        {"shop_id": shop_id, "article": article, "cost": cost}
+        for article, cost in chunk.items() if article not in existing
+    ]
+    if new:
+        session.execute(insert(table), new)
+
+
+def import_costs(session, shop_id: int, filename: str, data: bytes):
+    """Потоковый импорт себестоимости; возвращает (записей, ошибок, [(строка, текст ошибки)])
+
+    Первая строка считается заголовком, если в ней нет числа во второй колонке.
+    Пишется пачками по COST_IMPORT_CHUNK, версия "cost" поднимается один раз.
+    """
+    imported = 0
+    error_count = 0
+    errors = []
+    chunk = {}
+
+    def error(row_number, text):
+        nonlocal error_count
+        error_count += 1
+        if len(errors) < MAX_REPORTED_ERRORS:
+            errors.append((row_number, text))
+
+    for row_number, row in enumerate(iter_cost_rows(filename, data), 1):
+        row = list(row or ())
+        if not any(value not in (None, "") for value in row):
+            continue
+        article = parse_article(row[0] if row else None)
+        cost = parse_cost(row[1] if len(row) > 1 else None)
+        if row_number == 1 and cost is None:
+            continue  # заголовок
+        if article is None:
+            error(row_number, "не указан артикул")
+            continue
+        if cost is None:
+            error(row_number, f"себестоимость «{row[1] if len(row) > 1 else ''}» не число")
+            continue
+        if cost < 0:
+            error(row_number, "отрицательная себестоимость")
+            continue
+
+        chunk[article] = cost
+        if len(chunk) >= COST_IMPORT_CHUNK:
+            _flush(session, shop_id, chunk)
+            imported += len(chunk)
+            chunk = {}
+
+    if chunk:
+        _flush(session, shop_id, chunk)
+        imported += len(chunk)
+    if imported:
+        bump_data_version(session, shop_id, "cost")
+    session.commit()
+    logger.info(f"Shop {shop_id}: imported {imported} costs, {error_count} bad rows")
+    return imported, error_count, errors
+
+
+def import_cost_file(shop_id: int, filename: str, data: bytes):
+    """import_costs в своей сессии (для запуска в пуле потоков)"""
+    session = sessionmaker(bind=engine)()
+    try:
+        return import_costs(session, shop_id, filename, data)
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
@@ -0,0 +1,32 @@
+from datetime import datetime
+
+from tg_bot.models import DataVersion
+
+
+def get_data_version(session, shop_id: int, name: str = "report"):
+    """Текущая версия данных магазина: (версия, время обновления)"""
+    row = (
+        session.query(DataVersion)
+        .filter(DataVersion.shop_id == shop_id, DataVersion.name == name)
+        .first()
+    )
+    if row is None:
+        return 0, None
+    return row.version, row.updated_at
+
+
+def bump_data_version(session, shop_id: int, name: str = "report"):
+    """Увеличивает версию данных магазина (коммит делает вызывающий код).
+    Инкремент атомарный: версию могут поднимать несколько потоков загрузки."""
+    updated = (
+        session.query(DataVersion)
+        .filter(DataVersion.shop_id == shop_id, DataVersion.name == name)
+        .update(
+            {DataVersion.version: DataVersion.version + 1, DataVersion.updated_at: datetime.utcnow()},
+            synchronize_session=False,
+        )
+    )
+    if not updated:
+        session.add(DataVersion(shop_id=shop_id, name=name, version=1, updated_at=datetime.utcnow()))
+        session.flush()
+    return get_data_version(session, shop_id, name)[0]
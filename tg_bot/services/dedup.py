@@ -0,0 +1,29 @@
+def dedup_rows(rows, key="rrd_id", version=None):
+    """Строки без повторов по ключу (rrd_id для отчёта, srid для заказов и продаж).
+
+    Порядок — по первому появлению ключа; при повторе остаётся более новая строка:
+    с большим значением поля version или, без него, встретившаяся позже.
+    Строки без ключа не схлопываются.
+    """
+    positions = {}
+    result = []
+    for row in rows or []:
+        value = row.get(key)
+        if not value:
+            result.append(row)
+            continue
+        pos = positions.get(value)
+        if pos is None:
+            positions[value] = len(result)
+            result.append(row)
+        elif version is None or (row.get(version) or "") >= (result[pos].get(version) or ""):
+            result[pos] = row
+    return result
+
+
+def dedup_orders(rows):
+    """Заказы/продажи WB: одна строка на srid, последняя по lastChangeDate"""
+    if not isinstance(rows, list):
+        # Ответ с ошибкой API отдаём как есть
+        return rows
+    return dedup_rows(rows, key="srid", version="lastChangeDate")
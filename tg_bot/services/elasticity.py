@@ -0,0 +1,165 @@
+import os
+import asyncio
+import logging
+from datetime import datetime, date, timedelta
+
+import numpy as np
+from sqlalchemy import func
+
+from tg_bot.models import sessionmaker, engine, Order, ArticleElasticity
+
+logger = logging.getLogger(__name__)
+
+# Дни заказов учитываются, когда они уже не меняются (checker перечитывает последние 8 дней)
+ELASTICITY_SETTLE_DAYS = int(os.getenv("ELASTICITY_SETTLE_DAYS", 8))
+# Когда оценке можно верить: достаточно дней и коэффициент значимо отличается от нуля
+MIN_ELASTICITY_DAYS = 14
+MIN_T_STAT = 2.0
+# Допустимый диапазон для симулятора (положительная оценка — шум или внешний фактор)
+ELASTICITY_RANGE = (-5.0, 0.0)
+
+_SUMS = ("days", "sum_x", "sum_y", "sum_xx", "sum_xy", "sum_yy")
+
+
+def daily_order_aggregates(session, shop_id: int, after_day, until_day):
+    """Заказы nm_id по дням (без отмен): (nm_id, день, штук, средняя цена со скидкой продавца)"""
+    day = func.date(Order.date)
+    query = (
+        session.query(Order.nmId, day, func.count(Order.srid), func.avg(Order.priceWithDisc))
+        .filter(
+            Order.shop_id == shop_id,
+            Order.nmId.isnot(None),
+            Order.priceWithDisc > 0,
+            Order.isCancel.isnot(True),
+            Order.date < datetime.combine(until_day + timedelta(days=1), datetime.min.time()),
+        )
+        .group_by(Order.nmId, day)
+    )
+    if after_day is not None:
+        query = query.filter(Order.date >= datetime.combine(after_day + timedelta(days=1), datetime.min.time()))
+    return query.all()
+
+
+def fit(sums):
+    """Наклон ln(шт) по ln(цены) из накопленных сумм — сразу для всех nm_id.
+
+    Возвращает (эластичность, стандартная ошибка, R²); где цена не менялась — NaN.
+    """
+    n = sums["days"]
+    sxx = sums["sum_xx"] - sums["sum_x"] ** 2 / np.maximum(n, 1)
+    sxy = sums["sum_xy"] - sums["sum_x"] * sums["sum_y"] / np.maximum(n, 1)
+    syy = sums["sum_yy"] - sums["sum_y"] ** 2 / np.maximum(n, 1)
+    valid = (n >= 3) & (sxx > 1e-9)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = np.where(valid, sxy / sxx, np.nan)
+        sse = np.maximum(syy - slope * sxy, 0)
+        std_error = np.where(valid, np.sqrt(sse / np.maximum(n - 2, 1) / sxx), np.nan)
+        r2 = np.where(valid & (syy > 1e-9), 1 - sse / syy, np.nan)
+    return slope, std_error, r2
+
+
+def refresh_elasticity(session, shop_id: int, today=None):
+    """Добавляет к суммам регрессии новые устоявшиеся дни заказов и пересчитывает оценки.
+
+    Дни без заказов не наблюдаются (ln 0), поэтому оценка — по дням с продажами.
+    Коммит делает вызывающий код. Возвращает число учтённых дневных точек.
+    """
+    # День today - ELASTICITY_SETTLE_DAYS checker ещё перечитывает с середины, он не устоялся
+    until_day = (today or date.today()) - timedelta(days=ELASTICITY_SETTLE_DAYS + 1)
+    last_day = (
+        session.query(func.max(ArticleElasticity.last_day))
+        .filter(ArticleElasticity.shop_id == shop_id)
+        .scalar()
+    )
+    if last_day is not None and last_day >= until_day:
+        return 0
+    points = daily_order_aggregates(session, shop_id, last_day, until_day)
+
+    existing = session.query(ArticleElasticity).filter(ArticleElasticity.shop_id == shop_id).all()
+    nm_ids = np.array(sorted({row.nm_id for row in existing} | {int(p[0]) for p in points}), dtype=np.int64)
+    sums = {name: np.zeros(len(nm_ids)) for name in _SUMS}
+    positions = np.searchsorted(nm_ids, [row.nm_id for row in existing])
+    for name in _SUMS:
+        sums[name][positions] = [getattr(row, name) or 0 for row in existing]
+
+    if points:
+        nm = np.searchsorted(nm_ids, np.array([p[0] for p in points], dtype=np.int64))
+        x = np.log(np.array([p[3] for p in points], dtype=float))
+        y = np.log(np.array([p[2] for p in points], dtype=float))
+        for name, values in (
+            ("days", np.ones(len(points))),
+            ("sum_x", x),
+            ("sum_y", y),
+            ("sum_xx", x * x),
+            ("sum_xy", x * y),
+            ("sum_yy", y * y),
+        ):
+            sums[name] += np.bincount(nm, weights=values, minlength=len(nm_ids))
+
+    slope, std_error, r2 = fit(sums)
+    now = datetime.utcnow()
+    records = [
+        {
+            "shop_id": shop_id,
+            "nm_id": int(nm_id),
+            **{name: float(sums[name][i]) for name in _SUMS},
+            "days": int(sums["days"][i]),
+            "elasticity": 0.0 if np.isnan(slope[i]) else float(slope[i]),
+            "std_error": None if np.isnan(std_error[i]) else float(std_error[i]),
+            "r2": None if np.isnan(r2[i]) else float(r2[i]),
+            "last_day": until_day,
+            "updated_at": now,
+        }
+        for i, nm_id in enumerate(nm_ids)
+    ]
+    session.query(ArticleElasticity).filter(ArticleElasticity.shop_id == shop_id).delete(synchronize_session=False)
+    if records:
+        session.bulk_insert_mappings(ArticleElasticity, records)
+    logger.info(f"Shop {shop_id}: elasticity +{len(points)} daily points, {len(records)} articles")
+    return len(points)
+
+
+def is_confident(row) -> bool:
+    """Оценке можно верить: MIN_ELASTICITY_DAYS дней и |t| >= MIN_T_STAT"""
+    return (
+        row is not None
+        and row.days >= MIN_ELASTICITY_DAYS
+        and row.std_error
+        and abs(row.elasticity) / row.std_error >= MIN_T_STAT
+    )
+
+
+def usable_elasticity(row) -> float:
+    """Эластичность для симулятора: уверенная оценка в ELASTICITY_RANGE, иначе 0"""
+    if not is_confident(row):
+        return 0.0
+    return float(min(max(row.elasticity, ELASTICITY_RANGE[0]), ELASTICITY_RANGE[1]))
+
+
+def shop_elasticities(session, shop_id: int) -> dict:
+    """{nm_id: эластичность для симулятора} по всем nm_id магазина"""
+    return {
+        row.nm_id: usable_elasticity(row)
+        for row in session.query(ArticleElasticity).filter(ArticleElasticity.shop_id == shop_id)
+    }
+
+
+def article_elasticity(shop_id: int, nm_id: int):
+    """Запись оценки для nm_id или None"""
+    session = sessionmaker(bind=engine)()
+    try:
+        row = (
+            session.query(ArticleElasticity)
+            .filter(ArticleElasticity.shop_id == shop_id, ArticleElasticity.nm_id == nm_id)
+            .first()
+        )
+        if row is not None:
+            session.expunge(row)
+        return row
+    finally:
+        session.close()
+
+
+async def get_article_elasticity(shop_id: int, nm_id: int):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, article_elasticity, shop_id, nm_id)
@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import threading
+from datetime import datetime
+
+import numpy as np
+
+from tg_bot.models import sessionmaker, engine
+from tg_bot.services.data_versions import get_data_version
+from tg_bot.services.shop_dataset import shop_datasets, day_ordinal
+from tg_bot.services.profitability import shop_costs
+
+logger = logging.getLogger(__name__)
+
+# По скольким последним дням строится тренд и на сколько дней вперёд прогноз
+FORECAST_HISTORY_DAYS = 180
+FORECAST_HORIZON_DAYS = 360
+# Месяц прогноза — 30 дней (как окна в last_months_report)
+MONTH_DAYS = 30
+# Горизонт поиска срока окупаемости
+PAYBACK_HORIZON_MONTHS = 120
+
+
+def fit_trends(values, mask):
+    """Линейный тренд y = a + b*t для всех рядов сразу (закрытая форма МНК).
+
+    values — матрица (ряды x дни), mask — какие дни ряда учитывать
+    (ряд начинается с первой продажи). Возвращает (a, b).
+    """
+    t = np.arange(values.shape[1], dtype=float)
+    weights = mask.astype(float)
+    n = weights.sum(axis=1)
+    sum_t = weights @ t
+    sum_tt = weights @ (t * t)
+    sum_y = (weights * values).sum(axis=1)
+    sum_ty = (weights * values) @ t
+    denominator = n * sum_tt - sum_t ** 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        slope = np.where(denominator > 0, (n * sum_ty - sum_t * sum_y) / denominator, 0.0)
+        intercept = np.where(n > 0, (sum_y - slope * sum_t) / n, 0.0)
+    return intercept, slope
+
+
+def report_amounts(frame, costs):
+    """Выручка, прибыль и штуки строк отчёта со знаком (возвраты вычитаются) и разбиение по nm_id.
+
+    Прибыль строки: к перечислению - логистика - хранение - удержания - себестоимость.
+    Себестоимость ищется по nm_id, затем по артикулу продавца. Возвращает словарь:
+    nm_ids, articles, inverse (номер nm_id для каждой строки), revenue, profit, quantity.
+    """
+    is_sale = frame.contains("doc_type_name", "продажа", "sale")
+    is_return = frame.contains("doc_type_name", "возврат", "return") & ~is_sale
+    sign = is_sale.astype(float) - is_return
+    quantity = frame.col("quantity") * sign
+
+    nm_ids, first, inverse = np.unique(frame.nm_id, return_index=True, return_inverse=True)
+    names = np.asarray(frame.vocabs["sa_name"].values, dtype=object)
+    articles = names[frame.codes["sa_name"][first]] if len(first) else names[:0]
+    cost_per_item = np.array(
+        [costs.get(str(nm_id), costs.get(article, 0)) for nm_id, article in zip(nm_ids, articles)],
+        dtype=float,
+    )
+    return {
+        "nm_ids": nm_ids,
+        "articles": articles,
+        "inverse": inverse,
+        "quantity": quantity,
+        "revenue": frame.col("retail_price_withdisc_rub") * quantity,
+        "profit": (
+            frame.col("ppvz_for_pay") * sign
+            - frame.col("delivery_rub")
+            - frame.col("storage_fee")
+            - frame.col("deduction")
+            - cost_per_item[inverse] * quantity
+        ),
+    }
+
+
+class ShopForecast:
+    """Дневные и месячные прогнозы выручки и прибыли по nm_id и по магазину.
+
+    Прибыль — как в report_amounts. Последняя строка матриц — магазин целиком
+    (включая строки без товара: хранение, удержания).
+    """
+
+    METRICS = ("revenue", "profit")
+
+    def __init__(self, frame, costs, today=None):
+        today = today or datetime.utcnow()
+        last_day = day_ordinal(today) - 1  # текущий день ещё не закрыт
+        first_day = last_day - FORECAST_HISTORY_DAYS + 1
+        self.days = FORECAST_HISTORY_DAYS
+
+        amounts = report_amounts(frame, costs)
+        nm_ids, inverse = amounts["nm_ids"], amounts["inverse"]
+        articles = amounts["articles"]
+        rows = {"revenue": amounts["revenue"], "profit": amounts["profit"]}
+
+        # Вся история — для окупаемости
+        self.history_profit = float(rows["profit"].sum())
+        self.history_months = (
+            (int(frame.day.max()) - int(frame.day[frame.day > 0].min())) // MONTH_DAYS + 1
+            if (frame.day > 0).any() else 0
+        )
+
+        # Матрицы (товары + магазин) x дни окна
+        self.nm_ids = nm_ids
+        self.articles = articles
+        in_window = (frame.day >= first_day) & (frame.day <= last_day)
+        series = len(nm_ids) + 1
+        cells = inverse[in_window] * self.days + (frame.day[in_window] - first_day)
+        history = {}
+        for name, values in rows.items():
+            matrix = np.bincount(cells, weights=values[in_window], minlength=(series - 1) * self.days)
+            matrix = matrix.reshape(series - 1, self.days)
+            history[name] = np.vstack([matrix, matrix.sum(axis=0, keepdims=True)])
+
+        # Ряд товара начинается с первого дня с движением, ряд магазина — с начала окна
+        active = (history["revenue"] != 0) | (history["profit"] != 0)
+        started = np.maximum.accumulate(active, axis=1)
+        started[-1] = True
+        self.trends = {name: fit_trends(matrix, started) for name, matrix in history.items()}
+        # Матрицы истории в кэше не держим (сотни МБ на большой каталог) — только прибыль последнего месяца
+        self.recent_profit = history["profit"][:, -MONTH_DAYS:].sum(axis=1)
+
+    def daily(self, metric, horizon=FORECAST_HORIZON_DAYS):
+        """Прогноз по дням (ряды x horizon); выручка не бывает отрицательной"""
+        intercept, slope = self.trends[metric]
+        t = np.arange(self.days, self.days + horizon, dtype=float)
+        forecast = intercept[:, None] + slope[:, None] * t[None, :]
+        return np.maximum(forecast, 0) if metric == "revenue" else forecast
+
+    def monthly(self, metric, months=FORECAST_HORIZON_DAYS // MONTH_DAYS):
+        """Прогноз по 30-дневным месяцам в закрытой форме: 30a + b * сумма дней месяца"""
+        intercept, slope = self.trends[metric]
+        start = self.days + MONTH_DAYS * np.arange(months, dtype=float)
+        day_sums = MONTH_DAYS * start + MONTH_DAYS * (MONTH_DAYS - 1) / 2
+        forecast = MONTH_DAYS * intercept[:, None] + slope[:, None] * day_sums[None, :]
+        return np.maximum(forecast, 0) if metric == "revenue" else forecast
+
+    def shop_monthly(self, metric, months=FORECAST_HORIZON_DAYS // MONTH_DAYS):
+        return self.monthly(metric, months)[-1]
+
+    def payback_months(self, total_one_time):
+        """Месяцев от начала продаж до окупаемости разовых вложений или None (за 10 лет не окупится).
+
+        Накопленная прибыль истории плюс прогноз магазина по месяцам (без убыточных месяцев).
+        """
+        if self.history_profit >= total_one_time:
+            return self.history_months
+        profits = np.maximum(self.shop_monthly("profit", PAYBACK_HORIZON_MONTHS), 0)
+        reached = np.flatnonzero(self.history_profit + np.cumsum(profits) >= total_one_time)
+        if not len(reached) or self.history_months + reached[0] + 1 > PAYBACK_HORIZON_MONTHS:
+            return None
+        return self.history_months + int(reached[0]) + 1
+
+
+class ForecastStore:
+    """Прогнозы магазинов по версии отчёта, себестоимости и дню"""
+
+    def __init__(self):
+        self._forecasts = {}
+        self._lock = threading.Lock()
+
+    def get(self, shop_id: int) -> ShopForecast:
+        session = sessionmaker(bind=engine)()
+        try:
+            key = (
+                get_data_version(session, shop_id)[0],
+                get_data_version(session, shop_id, "cost")[0],
+                datetime.utcnow().date(),
+            )
+            with self._lock:
+                cached = self._forecasts.get(shop_id)
+                if cached is not None and cached[0] == key:
+                    return cached[1]
+            forecast = ShopForecast(shop_datasets.get(shop_id), shop_costs(session, shop_id))
+        finally:
+            session.close()
+        with self._lock:
+            self._forecasts[shop_id] = (key, forecast)
+        logger.info(f"Shop {shop_id}: forecast v{key[0]} ({len(forecast.nm_ids)} series)")
+        return forecast
+
+
+forecast_store = ForecastStore()
+
+
+async def get_shop_forecast(shop_id: int) -> ShopForecast:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, forecast_store.get, shop_id)
@@ -0,0 +1,80 @@
+import os
+import asyncio
+import logging
+from datetime import datetime
+
+from tg_bot.services.wb_api import fetch_report_detail_by_period, rate_budget
+from tg_bot.services.shop_dataset import ReportFrame, get_shop_frame, shop_datasets
+
+logger = logging.getLogger(__name__)
+
+# Сколько секунд интерактивный запрос ждёт WB API, прежде чем ответить локальными данными
+INTERACTIVE_DEADLINE = float(os.getenv("INTERACTIVE_FETCH_DEADLINE", 4))
+
+
+async def fetch_report_with_deadline(api_token: str, shop_id: int, start_date, end_date, deadline=INTERACTIVE_DEADLINE):
+    """Отчёт за период: свежий из WB API, если он успел до дедлайна, иначе локальный.
+
+    Возвращает (frame, stale_at, pending):
+    stale_at — время обновления локальных данных (None, если ответ свежий),
+    pending — незавершённый запрос к WB; его можно дождаться через wait_fresh_report
+    и обновить уже отправленный ответ. deadline=None — ждать WB без ограничения.
+    Запрос идёт через общий бюджет токена: если слот занят загрузчиками,
+    отвечаем локальными данными, а без них — ждём своей очереди.
+    """
+    local = await get_shop_frame(shop_id)
+    loop = asyncio.get_running_loop()
+    budget = rate_budget(api_token)
+    if await loop.run_in_executor(None, budget.try_acquire):
+        pending = loop.run_in_executor(None, fetch_report_detail_by_period, api_token, start_date, end_date, 1)
+    else:
+        cached = local.between(start_date, end_date)
+        if len(cached):
+            logger.info(f"Shop {shop_id}: WB API budget is exhausted, answering from local data")
+            return cached, local_freshness(shop_id), None
+        pending = loop.run_in_executor(None, _fetch_metered, budget, api_token, start_date, end_date)
+    try:
+        rows = await asyncio.wait_for(asyncio.shield(pending), deadline)
+    except asyncio.TimeoutError:
+        logger.info(f"Shop {shop_id}: WB API missed {deadline}s deadline, answering from local data")
+        return local.between(start_date, end_date), local_freshness(shop_id), pending
+
+    fresh = ReportFrame.from_rows(rows, local.vocabs)
+    if not len(fresh):
+        # WB не ответил — отвечаем локальными данными, если они есть
+        cached = local.between(start_date, end_date)
+        if len(cached):
+            return cached, local_freshness(shop_id), None
+    return fresh, None, None
+
+
+def _fetch_metered(budget, api_token: str, start_date, end_date):
+    """Запрос к WB после ожидания слота в бюджете токена (без повторов мимо бюджета)"""
+    budget.acquire()
+    return fetch_report_detail_by_period(api_token, start_date, end_date, 1)
+
+
+async def wait_fresh_report(pending, vocabs=None):
+    """Дожидается фонового запроса к WB: ReportFrame или None, если данных нет"""
+    rows = await pending
+    if not rows:
+        return None
+    return ReportFrame.from_rows(rows, vocabs)
+
+
+def local_freshness(shop_id: int):
+    """Время обновления локальных данных магазина (по времени сервера)"""
+    updated_at = shop_datasets.freshness(shop_id)
+    if updated_at is None:
+        return None
+    # DataVersion хранит UTC
+    return updated_at + (datetime.now() - datetime.utcnow())
+
+
+def freshness_note(stale_at, refreshing: bool = True) -> str:
+    """Пометка для ответа, собранного из локальных данных"""
+    when = stale_at.strftime("%d.%m %H:%M") if stale_at else "момент последней загрузки"
+    note = f"\n\n<i>⏳ WB API не ответил вовремя — показаны данные на {when}."
+    if refreshing:
+        note += " Сообщение обновится, когда придут свежие данные."
+    return note + "</i>"
@@ -0,0 +1,146 @@
+import logging
+from datetime import date
+
+from sqlalchemy import func, case, exists, or_, and_
+
+from tg_bot.models import Order, ReportRow, FunnelCell
+from tg_bot.services.order_cube import day_ranges, order_days_filter
+
+logger = logging.getLogger(__name__)
+
+_CHUNK = 500
+# Больше srid за загрузку — дешевле перестроить воронку магазина целиком
+FUNNEL_SRID_LIMIT = 50000
+
+
+def order_days_for_srids(session, shop_id: int, srids):
+    """Дни заказов с этими srid (поиск по первичному ключу orders)"""
+    srids = sorted({srid for srid in srids if srid})
+    days = set()
+    for start in range(0, len(srids), _CHUNK):
+        for (ordered_at,) in session.query(Order.date).filter(
+            Order.srid.in_(srids[start:start + _CHUNK]), Order.shop_id == shop_id, Order.date.isnot(None)
+        ):
+            days.add(ordered_at.date().toordinal())
+    return days
+
+
+def refresh_funnel(session, shop_id: int, days=None):
+    """Пересчитывает воронку за дни заказов days (None — все дни) из orders и строк отчёта.
+
+    Статус каждого srid: выкуплен — is_bouhght или строка «Продажа» в отчёте,
+    возвращён — строка «Возврат», отменён — isCancel без выкупа. Строки отчёта
+    ищутся по индексу (shop_id, srid). Пока воронки магазина нет, она строится
+    целиком. Коммит делает вызывающий код. Возвращает число записанных ячеек.
+    """
+    if days is not None and session.query(FunnelCell.id).filter(FunnelCell.shop_id == shop_id).first() is None:
+        days = None
+    if days is not None and not days:
+        return 0
+
+    def has_report_row(doc_type):
+        return exists().where(
+            ReportRow.shop_id == shop_id, ReportRow.srid == Order.srid, ReportRow.doc_type_name == doc_type
+        )
+
+    bought = or_(Order.is_bouhght.is_(True), has_report_row("Продажа"))
+    query = (
+        session.query(
+            func.date(Order.date),
+            func.coalesce(Order.nmId, 0),
+            func.count(Order.srid),
+            func.sum(case((and_(Order.isCancel.is_(True), ~bought), 1), else_=0)),
+            func.sum(case((bought, 1), else_=0)),
+            func.sum(case((has_report_row("Возврат"), 1), else_=0)),
+        )
+        .filter(Order.shop_id == shop_id, Order.date.isnot(None))
+        .group_by(func.date(Order.date), func.coalesce(Order.nmId, 0))
+    )
+    cells = session.query(FunnelCell).filter(FunnelCell.shop_id == shop_id)
+    if days is not None:
+        ranges = day_ranges(days)
+        query = query.filter(order_days_filter(ranges))
+        cells = cells.filter(or_(*[FunnelCell.day.between(first, last) for first, last in ranges]))
+
+    records = [
+        {
+            "shop_id": shop_id,
+            "day": date.fromisoformat(day).toordinal(),
+            "nm_id": int(nm_id),
+            "ordered": ordered,
+            "cancelled": cancelled or 0,
+            "bought": bought_count or 0,
+            "returned": returned or 0,
+        }
+        for day, nm_id, ordered, cancelled, bought_count, returned in query.all()
+    ]
+    cells.delete(synchronize_session=False)
+    if records:
+        session.bulk_insert_mappings(FunnelCell, records)
+    logger.info(f"Shop {shop_id}: funnel {len(records)} cells ({'all days' if days is None else f'{len(days)} days'})")
+    return len(records)
+
+
+def refresh_funnel_for_srids(session, shop_id: int, srids):
+    """Пересчёт воронки после загрузки строк отчёта: только дни заказов этих srid"""
+    return refresh_funnel(session, shop_id, order_days_for_srids(session, shop_id, srids))
+
+
+class FunnelRefresh:
+    """srid, затронутые загрузкой отчёта: воронка пересчитывается один раз после неё"""
+
+    def __init__(self, limit: int = FUNNEL_SRID_LIMIT):
+        self.limit = limit
+        self.srids = set()
+        self.full = False
+
+    def add(self, srids):
+        if self.full:
+            return
+        self.srids.update(srid for srid in srids if srid)
+        if len(self.srids) > self.limit:
+            self.full = True
+            self.srids = set()
+
+    def apply(self, session, shop_id: int):
+        if self.full:
+            return refresh_funnel(session, shop_id)
+        return refresh_funnel_for_srids(session, shop_id, self.srids)
+
+
+def funnel_rates(item):
+    """Процент выкупа (из завершённых заказов), отмен и возвратов; заказы в пути"""
+    ordered, cancelled, bought = item["ordered"], item["cancelled"], item["bought"]
+    item["pending"] = max(ordered - cancelled - bought, 0)
+    item["buyout_rate"] = bought / (bought + cancelled) if bought + cancelled else 0.0
+    item["cancel_rate"] = cancelled / ordered if ordered else 0.0
+    item["return_rate"] = item["returned"] / bought if bought else 0.0
+    return item
+
+
+def funnel_metrics(session, shop_id: int, start_date, end_date) -> dict:
+    """{nm_id: воронка с процентами} по заказам периода (одна выборка по индексу shop_id, day)"""
+    rows = (
+        session.query(
+            FunnelCell.nm_id,
+            func.sum(FunnelCell.ordered),
+            func.sum(FunnelCell.cancelled),
+            func.sum(FunnelCell.bought),
+            func.sum(FunnelCell.returned),
+        )
+        .filter(
+            FunnelCell.shop_id == shop_id,
+            FunnelCell.day.between(start_date.date().toordinal(), end_date.date().toordinal()),
+        )
+        .group_by(FunnelCell.nm_id)
+        .all()
+    )
+    return {
+        int(nm_id): funnel_rates({
+            "ordered": ordered or 0,
+            "cancelled": cancelled or 0,
+            "bought": bought or 0,
+            "returned": returned or 0,
+        })
+        for nm_id, ordered, cancelled, bought, returned in rows
+    }
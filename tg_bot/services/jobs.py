@@ -0,0 +1,298 @@
+import os
+import io
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+
+from aiogram.types import InputFile
+from aiogram.utils.exceptions import MessageNotModified, MessageToDeleteNotFound, BadRequest
+
+from tg_bot.models import sessionmaker, engine, ReportJob
+from tg_bot.services.artifacts import remember_file_id, forget_file_id
+
+logger = logging.getLogger(__name__)
+
+# Сколько тяжёлых отчётов считается одновременно
+REPORT_JOB_WORKERS = int(os.getenv("REPORT_JOB_WORKERS", 2))
+# Незавершённые задачи старше этого после рестарта не перезапускаем
+REPORT_JOB_RESUME_WINDOW = timedelta(hours=1)
+
+ERROR_TEXT = "❌ Произошла ошибка при генерации отчета. Попробуйте позже."
+
+
+class JobResult:
+    """Результат задачи: текст или документ (bytes и/или file_id из кэша артефактов)"""
+
+    def __init__(self, text=None, document=None, filename=None, caption=None, reply_markup=None,
+                 file_id=None, artifact_id=None):
+        self.text = text
+        self.document = document
+        self.filename = filename
+        self.caption = caption
+        self.reply_markup = reply_markup
+        self.file_id = file_id
+        self.artifact_id = artifact_id
+
+    @property
+    def is_document(self):
+        return self.document is not None or self.file_id is not None
+
+
+_runners = {}
+
+
+def job_runner(kind: str):
+    """Регистрирует обработчик задачи: async runner(params, context, progress) -> JobResult.
+
+    params — JSON-параметры (сохраняются в report_jobs), context — данные в памяти,
+    которых нет после рестарта (None), progress(text) — обновление сообщения о расчёте.
+    """
+    def decorator(func):
+        _runners[kind] = func
+        return func
+    return decorator
+
+
+def job_key(*parts) -> str:
+    """Ключ задачи: одинаковые запросы (пользователь, магазин, отчёт, период) совпадают"""
+    return ":".join(str(part) for part in parts)
+
+
+def _run_in_thread(runner, params, context, progress):
+    # Отдельный event loop в рабочем потоке: расчёт не блокирует обработку сообщений
+    return asyncio.run(runner(params, context, progress))
+
+
+def _set_status(job_id, status, error=None):
+    session = sessionmaker(bind=engine)()
+    try:
+        session.query(ReportJob).filter(ReportJob.id == job_id).update(
+            {ReportJob.status: status, ReportJob.error: error, ReportJob.updated_at: datetime.utcnow()},
+            synchronize_session=False,
+        )
+        session.commit()
+    finally:
+        session.close()
+
+
+class _Job:
+    def __init__(self, key, kind, params, record_id):
+        self.key = key
+        self.kind = kind
+        self.params = params
+        self.record_id = record_id
+        self.chat_ids = []
+        self.status_messages = []
+        self.context = None
+        self.done = asyncio.Event()
+
+    def attach(self, chat_id, status_message):
+        if chat_id not in self.chat_ids:
+            self.chat_ids.append(chat_id)
+        if status_message is not None:
+            self.status_messages.append(status_message)
+
+
+class ReportJobRunner:
+    """Фоновые задачи отчётов: ограниченное число воркеров и single-flight по ключу"""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="report-job")
+        self._jobs = {}
+        self._inline = set()
+        self._active = 0
+        self.bot = None
+
+    async def start(self, bot):
+        """Привязка к боту и перезапуск задач, прерванных рестартом"""
+        self.bot = bot
+        session = sessionmaker(bind=engine)()
+        try:
+            threshold = datetime.utcnow() - REPORT_JOB_RESUME_WINDOW
+            unfinished = (
+                session.query(ReportJob)
+                .filter(ReportJob.status.in_(("queued", "running")))
+                .all()
+            )
+            for record in unfinished:
+                if record.created_at < threshold or record.kind not in _runners:
+                    record.status = "failed"
+                    record.error = "interrupted by restart"
+                    continue
+                logger.info(f"Resuming report job {record.id} ({record.key})")
+                asyncio.create_task(self._resume(record.id, record.key, record.kind, record.params, record.chat_id))
+            session.commit()
+        finally:
+            session.close()
+
+    async def run(self, key, kind, params, chat_id, status_message=None, context=None):
+        """Запускает задачу или присоединяется к такой же, уже выполняющейся.
+
+        Возвращает отправленное сообщение с результатом для инициатора задачи;
+        присоединившиеся получают результат в чат, а run() возвращает им None.
+        """
+        job = self._jobs.get(key)
+        if job is not None:
+            job.attach(chat_id, status_message)
+            await self._edit(status_message, "⏳ Этот отчёт уже готовится — пришлю его, как только он будет готов")
+            await job.done.wait()
+            return None
+
+        session = sessionmaker(bind=engine)()
+        try:
+            record = ReportJob(key=key, kind=kind, chat_id=chat_id, params=params, status="queued")
+            session.add(record)
+            session.commit()
+            record_id = record.id
+        finally:
+            session.close()
+
+        job = _Job(key, kind, params, record_id)
+        job.attach(chat_id, status_message)
+        self._jobs[key] = job
+        try:
+            sent = await self._execute(job, context)
+            return sent.get(chat_id)
+        finally:
+            self._jobs.pop(key, None)
+            job.done.set()
+
+    @asynccontextmanager
+    async def single_flight(self, key):
+        """Для расчётов прямо в обработчике: True, если такой же расчёт уже идёт"""
+        if key in self._inline:
+            yield True
+            return
+        self._inline.add(key)
+        try:
+            yield False
+        finally:
+            self._inline.discard(key)
+
+    async def _resume(self, record_id, key, kind, params, chat_id):
+        job = _Job(key, kind, params, record_id)
+        job.attach(chat_id, None)
+        self._jobs[key] = job
+        try:
+            await self._execute(job, None)
+        finally:
+            self._jobs.pop(key, None)
+            job.done.set()
+
+    async def _execute(self, job, context):
+        job.context = context
+        loop = asyncio.get_running_loop()
+
+        def progress(text):
+            asyncio.run_coroutine_threadsafe(self._progress(job, text), loop)
+
+        if self._active >= self.workers:
+            await self._progress(job, "⏳ Отчёт в очереди, скоро начнём расчёт...")
+        self._active += 1
+        _set_status(job.record_id, "running")
+        try:
+            result = await loop.run_in_executor(
+                self._executor, _run_in_thread, _runners[job.kind], job.params, context, progress
+            )
+            _set_status(job.record_id, "done")
+        except Exception as e:
+            logger.error(f"Report job {job.key} failed: {e}")
+            _set_status(job.record_id, "failed", str(e))
+            result = JobResult(text=ERROR_TEXT)
+        finally:
+            self._active -= 1
+        return await self._deliver(job, result or JobResult(text=ERROR_TEXT))
+
+    async def _progress(self, job, text):
+        for message in list(job.status_messages):
+            await self._edit(message, text)
+
+    async def _edit(self, message, text):
+        if message is None:
+            return
+        try:
+            await message.edit_text(text)
+        except MessageNotModified:
+            pass
+        except Exception as e:
+            logger.warning(f"Failed to update job status message: {e}")
+
+    async def _deliver(self, job, result):
+        """Отправляет результат во все чаты, где его ждут"""
+        sent = {}
+        if result.is_document:
+            for message in job.status_messages:
+                try:
+                    await message.delete()
+                except MessageToDeleteNotFound:
+                    pass
+                except Exception as e:
+                    logger.warning(f"Failed to delete job status message: {e}")
+            for chat_id in job.chat_ids:
+                sent[chat_id] = await self._send_document(chat_id, result, job)
+            return sent
+
+        edited = set()
+        for message in job.status_messages:
+            if message.chat.id in edited:
+                await self._edit(message, "✅ Готово")
+                continue
+            try:
+                sent[message.chat.id] = await message.edit_text(result.text, reply_markup=result.reply_markup)
+                edited.add(message.chat.id)
+            except Exception as e:
+                logger.warning(f"Failed to deliver job result: {e}")
+        for chat_id in job.chat_ids:
+            if chat_id not in edited:
+                sent[chat_id] = await self.bot.send_message(chat_id, result.text, reply_markup=result.reply_markup)
+        return sent
+
+
+    async def _rebuild(self, job, result):
+        """Собирает документ заново: file_id отклонён, а файла в кэше уже нет"""
+        loop = asyncio.get_running_loop()
+        try:
+            rebuilt = await loop.run_in_executor(
+                self._executor, _run_in_thread, _runners[job.kind], job.params, job.context, lambda text: None
+            )
+        except Exception as e:
+            logger.error(f"Report job {job.key} rebuild failed: {e}")
+            return False
+        if rebuilt is None or rebuilt.document is None:
+            return False
+        result.document = rebuilt.document
+        result.artifact_id = rebuilt.artifact_id
+        return True
+
+    async def _send_document(self, chat_id, result, job=None):
+        """Отправка по file_id, если файл уже загружался, иначе загрузка bytes"""
+        if result.file_id is not None:
+            try:
+                return await self.bot.send_document(
+                    chat_id, result.file_id, caption=result.caption, reply_markup=result.reply_markup
+                )
+            except BadRequest as e:
+                logger.warning(f"Cached file_id rejected, uploading again: {e}")
+                result.file_id = None
+                if result.artifact_id is not None:
+                    # Запись без файла и file_id кэш удалит при следующем обращении
+                    forget_file_id(result.artifact_id)
+                if result.document is None and (job is None or not await self._rebuild(job, result)):
+                    return await self.bot.send_message(chat_id, ERROR_TEXT)
+
+        file = InputFile(io.BytesIO(result.document), filename=result.filename)
+        message = await self.bot.send_document(
+            chat_id, file, caption=result.caption, reply_markup=result.reply_markup
+        )
+        if message.document is not None:
+            # Следующие чаты и повторные запросы получат уже загруженный файл
+            result.file_id = message.document.file_id
+            if result.artifact_id is not None:
+                remember_file_id(result.artifact_id, result.file_id)
+        return message
+
+
+report_jobs = ReportJobRunner(REPORT_JOB_WORKERS)
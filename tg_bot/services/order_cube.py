@@ -0,0 +1,330 @@
+import asyncio
+import logging
+import threading
+from datetime import datetime, date, timedelta
+
+import numpy as np
+from sqlalchemy import func, case, or_, and_, event
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.orm import Session
+
+from tg_bot.models import sessionmaker, engine, Order, DimensionValue, OrderCubeCell
+from tg_bot.services.data_versions import get_data_version, bump_data_version
+
+logger = logging.getLogger(__name__)
+
+# Версия куба в data_versions
+CUBE_VERSION = "orders"
+
+# Измерения куба и колонки заказа, из которых они берутся
+CUBE_DIMENSIONS = {
+    "warehouse": Order.warehouseName,
+    "region": Order.regionName,
+    "okrug": Order.oblastOkrugName,
+    "warehouse_type": Order.warehouseType,
+    "category": Order.category,
+    "subject": Order.subject,
+    "brand": Order.brand,
+}
+DIMENSION_TITLES = {
+    "warehouse": "Склад",
+    "region": "Регион",
+    "okrug": "Округ",
+    "warehouse_type": "Тип склада",
+    "category": "Категория",
+    "subject": "Предмет",
+    "brand": "Бренд",
+}
+MEASURES = ("orders", "cancellations", "buyouts", "revenue", "buyout_revenue")
+
+# Ключ ячейки: день, nm_id, склад, регион; остальные измерения зависят от них
+_KEY = ("warehouse", "region")
+_CHUNK = 500
+# Коды измерений из незакоммиченной транзакции (в session.info)
+_PENDING = "dimension_codes"
+
+
+class DimensionDictionary:
+    """Коды строковых значений измерений (общие для всех магазинов), кэш в памяти процесса.
+
+    Коды, прочитанные в открытой транзакции, попадают в кэш только после её коммита:
+    при откате вставленные строки исчезают, а их id SQLite может отдать другим значениям.
+    """
+
+    def __init__(self):
+        self._codes = {}
+        self._values = {}
+        self._lock = threading.Lock()
+        event.listen(Session, "after_commit", self._committed)
+        event.listen(Session, "after_transaction_end", self._ended)
+
+    def encode(self, session, dimension: str, values) -> dict:
+        """{значение: код} для values; новые значения добавляются в dimension_values"""
+        with self._lock:
+            known = dict(self._codes.get(dimension, {}))
+        pending = session.info.setdefault(_PENDING, {}).setdefault(dimension, {})
+        known.update(pending)
+        missing = {value for value in values if value and value not in known}
+        if missing:
+            missing = sorted(missing)
+            for start in range(0, len(missing), _CHUNK):
+                chunk = missing[start:start + _CHUNK]
+                session.execute(
+                    insert(DimensionValue)
+                    .values([{"dimension": dimension, "value": value} for value in chunk])
+                    .on_conflict_do_nothing(index_elements=["dimension", "value"])
+                )
+                rows = session.query(DimensionValue.value, DimensionValue.id).filter(
+                    DimensionValue.dimension == dimension, DimensionValue.value.in_(chunk)
+                ).all()
+                pending.update(rows)
+                known.update(rows)
+        return {value: known.get(value, 0) for value in values}
+
+    def _committed(self, session):
+        pending = session.info.pop(_PENDING, None)
+        if pending:
+            with self._lock:
+                for dimension, codes in pending.items():
+                    self._codes.setdefault(dimension, {}).update(codes)
+
+    def _ended(self, session, transaction):
+        # Откат или закрытие без коммита: коды транзакции не сохраняем
+        if transaction.parent is None:
+            session.info.pop(_PENDING, None)
+
+    def decode(self, session, dimension: str) -> dict:
+        """{код: значение} всех значений измерения"""
+        rows = session.query(DimensionValue.id, DimensionValue.value).filter(
+            DimensionValue.dimension == dimension
+        ).all()
+        with self._lock:
+            values = self._values[dimension] = dict(rows)
+            values[0] = ""
+            return values
+
+
+dimension_dictionary = DimensionDictionary()
+
+
+def _to_day(value):
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if isinstance(value, datetime):
+        value = value.date()
+    return value.toordinal()
+
+
+def touched_days(session, shop_id: int, rows):
+    """Дни заказов, которые изменит загрузка строк API: даты из ответа и прежние даты этих srid.
+
+    Вызывается до сохранения — merge может перезаписать дату заказа.
+    """
+    days = set()
+    srids = []
+    for row in rows:
+        if not isinstance(row, dict):
+            continue
+        if row.get("date"):
+            days.add(_to_day(row["date"]))
+        if row.get("srid"):
+            srids.append(row["srid"])
+    for start in range(0, len(srids), _CHUNK):
+        for (stored,) in session.query(Order.date).filter(
+            Order.shop_id == shop_id, Order.srid.in_(srids[start:start + _CHUNK]), Order.date.isnot(None)
+        ):
+            days.add(_to_day(stored))
+    return days
+
+
+def day_ranges(days):
+    """Отсортированные дни -> непрерывные диапазоны [первый, последний]"""
+    ranges = []
+    for day in sorted(days):
+        if ranges and day == ranges[-1][1] + 1:
+            ranges[-1][1] = day
+        else:
+            ranges.append([day, day])
+    return ranges
+
+
+def order_days_filter(ranges):
+    """Условие на Order.date: заказ сделан в один из диапазонов дней"""
+    return or_(*[
+        and_(
+            Order.date >= datetime.combine(date.fromordinal(first), datetime.min.time()),
+            Order.date < datetime.combine(date.fromordinal(last + 1), datetime.min.time()),
+        )
+        for first, last in ranges
+    ])
+
+
+def refresh_order_cube(session, shop_id: int, days=None):
+    """Пересчитывает ячейки куба за дни заказов days (None — весь куб) из таблицы orders.
+
+    Пока куб магазина не построен (версия 0), строится целиком. Коммит делает
+    вызывающий код. Возвращает число записанных ячеек.
+    """
+    if days is not None and get_data_version(session, shop_id, CUBE_VERSION)[0] == 0:
+        days = None
+    if days is not None and not days:
+        return 0
+
+    grouped = {name: func.coalesce(CUBE_DIMENSIONS[name], "") for name in _KEY}
+    attributes = [name for name in CUBE_DIMENSIONS if name not in _KEY]
+    query = (
+        session.query(
+            func.date(Order.date),
+            func.coalesce(Order.nmId, 0),
+            *grouped.values(),
+            *[func.max(CUBE_DIMENSIONS[name]) for name in attributes],
+            func.count(Order.srid),
+            func.sum(case((Order.isCancel.is_(True), 1), else_=0)),
+            func.sum(case((Order.is_bouhght.is_(True), 1), else_=0)),
+            func.sum(func.coalesce(Order.priceWithDisc, 0)),
+            func.sum(case((Order.is_bouhght.is_(True), Order.priceWithDisc), else_=0)),
+        )
+        .filter(Order.shop_id == shop_id, Order.date.isnot(None))
+        .group_by(func.date(Order.date), func.coalesce(Order.nmId, 0), *grouped.values())
+    )
+    cells = session.query(OrderCubeCell).filter(OrderCubeCell.shop_id == shop_id)
+    if days is not None:
+        ranges = day_ranges(days)
+        query = query.filter(order_days_filter(ranges))
+        cells = cells.filter(or_(*[OrderCubeCell.day.between(first, last) for first, last in ranges]))
+    rows = query.all()
+
+    names = list(_KEY) + attributes
+    codes = {
+        name: dimension_dictionary.encode(session, name, {row[2 + i] for row in rows})
+        for i, name in enumerate(names)
+    }
+    records = []
+    for row in rows:
+        record = {
+            "shop_id": shop_id,
+            "day": date.fromisoformat(row[0]).toordinal(),
+            "nm_id": int(row[1]),
+        }
+        for i, name in enumerate(names):
+            record[name] = codes[name].get(row[2 + i], 0)
+        for i, measure in enumerate(MEASURES):
+            record[measure] = row[2 + len(names) + i] or 0
+        records.append(record)
+
+    cells.delete(synchronize_session=False)
+    if records:
+        session.bulk_insert_mappings(OrderCubeCell, records)
+    bump_data_version(session, shop_id, CUBE_VERSION)
+    logger.info(f"Shop {shop_id}: order cube {len(records)} cells ({'all days' if days is None else f'{len(days)} days'})")
+    return len(records)
+
+
+class OrderCube:
+    """Ячейки куба магазина в массивах NumPy: срезы по измерению за период без запросов к БД"""
+
+    COLUMNS = ("day", "nm_id") + tuple(CUBE_DIMENSIONS) + MEASURES
+
+    def __init__(self, rows, values):
+        """rows — кортежи ячеек в порядке COLUMNS, values — {измерение: {код: значение}}"""
+        self.values = values
+        # Row в кортежи: так NumPy разбирает строки на порядок быстрее
+        table = np.array([tuple(row) for row in rows], dtype=float).reshape(len(rows), len(self.COLUMNS))
+        columns = dict(zip(self.COLUMNS, np.nan_to_num(table).T))
+        self.day = columns["day"].astype(np.int64)
+        self.nm_id = columns["nm_id"].astype(np.int64)
+        self.codes = {name: columns[name].astype(np.int64) for name in CUBE_DIMENSIONS}
+        self.measures = {name: columns[name] for name in MEASURES}
+
+    def __len__(self):
+        return len(self.day)
+
+    def _mask(self, start_date, end_date, nm_id=None):
+        mask = (self.day >= _to_day(start_date)) & (self.day <= _to_day(end_date))
+        if nm_id is not None:
+            mask &= self.nm_id == nm_id
+        return mask
+
+    def totals(self, start_date, end_date, nm_id=None):
+        mask = self._mask(start_date, end_date, nm_id)
+        return with_rates({name: float(values[mask].sum()) for name, values in self.measures.items()})
+
+    def slice(self, dimension, start_date, end_date, nm_id=None):
+        """Показатели по значениям измерения за период, по убыванию заказов"""
+        mask = self._mask(start_date, end_date, nm_id)
+        codes = self.codes[dimension][mask]
+        unique, inverse = np.unique(codes, return_inverse=True)
+        sums = {
+            name: np.bincount(inverse, weights=values[mask], minlength=len(unique))
+            for name, values in self.measures.items()
+        }
+        order = np.argsort(-sums["orders"], kind="stable")
+        names = self.values.get(dimension, {})
+        return [
+            with_rates({
+                "name": names.get(int(unique[i]), "") or "Не указано",
+                **{name: float(values[i]) for name, values in sums.items()},
+            })
+            for i in order
+        ]
+
+
+def with_rates(item):
+    """Добавляет процент выкупа и отмен к показателям"""
+    orders = item["orders"]
+    item["buyout_rate"] = item["buyouts"] / orders if orders else 0.0
+    item["cancel_rate"] = item["cancellations"] / orders if orders else 0.0
+    return item
+
+
+class CubeStore:
+    """Кубы магазинов в памяти по версии куба (поднимается при каждом пересчёте)"""
+
+    def __init__(self):
+        self._cubes = {}
+        self._lock = threading.Lock()
+
+    def get(self, shop_id: int) -> OrderCube:
+        session = sessionmaker(bind=engine)()
+        try:
+            version = get_data_version(session, shop_id, CUBE_VERSION)[0]
+            if version == 0:
+                # Первое обращение: куб строится из всех заказов магазина
+                refresh_order_cube(session, shop_id)
+                session.commit()
+                version = get_data_version(session, shop_id, CUBE_VERSION)[0]
+            with self._lock:
+                cached = self._cubes.get(shop_id)
+                if cached is not None and cached[0] == version:
+                    return cached[1]
+            rows = (
+                session.query(*[getattr(OrderCubeCell, name) for name in OrderCube.COLUMNS])
+                .filter(OrderCubeCell.shop_id == shop_id)
+                .all()
+            )
+            cube = OrderCube(rows, {name: dimension_dictionary.decode(session, name) for name in CUBE_DIMENSIONS})
+        finally:
+            session.close()
+        with self._lock:
+            self._cubes[shop_id] = (version, cube)
+        return cube
+
+
+cube_store = CubeStore()
+
+
+def cube_slice(shop_id: int, dimension: str, start_date, end_date, nm_id=None):
+    """(итоги, строки по измерению) за период из куба заказов"""
+    cube = cube_store.get(shop_id)
+    return cube.totals(start_date, end_date, nm_id), cube.slice(dimension, start_date, end_date, nm_id)
+
+
+async def get_cube_slice(shop_id: int, dimension: str, start_date, end_date, nm_id=None):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, cube_slice, shop_id, dimension, start_date, end_date, nm_id)
+
+
+def cube_window(days: int, now=None):
+    """Последние days дней, включая сегодняшний"""
+    end = now or datetime.utcnow()
+    return end - timedelta(days=days - 1), end
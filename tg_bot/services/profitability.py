@@ -0,0 +1,327 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from sqlalchemy import func
+
+from tg_bot.models import sessionmaker, engine, ProductCost, Advertisement, ArticleProfitability
+from tg_bot.services.data_versions import get_data_version
+from tg_bot.services.shop_dataset import shop_datasets
+
+logger = logging.getLogger(__name__)
+
+# Окно оценки доходности артикула
+PROFITABILITY_DAYS = 30
+PROFITABILITY_PERIODS = ("30d", "month")
+
+PROFITABILITY_LEVELS = [
+    {
+        "min": -float("inf"),
+        "max": 20,
+        "name": "⚠️ Низкая доходность",
+        "characteristics": "Плохая рентабельность, высокие риски или низкая маржинальность.",
+        "reasons": "Высокая конкуренция, большие расходы на логистику/хранение, низкие наценки.",
+        "conclusion": "Такой бизнес невыгоден, нужно пересматривать модель.",
+        "recommendations": [
+            "Срочно пересмотрите ценовую политику и себестоимость.",
+            "Ищите более выгодных поставщиков или сокращайте логистические издержки.",
+            "Проверьте скрытые расходы (хранение, возвраты, реклама) и оптимизируйте их.",
+            "Если рост невозможен – рассмотрите закрытие или смену ниши.",
+        ],
+        "action": "Оптимизировать или уходить",
+    },
+    {
+        "min": 20,
+        "max": 40,
+        "name": "⚠️ Ниже среднего",
+        "characteristics": "Минимально приемлемая рентабельность, но требует оптимизации.",
+        "reasons": "Средняя конкуренция, умеренные издержки.",
+        "conclusion": "Высокий риск уйти в ноль или минус из-за внешних факторов.",
+        "recommendations": [
+            "Увеличивайте маржу через улучшение упаковки, допродажи или брендинг.",
+            "Автоматизируйте процессы для снижения операционных затрат.",
+            "Тестируйте новые рекламные каналы для увеличения продаж.",
+            "Анализируйте конкурентов на предмет более выгодных товаров.",
+        ],
+        "action": "Улучшать и тестировать другие товары",
+    },
+    {
+        "min": 40,
+        "max": 60,
+        "name": "✅ Средняя доходность",
+        "characteristics": "Нормальный уровень для стабильного бизнеса.",
+        "reasons": "Хороший спрос, грамотное ценообразование, контроль затрат.",
+        "conclusion": "Устойчивый бизнес, можно масштабировать.",
+        "recommendations": [
+            "Фокусируйтесь на стабильности: контролируйте качество и сервис.",
+            "Расширяйте ассортимент в нише для увеличения среднего чека.",
+            "Инвестируйте в лояльность клиентов (отзывы, рассылки).",
+            "Тестируйте смежные ниши с более высокой маржой.",
+        ],
+        "action": "Закрепляться и расти",
+    },
+    {
+        "min": 60,
+        "max": 100,
+        "name": "🔥 Высокая доходность",
+        "characteristics": "Очень хорошая рентабельность, перспективный бизнес.",
+        "reasons": "Уникальный товар, низкая конкуренция, эффективные рекламные каналы.",
+        "conclusion": "Отличный результат, стоит вкладывать больше ресурсов.",
+        "recommendations": [
+            "Активно масштабируйте: выходите на новые маркетплейсы или рынки.",
+            "Усиливайте бренд и работайте с повторными продажами.",
+            "Диверсифицируйте поставщиков для снижения рисков.",
+            "Инвестируйте часть прибыли в новые высокомаржинальные товары.",
+        ],
+        "action": "Масштабировать и защищать",
+    },
+    {
+        "min": 100,
+        "max": float("inf"),
+        "name": "✨ Премиальная доходность",
+        "characteristics": "Высокомаржинальный бизнес, часто нишевый.",
+        "reasons": "Эксклюзивные товары, VIP-сегмент, отсутствие прямых аналогов.",
+        "conclusion": "Редкий и ценный кейс, требует защиты позиций.",
+        "recommendations": [
+            "Укрепляйте эксклюзивность через товарный знак и уникальные условия с поставщиками.",
+            "Создавайте финансовую подушку безопасности.",
+            "Масштабируйте до точки максимальной эффективности.",
+            "Мониторьте динамику прибыли и будьте готовы к поиску новых товаров.",
+        ],
+        "action": "Укреплять позиции или выжимать все соки",
+    },
+]
+
+
+def get_profitability_level(profitability):
+    """Определение уровня доходности по проценту рентабельности"""
+    for level in PROFITABILITY_LEVELS:
+        if level["min"] <= profitability < level["max"]:
+            return level
+    return PROFITABILITY_LEVELS[0]  # По умолчанию низкая доходность
+
+
+# Верхние границы уровней: searchsorted по ним даёт тот же уровень, что get_profitability_level
+_LEVEL_BOUNDS = np.array([level["max"] for level in PROFITABILITY_LEVELS[:-1]])
+
+
+def period_window(period: str, now=None):
+    """Начало и конец окна: последние PROFITABILITY_DAYS дней или текущий месяц"""
+    now = now or datetime.utcnow()
+    if period == "month":
+        return now.replace(day=1, hour=0, minute=0, second=0, microsecond=0), now
+    return now - timedelta(days=PROFITABILITY_DAYS), now
+
+
+class ProfitabilityIndex:
+    """Суммы за окно по артикулам (nm_id) и общие по магазину.
+
+    Логистика и хранение магазина считаются один раз и делятся между артикулами
+    пропорционально выручке.
+    """
+
+    def __init__(self, frame, start_date, end_date):
+        window = frame.between(start_date, end_date)
+        commission = window.col("ppvz_sales_commission") + window.col("ppvz_vw") + window.col("ppvz_vw_nds")
+        self.nm_ids, self.revenue = window.group_sum("nm_id", window.col("retail_price_withdisc_rub"))
+        _, self.quantity = window.group_sum("nm_id", window.col("quantity"))
+        _, self.commission = window.group_sum("nm_id", commission)
+        is_sale = window.contains("doc_type_name", "продажа", "sale")
+        is_return = window.contains("doc_type_name", "возврат", "return") & ~is_sale
+        _, self.sales = window.group_sum("nm_id", window.col("quantity") * is_sale)
+        _, self.returns = window.group_sum("nm_id", window.col("quantity") * is_return)
+        # Артикул продавца по первой строке nm_id
+        _, first = np.unique(window.nm_id, return_index=True)
+        names = np.asarray(window.vocabs["sa_name"].values, dtype=object)
+        self.articles = names[window.codes["sa_name"][first]] if len(first) else names[:0]
+
+        self.total_logistics = window.sum("delivery_rub")
+        self.total_storage = window.sum("storage_fee")
+        self.total_revenue = window.sum("retail_price_withdisc_rub")
+
+    def __len__(self):
+        return len(self.nm_ids)
+
+    def table(self, cost_per_item):
+        """Показатели всех артикулов массивами; cost_per_item — массив по nm_ids"""
+        share = self.revenue / self.total_revenue if self.total_revenue else np.zeros(len(self))
+        # Знак комиссии как в исходном расчёте по строкам WB
+        commission = -self.commission
+        logistics = self.total_logistics * share
+        storage = self.total_storage * share
+        cost = cost_per_item * self.quantity
+        expenses = commission + logistics + storage + cost
+        net_profit = self.revenue - expenses
+        profitability = np.divide(
+            net_profit * 100, self.revenue, out=np.zeros(len(self)), where=self.revenue != 0
+        )
+        return {
+            "revenue": self.revenue,
+            "cost": cost,
+            "commission": commission,
+            "logistics": logistics,
+            "storage": storage,
+            "expenses": expenses,
+            "net_profit": net_profit,
+            "profitability": profitability,
+            "level": np.searchsorted(_LEVEL_BOUNDS, profitability, side="right"),
+        }
+
+
+def shop_costs(session, shop_id: int) -> dict:
+    return dict(
+        session.query(ProductCost.article, ProductCost.cost).filter(ProductCost.shop_id == shop_id)
+    )
+
+
+def shop_adverts(session, shop_id: int, start_date, end_date) -> dict:
+    return dict(
+        session.query(Advertisement.nmId, func.sum(Advertisement.amount))
+        .filter(
+            Advertisement.shop_id == shop_id,
+            Advertisement.date >= start_date,
+            Advertisement.date <= end_date,
+        )
+        .group_by(Advertisement.nmId)
+    )
+
+
+def refresh_profitability(session, shop_id: int, frame=None):
+    """Пересчитывает таблицу доходности магазина за все окна (коммит делает вызывающий код)"""
+    if frame is None:
+        frame = shop_datasets.get(shop_id)
+    report_version = get_data_version(session, shop_id)[0]
+    cost_version = get_data_version(session, shop_id, "cost")[0]
+    costs = shop_costs(session, shop_id)
+    now = datetime.utcnow()
+
+    records = []
+    for period in PROFITABILITY_PERIODS:
+        start_date, end_date = period_window(period, now)
+        index = ProfitabilityIndex(frame, start_date, end_date)
+        adverts = shop_adverts(session, shop_id, start_date, end_date)
+        # Себестоимость ищем по nm_id, затем по артикулу продавца
+        cost_per_item = np.array(
+            [costs.get(str(nm_id), costs.get(article, 0)) for nm_id, article in zip(index.nm_ids, index.articles)],
+            dtype=float,
+        )
+        table = index.table(cost_per_item)
+        for i, nm_id in enumerate(index.nm_ids):
+            if not nm_id:
+                continue  # строки без товара (хранение, штрафы)
+            records.append({
+                "shop_id": shop_id,
+                "period": period,
+                "nm_id": int(nm_id),
+                "article": index.articles[i] or None,
+                "quantity": int(index.quantity[i]),
+                "sales": int(index.sales[i]),
+                "returns": int(index.returns[i]),
+                "advert": abs(adverts.get(int(nm_id)) or 0),
+                "cost_per_item": float(cost_per_item[i]),
+                "report_version": report_version,
+                "cost_version": cost_version,
+                "computed_on": now.date(),
+                **{name: float(table[name][i]) for name in (
+                    "revenue", "cost", "commission", "logistics", "storage", "net_profit", "profitability"
+                )},
+                "level": int(table["level"][i]),
+            })
+
+    session.query(ArticleProfitability).filter(ArticleProfitability.shop_id == shop_id).delete(
+        synchronize_session=False
+    )
+    if records:
+        session.bulk_insert_mappings(ArticleProfitability, records)
+    logger.info(f"Shop {shop_id}: profitability table v{report_version} ({len(records)} rows)")
+    return len(records)
+
+
+def ensure_profitability(session, shop_id: int):
+    """Пересчёт, если таблица посчитана на старые данные, себестоимость или вчерашний день"""
+    state = (
+        session.query(
+            ArticleProfitability.report_version,
+            ArticleProfitability.cost_version,
+            ArticleProfitability.computed_on,
+        )
+        .filter(ArticleProfitability.shop_id == shop_id)
+        .first()
+    )
+    current = (
+        get_data_version(session, shop_id)[0],
+        get_data_version(session, shop_id, "cost")[0],
+        datetime.utcnow().date(),
+    )
+    if state is None or tuple(state) != current:
+        refresh_profitability(session, shop_id)
+        session.commit()
+
+
+def profitability_rows(shop_id: int, period: str = "30d", level=None, order_by="net_profit", limit=None):
+    """Строки таблицы доходности: фильтр по уровню и сортировка по убыванию колонки"""
+    session = sessionmaker(bind=engine)()
+    try:
+        ensure_profitability(session, shop_id)
+        query = session.query(ArticleProfitability).filter(
+            ArticleProfitability.shop_id == shop_id, ArticleProfitability.period == period
+        )
+        if level is not None:
+            query = query.filter(ArticleProfitability.level == level)
+        query = query.order_by(getattr(ArticleProfitability, order_by).desc())
+        if limit:
+            query = query.limit(limit)
+        rows = query.all()
+        session.expunge_all()
+        return rows
+    finally:
+        session.close()
+
+
+def row_metrics(row) -> dict:
+    """Показатели строки таблицы в виде, который ждут экраны аналитики"""
+    return {
+        "revenue": row.revenue,
+        "cost": row.cost,
+        "commission": row.commission,
+        "logistics": row.logistics,
+        "storage": row.storage,
+        "expenses": row.commission + row.logistics + row.storage + row.cost,
+        "net_profit": row.net_profit,
+        "profitability": row.profitability,
+        "quantity": row.quantity,
+        "cost_per_item": row.cost_per_item,
+        "level": row.level,
+    }
+
+
+def article_profitability(shop_id: int, nm_id: int, period: str = "30d"):
+    """Доходность артикула из таблицы или None, если продаж в окне не было"""
+    session = sessionmaker(bind=engine)()
+    try:
+        ensure_profitability(session, shop_id)
+        row = (
+            session.query(ArticleProfitability)
+            .filter(
+                ArticleProfitability.shop_id == shop_id,
+                ArticleProfitability.period == period,
+                ArticleProfitability.nm_id == nm_id,
+            )
+            .first()
+        )
+        return row_metrics(row) if row is not None else None
+    finally:
+        session.close()
+
+
+async def get_article_profitability(shop_id: int, nm_id: int, period: str = "30d"):
+    """article_profitability без блокировки event loop на пересчёте таблицы"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, article_profitability, shop_id, nm_id, period)
+
+
+async def get_profitability_rows(shop_id: int, period: str = "30d", level=None, order_by="net_profit", limit=None):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, profitability_rows, shop_id, period, level, order_by, limit)
@@ -0,0 +1,137 @@
+import heapq
+import asyncio
+import threading
+
+import numpy as np
+
+from tg_bot.models import sessionmaker, engine, ArticleProfitability
+from tg_bot.services.profitability import ensure_profitability
+
+RANKING_PAGE_SIZE = 5
+
+
+def _ratio(numerator, denominator, scale=1):
+    """numerator / denominator; там, где знаменатель 0 — NaN (артикул в рейтинг не попадает)"""
+    return np.divide(
+        numerator * scale, denominator, out=np.full(len(numerator), np.nan), where=denominator != 0
+    )
+
+
+# Метрики рейтинга: название, формат значения и расчёт по колонкам таблицы доходности
+RANKING_METRICS = {
+    "profit": ("Чистая прибыль", "{:.2f} руб.", lambda c: c["net_profit"]),
+    "revenue": ("Выручка", "{:.2f} руб.", lambda c: c["revenue"]),
+    "margin": ("Рентабельность", "{:.1f}%", lambda c: _ratio(c["net_profit"], c["revenue"], 100)),
+    "ad_share": ("Доля рекламы", "{:.1f}%", lambda c: _ratio(c["advert"], c["revenue"], 100)),
+    "return_rate": ("Процент возвратов", "{:.1f}%", lambda c: _ratio(c["returns"], c["sales"], 100)),
+    "logistics_per_unit": ("Логистика на единицу", "{:.2f} руб.", lambda c: _ratio(c["logistics"], c["quantity"])),
+}
+
+_COLUMNS = ("nm_id", "article", "quantity", "sales", "returns", "revenue", "net_profit", "advert", "logistics")
+
+
+class ProductRanking:
+    """Колонки таблицы доходности магазина и рейтинги по ним.
+
+    Значения метрики считаются один раз на версию данных; страница рейтинга —
+    частичная сортировка кучей (heapq) по первым (page + 1) * size позициям.
+    """
+
+    def __init__(self, rows):
+        self.columns = {
+            name: np.array([getattr(row, name) or 0 for row in rows], dtype=float)
+            for name in _COLUMNS if name != "article"
+        }
+        self.articles = [row.article or str(row.nm_id) for row in rows]
+        self._values = {}
+        self._pages = {}
+
+    def values(self, metric):
+        values = self._values.get(metric)
+        if values is None:
+            values = self._values[metric] = RANKING_METRICS[metric][2](self.columns)
+        return values
+
+    def top(self, metric, limit, bottom=False):
+        """Индексы первых limit артикулов по метрике (по убыванию или по возрастанию)"""
+        key = (metric, bottom, limit)
+        cached = self._pages.get(key)
+        if cached is not None:
+            return cached
+        values = self.values(metric)
+        candidates = np.flatnonzero(~np.isnan(values)).tolist()
+        choose = heapq.nsmallest if bottom else heapq.nlargest
+        result = choose(limit, candidates, key=values.__getitem__)
+        self._pages[key] = result
+        return result
+
+    def page(self, metric, page=0, size=RANKING_PAGE_SIZE, bottom=False):
+        """Страница рейтинга: (элементы, есть ли следующая страница)"""
+        ranked = self.top(metric, (page + 1) * size + 1, bottom)
+        values = self.values(metric)
+        items = [
+            {
+                "place": page * size + i + 1,
+                "nm_id": int(self.columns["nm_id"][index]),
+                "article": self.articles[index],
+                "value": float(values[index]),
+                "revenue": float(self.columns["revenue"][index]),
+                "profit": float(self.columns["net_profit"][index]),
+                "quantity": int(self.columns["quantity"][index]),
+            }
+            for i, index in enumerate(ranked[page * size:(page + 1) * size])
+        ]
+        return items, len(ranked) > (page + 1) * size
+
+
+class RankingStore:
+    """Рейтинги магазинов по версии таблицы доходности (отчёт, себестоимость, день)"""
+
+    def __init__(self):
+        self._rankings = {}
+        self._lock = threading.Lock()
+
+    def get(self, shop_id: int, period: str = "30d") -> ProductRanking:
+        session = sessionmaker(bind=engine)()
+        try:
+            ensure_profitability(session, shop_id)
+            state = (
+                session.query(
+                    ArticleProfitability.report_version,
+                    ArticleProfitability.cost_version,
+                    ArticleProfitability.computed_on,
+                )
+                .filter(ArticleProfitability.shop_id == shop_id)
+                .first()
+            )
+            key = (period, tuple(state) if state is not None else None)
+            with self._lock:
+                cached = self._rankings.get(shop_id, {}).get(period)
+                if cached is not None and cached[0] == key:
+                    return cached[1]
+            rows = (
+                session.query(*[getattr(ArticleProfitability, name) for name in _COLUMNS])
+                .filter(ArticleProfitability.shop_id == shop_id, ArticleProfitability.period == period)
+                .all()
+            )
+            ranking = ProductRanking(rows)
+            with self._lock:
+                self._rankings.setdefault(shop_id, {})[period] = (key, ranking)
+            return ranking
+        finally:
+            session.close()
+
+
+ranking_store = RankingStore()
+
+
+def rank_products(shop_id: int, metric: str = "profit", page: int = 0, size: int = RANKING_PAGE_SIZE,
+                  bottom: bool = False, period: str = "30d"):
+    """Топ (или антитоп) артикулов магазина по метрике: (элементы, есть ли следующая страница)"""
+    return ranking_store.get(shop_id, period).page(metric, page, size, bottom)
+
+
+async def get_ranked_products(shop_id: int, metric: str = "profit", page: int = 0, size: int = RANKING_PAGE_SIZE,
+                              bottom: bool = False, period: str = "30d"):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, rank_products, shop_id, metric, page, size, bottom, period)
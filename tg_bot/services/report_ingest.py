@@ -0,0 +1,181 @@
+import time
+import logging
+from datetime import datetime
+
+import requests
+from sqlalchemy import func, case
+
+from tg_bot.models import ReportRow, ReportDaily, IngestCheckpoint
+from tg_bot.services.report_projection import upsert_report_rows, parse_day
+from tg_bot.services.checkpoints import get_checkpoint, advance_checkpoint, complete_checkpoint
+from tg_bot.services.wb_api import rate_budget
+from tg_bot.services.dedup import dedup_rows
+from tg_bot.services.funnel import FunnelRefresh
+
+logger = logging.getLogger(__name__)
+
+REPORT_URL = "https://statistics-api.wildberries.ru/api/v5/supplier/reportDetailByPeriod"
+REPORT_ENDPOINT = "reportDetailByPeriod"
+# Начало истории отчётов, которую загружаем
+REPORT_HISTORY_START = datetime(year=2024, month=1, day=29)
+MAX_PAGES = 1000
+
+
+def fetch_report_pages(api_token: str, date_from: datetime, date_to: datetime, rrd_id: int = 0, retries: int = 3):
+    """Генератор страниц reportDetailByPeriod начиная после rrd_id.
+
+    В памяти держится только текущая страница; пагинация по rrdid последней строки.
+    Запросы идут в пределах бюджета токена (общего для всех процессов).
+    """
+    headers = {"Authorization": api_token}
+    budget = rate_budget(api_token)
+    for _ in range(MAX_PAGES):
+        params = {
+            "dateFrom": date_from.strftime("%Y-%m-%d"),
+            "dateTo": date_to.strftime("%Y-%m-%d"),
+            "rrdid": rrd_id
+        }
+        page = None
+        for attempt in range(retries):
+            budget.acquire()
+            try:
+                response = requests.get(REPORT_URL, headers=headers, params=params, timeout=30)
+                if response.status_code == 200:
+                    page = response.json() or []
+                    break
+
+                if response.status_code == 429:
+                    retry_after = int(response.headers.get('X-Ratelimit-Retry', 54))
+                    logger.warning(f"API limit exceeded. Retrying after {retry_after} seconds")
+                    time.sleep(retry_after)
+                    continue
+
+                logger.warning(f"API error: {response.status_code}, attempt {attempt + 1}")
+            except requests.exceptions.RequestException as e:
+                logger.error(f"Request error: {e}, attempt {attempt + 1}")
+            except Exception as e:
+                logger.error(f"Unknown error: {e}, attempt {attempt + 1}")
+
+        if page is None:
+            raise RuntimeError(f"Failed to fetch report page after rrdid={rrd_id}")
+        if not page:
+            return
+        rrd_id = page[-1]["rrd_id"]
+        # Между страницами повторов нет (rrdid строго растёт), внутри страницы —
+        # схлопываем: один INSERT ... ON CONFLICT не может обновить строку дважды
+        yield dedup_rows(page)
+
+
+def refresh_daily_rollups(session, shop_id: int, days):
+    """Пересчитывает дневные агрегаты за затронутые дни из report_rows (идемпотентно)"""
+    days = sorted(set(days))
+    if not days:
+        return
+    session.query(ReportDaily).filter(
+        ReportDaily.shop_id == shop_id, ReportDaily.day.in_(days)
+    ).delete(synchronize_session=False)
+    rows = (
+        session.query(
+            ReportRow.day,
+            func.count(ReportRow.id),
+            func.sum(ReportRow.quantity),
+            func.sum(case((ReportRow.doc_type_name == "Продажа", ReportRow.quantity), else_=0)),
+            func.sum(case((ReportRow.doc_type_name == "Возврат", ReportRow.quantity), else_=0)),
+            func.sum(ReportRow.retail_price_withdisc_rub * ReportRow.quantity),
+            func.sum(ReportRow.ppvz_for_pay),
+            func.sum(ReportRow.delivery_rub),
+            func.sum(ReportRow.storage_fee),
+            func.sum(ReportRow.deduction),
+        )
+        .filter(ReportRow.shop_id == shop_id, ReportRow.day.in_(days))
+        .group_by(ReportRow.day)
+        .all()
+    )
+    for day, count, quantity, sales, returns, retail, for_pay, delivery, storage, deduction in rows:
+        session.add(ReportDaily(
+            shop_id=shop_id,
+            day=day,
+            rows=count,
+            quantity=quantity or 0,
+            sales_quantity=sales or 0,
+            returns_quantity=returns or 0,
+            retail_amount=retail or 0,
+            for_pay=for_pay or 0,
+            delivery=delivery or 0,
+            storage=storage or 0,
+            deduction=deduction or 0,
+        ))
+
+
+def ingest_pages(session, shop_id: int, pages, checkpoint=None, funnel=None):
+    """fetch -> проекция -> upsert -> агрегаты -> чекпоинт -> commit, по одной странице.
+
+    Генератор: отдаёт (номер страницы, строк на странице, последний rrd_id).
+    srid страниц копятся в funnel, воронка пересчитывается после загрузки.
+    Версию данных поднимает вызывающий код — один раз после загрузки.
+    """
+    for number, page in enumerate(pages, 1):
+        upsert_report_rows(session, shop_id, page)
+        refresh_daily_rollups(session, shop_id, (parse_day(row.get("sale_dt")) for row in page))
+        if funnel is not None:
+            funnel.add(row.get("srid") for row in page)
+        if checkpoint is not None:
+            advance_checkpoint(checkpoint, page[-1]["rrd_id"], len(page))
+        session.commit()
+        yield number, len(page), page[-1]["rrd_id"]
+
+
+def stored_rrd_id(session, shop_id: int) -> int:
+    """Последний загруженный rrd_id магазина (0 — строк нет)"""
+    return session.query(func.max(ReportRow.rrd_id)).filter(ReportRow.shop_id == shop_id).scalar() or 0
+
+
+def backfill_checkpoints(session, shop_id: int, updated_before=None):
+    """Незавершённые окна истории (закрытые диапазоны), опционально — не обновлявшиеся с updated_before"""
+    query = session.query(IngestCheckpoint).filter(
+        IngestCheckpoint.shop_id == shop_id,
+        IngestCheckpoint.endpoint == REPORT_ENDPOINT,
+        IngestCheckpoint.date_to.isnot(None),
+        IngestCheckpoint.completed.is_(False),
+    )
+    if updated_before is not None:
+        query = query.filter(IngestCheckpoint.updated_at < updated_before)
+    return query.order_by(IngestCheckpoint.date_to.desc()).all()
+
+
+def ingest_shop_report(session, shop, date_from=None, date_to=None):
+    """Потоковая загрузка отчёта магазина; возвращает число загруженных строк.
+
+    Продолжает с чекпоинта (магазин, метод, диапазон дат). Без date_to диапазон
+    открыт до текущего дня: чекпоинт работает как курсор и не завершается.
+    Версию данных поднимает вызывающий код, если строки загружены.
+    """
+    date_from = date_from or REPORT_HISTORY_START
+    checkpoint = get_checkpoint(session, shop.id, REPORT_ENDPOINT, date_from, date_to)
+    if checkpoint.completed:
+        return 0
+    if date_to is None and not checkpoint.last_rrd_id:
+        # Историю нового магазина грузит backfill окнами, свежие — первыми:
+        # курсор продолжает после загруженных строк, а не с начала истории
+        checkpoint.last_rrd_id = stored_rrd_id(session, shop.id)
+        if not checkpoint.last_rrd_id and backfill_checkpoints(session, shop.id):
+            session.rollback()
+            return 0
+    if checkpoint.last_rrd_id:
+        logger.info(f"Shop {shop.id}: resuming {REPORT_ENDPOINT} after rrd_id {checkpoint.last_rrd_id}")
+    # Транзакция не должна быть открыта во время запросов: бюджет токена тоже пишет в БД
+    session.commit()
+
+    total = 0
+    funnel = FunnelRefresh()
+    pages = fetch_report_pages(shop.api_token, date_from, date_to or datetime.now(), checkpoint.last_rrd_id)
+    for number, count, rrd_id in ingest_pages(session, shop.id, pages, checkpoint, funnel):
+        total += count
+        logger.info(f"Shop {shop.id}: page {number}, {count} rows (rrd_id {rrd_id})")
+
+    if total:
+        funnel.apply(session, shop.id)
+    if date_to is not None:
+        complete_checkpoint(checkpoint)
+    session.commit()
+    return total
@@ -0,0 +1,127 @@
+import os
+import json
+import zlib
+import hashlib
+import logging
+from datetime import date
+
+from sqlalchemy.dialects.sqlite import insert
+
+from tg_bot.models import ReportRow, ReportArchive
+
+logger = logging.getLogger(__name__)
+
+# Проекция строки reportDetailByPeriod: из ~80 полей храним только те, что читает аналитика.
+# Деньги — целые копейки, дата продажи — порядковый номер дня, повторяющиеся строки интернируются.
+MONEY_FIELDS = (
+    "retail_price_withdisc_rub",
+    "ppvz_for_pay",
+    "ppvz_reward",
+    "ppvz_sales_commission",
+    "ppvz_vw",
+    "ppvz_vw_nds",
+    "delivery_rub",
+    "rebill_logistic_cost",
+    "storage_fee",
+    "deduction",
+)
+COUNT_FIELDS = ("quantity",)
+NUMERIC_FIELDS = COUNT_FIELDS + MONEY_FIELDS
+STRING_FIELDS = (
+    "sa_name",
+    "subject_name",
+    "doc_type_name",
+    "bonus_type_name",
+)
+
+# Архивировать исходные страницы отчёта (zlib) — выключено по умолчанию
+ARCHIVE_RAW_REPORTS = os.getenv("REPORT_ARCHIVE_RAW", "0") == "1"
+
+# Строк в одном INSERT (ограничение SQLite на число параметров)
+UPSERT_CHUNK = 500
+
+_strings = {}
+
+
+def intern_string(value):
+    """Одна копия каждой строки на процесс (предметы, типы документов повторяются).
+
+    Только для полей с небольшим числом значений: словарь живёт, пока живёт процесс.
+    """
+    if value is None:
+        return ""
+    if not isinstance(value, str):
+        value = str(value)
+    return _strings.setdefault(value, value)
+
+
+def srid_key(value) -> int:
+    """srid в колонках в памяти и в снапшоте: стабильный 64-битный хэш (0 — пустой srid).
+
+    srid почти уникален для строки, словарь таких строк занимал бы память
+    процесса и заголовок снапшота.
+    """
+    if not value:
+        return 0
+    digest = hashlib.blake2b(str(value).encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little", signed=True)
+
+
+def to_kopecks(value):
+    return int(round((value or 0) * 100))
+
+
+def parse_day(sale_dt):
+    """Порядковый номер дня из sale_dt (0, если дата не разбирается)"""
+    try:
+        return date.fromisoformat(sale_dt[:10]).toordinal()
+    except (TypeError, ValueError):
+        return 0
+
+
+def project_row(row: dict) -> dict:
+    """Строка WB API -> компактная строка проекции"""
+    projected = {
+        "rrd_id": row.get("rrd_id") or 0,
+        "day": parse_day(row.get("sale_dt")),
+        "nm_id": row.get("nm_id") or 0,
+        "quantity": int(row.get("quantity") or 0),
+        "srid": str(row.get("srid") or ""),
+    }
+    for name in MONEY_FIELDS:
+        projected[name] = to_kopecks(row.get(name))
+    for name in STRING_FIELDS:
+        projected[name] = intern_string(row.get(name))
+    return projected
+
+
+def upsert_report_rows(session, shop_id: int, rows):
+    """Проецирует и сохраняет строки отчёта (повторная загрузка rrd_id перезаписывает строку)"""
+    projected = [dict(project_row(row), shop_id=shop_id) for row in rows]
+    for start in range(0, len(projected), UPSERT_CHUNK):
+        chunk = projected[start:start + UPSERT_CHUNK]
+        stmt = insert(ReportRow).values(chunk)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["shop_id", "rrd_id"],
+            set_={name: stmt.excluded[name] for name in chunk[0] if name not in ("shop_id", "rrd_id")},
+        )
+        session.execute(stmt)
+    if ARCHIVE_RAW_REPORTS and rows:
+        archive_raw_rows(session, shop_id, rows)
+    return len(projected)
+
+
+def archive_raw_rows(session, shop_id: int, rows):
+    """Сжатая копия исходных строк WB (для разборов и перепроекции)"""
+    rrd_ids = [row.get("rrd_id") or 0 for row in rows]
+    payload = zlib.compress(json.dumps(rows, ensure_ascii=False).encode("utf-8"), 6)
+    session.add(ReportArchive(
+        shop_id=shop_id,
+        rrd_from=min(rrd_ids),
+        rrd_to=max(rrd_ids),
+        payload=payload,
+    ))
+
+
+def load_raw_rows(archive: ReportArchive):
+    return json.loads(zlib.decompress(archive.payload).decode("utf-8"))
@@ -0,0 +1,368 @@
+import os
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import numpy as np
+
+from tg_bot.models import sessionmaker, engine, CashedShopData, ReportRow
+from tg_bot.services.data_versions import get_data_version
+from tg_bot.services.snapshots import read_snapshot, write_snapshot
+from tg_bot.services.dedup import dedup_rows
+from tg_bot.services.report_projection import (
+    MONEY_FIELDS,
+    NUMERIC_FIELDS,
+    STRING_FIELDS,
+    project_row,
+    srid_key,
+)
+
+logger = logging.getLogger(__name__)
+
+PROMOTION_BONUS_TYPE = "Оказание услуг «ВБ.Продвижение»"
+
+# Бюджет памяти на все магазины в процессе бота
+DATASET_MEMORY_BUDGET = int(os.getenv("SHOP_DATASET_MEMORY_MB", 256)) * 1024 * 1024
+
+
+def day_ordinal(value):
+    """Порядковый номер дня для date/datetime"""
+    if isinstance(value, datetime):
+        value = value.date()
+    return value.toordinal()
+
+
+def _first_day(value):
+    """Первый день, попадающий в фильтр sale_dt >= value (sale_dt — полночь)"""
+    if isinstance(value, datetime) and value.time() != datetime.min.time():
+        return day_ordinal(value) + 1
+    return day_ordinal(value)
+
+
+class StringVocab:
+    """Словарное кодирование строковой колонки (код 0 — пустая строка)"""
+
+    def __init__(self):
+        self.values = [""]
+        self._codes = {"": 0}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_values(cls, values):
+        vocab = cls()
+        vocab.values = list(values) or [""]
+        vocab._codes = {v: i for i, v in enumerate(vocab.values)}
+        return vocab
+
+    def __len__(self):
+        return len(self.values)
+
+    def encode(self, value):
+        if value is None:
+            return 0
+        if not isinstance(value, str):
+            value = str(value)
+        code = self._codes.get(value)
+        if code is None:
+            with self._lock:
+                code = self._codes.get(value)
+                if code is None:
+                    code = len(self.values)
+                    self.values.append(value)
+                    self._codes[value] = code
+        return code
+
+    def code(self, value):
+        """Код значения или -1, если такого значения нет"""
+        return self._codes.get(value, -1)
+
+    def lookup_table(self, predicate):
+        """Булева таблица code -> predicate(value) для векторных фильтров"""
+        return np.fromiter((predicate(v) for v in self.values), dtype=bool, count=len(self.values))
+
+
+class ReportFrame:
+    """Строки детального отчёта WB в колоночном виде (массивы NumPy).
+    Денежные колонки хранятся в копейках (int64), col()/sum() отдают рубли.
+    srid — хэши (см. report_projection.srid_key): нужны только для сравнения строк."""
+
+    def __init__(self, day, rrd_id, nm_id, srid, numeric, codes, vocabs):
+        self.day = day
+        self.rrd_id = rrd_id
+        self.nm_id = nm_id
+        self.srid = srid
+        self.numeric = numeric
+        self.codes = codes
+        self.vocabs = vocabs
+
+    @staticmethod
+    def new_vocabs():
+        return {name: StringVocab() for name in STRING_FIELDS}
+
+    @classmethod
+    def from_rows(cls, rows, vocabs=None):
+        """Строит фрейм из строк отчёта (список словарей из WB API, повторы rrd_id схлопываются)"""
+        return cls.from_records([project_row(r) for r in dedup_rows(rows)], vocabs)
+
+    @classmethod
+    def from_records(cls, records, vocabs=None):
+        """Строит фрейм из строк проекции (см. report_projection.project_row)"""
+        vocabs = vocabs or cls.new_vocabs()
+        count = len(records)
+
+        def column(name, dtype):
+            return np.fromiter((r[name] or 0 for r in records), dtype=dtype, count=count)
+
+        numeric = {name: column(name, np.int64) for name in MONEY_FIELDS}
+        numeric["quantity"] = column("quantity", np.int32)
+        codes = {
+            name: np.fromiter((vocabs[name].encode(r[name]) for r in records), dtype=np.int32, count=count)
+            for name in STRING_FIELDS
+        }
+        return cls(
+            column("day", np.int32),
+            column("rrd_id", np.int64),
+            column("nm_id", np.int64),
+            np.fromiter((srid_key(r["srid"]) for r in records), dtype=np.int64, count=count),
+            {name: numeric[name] for name in NUMERIC_FIELDS},
+            codes,
+            vocabs,
+        )
+
+    @classmethod
+    def from_db(cls, session, shop_id, after_rrd_id=0, vocabs=None):
+        """Строки магазина из report_rows (rrd_id > after_rrd_id) в порядке rrd_id"""
+        names = ("rrd_id", "day", "nm_id", "srid") + NUMERIC_FIELDS + STRING_FIELDS
+        query = (
+            session.query(*[getattr(ReportRow, name) for name in names])
+            .filter(ReportRow.shop_id == shop_id, ReportRow.rrd_id > after_rrd_id)
+            .order_by(ReportRow.rrd_id)
+        )
+        return cls.from_records([r._mapping for r in query.all()], vocabs)
+
+    def to_arrays(self):
+        """Колонки и таблицы строк для записи снапшота"""
+        arrays = {"day": self.day, "rrd_id": self.rrd_id, "nm_id": self.nm_id, "srid": self.srid}
+        arrays.update({f"num:{name}": a for name, a in self.numeric.items()})
+        arrays.update({f"str:{name}": a for name, a in self.codes.items()})
+        strings = {name: list(vocab.values) for name, vocab in self.vocabs.items()}
+        return arrays, strings
+
+    @classmethod
+    def from_arrays(cls, arrays, strings):
+        """Фрейм поверх готовых колонок (например, отображённых в память)"""
+        return cls(
+            arrays["day"],
+            arrays["rrd_id"],
+            arrays["nm_id"],
+            arrays["srid"],
+            {name: arrays[f"num:{name}"] for name in NUMERIC_FIELDS},
+            {name: arrays[f"str:{name}"] for name in STRING_FIELDS},
+            {name: StringVocab.from_values(strings[name]) for name in STRING_FIELDS},
+        )
+
+    def __len__(self):
+        return len(self.day)
+
+    def _arrays(self):
+        return [self.day, self.rrd_id, self.nm_id, self.srid, *self.numeric.values(), *self.codes.values()]
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in self._arrays())
+
+    @property
+    def resident_nbytes(self):
+        """Память процесса без колонок, отображённых из снапшота (они в page cache)"""
+        return sum(a.nbytes for a in self._arrays() if not isinstance(a, np.memmap))
+
+    @property
+    def max_rrd_id(self):
+        return int(self.rrd_id.max()) if len(self) else 0
+
+    def take(self, index):
+        """Подмножество строк по булевой маске или массиву индексов"""
+        return ReportFrame(
+            self.day[index],
+            self.rrd_id[index],
+            self.nm_id[index],
+            self.srid[index],
+            {name: a[index] for name, a in self.numeric.items()},
+            {name: a[index] for name, a in self.codes.items()},
+            self.vocabs,
+        )
+
+    def append(self, other):
+        """Новый фрейм из строк self и other (словари должны совпадать)"""
+        return ReportFrame(
+            np.concatenate([self.day, other.day]),
+            np.concatenate([self.rrd_id, other.rrd_id]),
+            np.concatenate([self.nm_id, other.nm_id]),
+            np.concatenate([self.srid, other.srid]),
+            {name: np.concatenate([a, other.numeric[name]]) for name, a in self.numeric.items()},
+            {name: np.concatenate([a, other.codes[name]]) for name, a in self.codes.items()},
+            self.vocabs,
+        )
+
+    def between(self, start, end):
+        """Строки с sale_dt в [start; end] (как сравнение с полуночью дня продажи)"""
+        mask = (self.day >= _first_day(start)) & (self.day <= day_ordinal(end))
+        return self.take(mask)
+
+    def count_between(self, start, end):
+        return int(((self.day >= _first_day(start)) & (self.day <= day_ordinal(end))).sum())
+
+    def on_day(self, day):
+        return self.take(self.day == day_ordinal(day))
+
+    def col(self, name):
+        values = self.numeric[name]
+        return values / 100 if name in MONEY_FIELDS else values
+
+    def sum(self, name):
+        total = int(self.numeric[name].sum())
+        return total / 100 if name in MONEY_FIELDS else float(total)
+
+    def strings(self, name):
+        """Декодированная строковая колонка"""
+        values = np.asarray(self.vocabs[name].values, dtype=object)
+        return values[self.codes[name]]
+
+    def contains(self, name, *needles):
+        """Маска строк, где значение колонки содержит одну из подстрок (без учёта регистра)"""
+        table = self.vocabs[name].lookup_table(
+            lambda v: any(n in v.lower() for n in needles)
+        )
+        return table[self.codes[name]]
+
+    def without(self, name, value):
+        """Фрейм без строк, где колонка равна value"""
+        return self.take(self.codes[name] != self.vocabs[name].code(value))
+
+    def group_sum(self, key, values):
+        """Суммы по группам: (ключи, суммы). key — nm_id или строковая колонка"""
+        keys = self.nm_id if key == "nm_id" else self.codes[key]
+        if not len(keys):
+            return keys[:0], np.zeros(0)
+        unique, inverse = np.unique(keys, return_inverse=True)
+        return unique, np.bincount(inverse, weights=values, minlength=len(unique))
+
+
+class _Entry:
+    __slots__ = ("version", "updated_at", "frame")
+
+    def __init__(self, version, updated_at, frame):
+        self.version = version
+        self.updated_at = updated_at
+        self.frame = frame
+
+
+class ShopDatasetStore:
+    """LRU-кэш колоночных отчётов магазинов с ограничением по памяти.
+
+    Данные загружаются при первом обращении и перечитываются, когда загрузчик
+    увеличивает версию данных магазина (DataVersion).
+    """
+
+    def __init__(self, budget_bytes: int):
+        self.budget_bytes = budget_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._shop_locks = {}
+
+    def _shop_lock(self, shop_id):
+        with self._lock:
+            return self._shop_locks.setdefault(shop_id, threading.Lock())
+
+    def get(self, shop_id: int) -> ReportFrame:
+        session = sessionmaker(bind=engine)()
+        try:
+            version, updated_at = get_data_version(session, shop_id)
+            with self._shop_lock(shop_id):
+                with self._lock:
+                    entry = self._entries.get(shop_id)
+                    if entry is not None:
+                        self._entries.move_to_end(shop_id)
+                if entry is not None and entry.version == version:
+                    return entry.frame
+                frame = self._load(session, shop_id, entry, version)
+                self._put(shop_id, _Entry(version, updated_at, frame))
+                return frame
+        finally:
+            session.close()
+
+    def freshness(self, shop_id: int):
+        """Время обновления данных, из которых построен фрейм"""
+        entry = self._entries.get(shop_id)
+        return entry.updated_at if entry else None
+
+    def invalidate(self, shop_id: int):
+        with self._lock:
+            self._entries.pop(shop_id, None)
+
+    @property
+    def nbytes(self):
+        return sum(e.frame.resident_nbytes for e in list(self._entries.values()))
+
+    def _load(self, session, shop_id, entry, version):
+        # Снапшот загрузчика: отображаем в память без разбора JSON
+        snapshot = read_snapshot(shop_id, version) if version else None
+        if snapshot is not None:
+            logger.info(f"Shop {shop_id}: mapped snapshot v{version}")
+            return ReportFrame.from_arrays(*snapshot)
+
+        if entry is not None and len(entry.frame):
+            # Догружаем только новые строки (rrd_id растёт от страницы к странице)
+            last_rrd = entry.frame.max_rrd_id
+            known = (
+                session.query(ReportRow)
+                .filter(ReportRow.shop_id == shop_id, ReportRow.rrd_id <= last_rrd)
+                .count()
+            )
+            if known == len(entry.frame):
+                fresh = ReportFrame.from_db(session, shop_id, last_rrd, entry.frame.vocabs)
+                logger.info(f"Shop {shop_id}: +{len(fresh)} rows to dataset")
+                return entry.frame.append(fresh)
+
+        frame = ReportFrame.from_db(session, shop_id)
+        if len(frame):
+            logger.info(f"Shop {shop_id}: loading dataset ({len(frame)} rows)")
+            return frame
+
+        # Магазины, ещё не перезагруженные в report_rows
+        cashed = session.query(CashedShopData).filter(CashedShopData.shop_id == shop_id).first()
+        rows = cashed.cashed_all if cashed and cashed.cashed_all else []
+        logger.info(f"Shop {shop_id}: loading legacy dataset ({len(rows)} rows)")
+        return ReportFrame.from_rows(rows)
+
+    def _put(self, shop_id, entry):
+        with self._lock:
+            self._entries[shop_id] = entry
+            self._entries.move_to_end(shop_id)
+            total = sum(e.frame.resident_nbytes for e in self._entries.values())
+            while total > self.budget_bytes and len(self._entries) > 1:
+                evicted_id, evicted = self._entries.popitem(last=False)
+                total -= evicted.frame.resident_nbytes
+                logger.info(f"Shop {evicted_id}: dataset evicted ({evicted.frame.resident_nbytes} bytes)")
+
+
+shop_datasets = ShopDatasetStore(DATASET_MEMORY_BUDGET)
+
+
+def publish_snapshot(session, shop_id: int, version: int) -> ReportFrame:
+    """Пишет снапшот отчёта магазина для процессов бота (вызывается загрузчиком).
+    Возвращает фрейм, из которого записан снапшот."""
+    frame = ReportFrame.from_db(session, shop_id)
+    try:
+        write_snapshot(shop_id, version, *frame.to_arrays())
+    except OSError as e:
+        logger.error(f"Shop {shop_id}: failed to write snapshot: {e}")
+    return frame
+
+
+async def get_shop_frame(shop_id: int) -> ReportFrame:
+    """Фрейм магазина без блокировки event loop на первой загрузке"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, shop_datasets.get, shop_id)
@@ -0,0 +1,159 @@
+import asyncio
+
+import numpy as np
+
+from tg_bot.models import sessionmaker, engine, ArticleProfitability
+from tg_bot.services.profitability import ensure_profitability
+from tg_bot.services.elasticity import shop_elasticities
+
+# Сетка по умолчанию: изменение цены и себестоимости от -30% до +30% с шагом 5% (169 сценариев)
+PRICE_STEPS = tuple(range(-30, 31, 5))
+COST_STEPS = tuple(range(-30, 31, 5))
+
+
+class ScenarioBase:
+    """Показатели артикулов за 30 дней из таблицы доходности — база для сценариев"""
+
+    def __init__(self, rows):
+        rows = [row for row in rows if row.quantity > 0 and row.revenue > 0]
+        self.nm_ids = [row.nm_id for row in rows]
+        self.articles = [row.article or str(row.nm_id) for row in rows]
+
+        def column(name):
+            return np.array([getattr(row, name) or 0 for row in rows], dtype=float)
+
+        self.quantity = column("quantity")
+        self.revenue = column("revenue")
+        self.commission = column("commission")
+        self.logistics = column("logistics")
+        self.storage = column("storage")
+        self.cost_per_item = column("cost_per_item")
+        self.price = self.revenue / self.quantity if len(rows) else column("revenue")
+        # Оценённая по истории заказов эластичность (0, где оценки нет или ей нельзя верить)
+        self.elasticity = np.zeros(len(rows))
+
+    def __len__(self):
+        return len(self.nm_ids)
+
+    def evaluate(self, price, cost, elasticity=0.0):
+        """Все сценарии одним проходом.
+
+        price — новая цена за штуку (n, P), cost — новая себестоимость (n, C),
+        elasticity — эластичность спроса по цене: число (0 — продажи как в истории)
+        или None — оценка по истории заказов для каждого артикула.
+        Возвращает словарь массивов (n, P, C): quantity, revenue, profit.
+        Комиссия меняется вместе с выручкой, логистика и хранение — с количеством.
+        """
+        if elasticity is None:
+            elasticity = self.elasticity[:, None]
+        ratio = price / self.price[:, None]
+        quantity = self.quantity[:, None] * np.power(ratio, elasticity)
+        revenue = price * quantity
+        volume = quantity / self.quantity[:, None]
+        expenses = (
+            self.commission[:, None] * (revenue / self.revenue[:, None])
+            + (self.logistics + self.storage)[:, None] * volume
+        )
+        profit = (revenue - expenses)[:, :, None] - cost[:, None, :] * quantity[:, :, None]
+        shape = profit.shape
+        return {
+            "quantity": np.broadcast_to(quantity[:, :, None], shape),
+            "revenue": np.broadcast_to(revenue[:, :, None], shape),
+            "profit": profit,
+        }
+
+    def baseline_profit(self):
+        return self.revenue - self.commission - self.logistics - self.storage - self.cost_per_item * self.quantity
+
+    def grid(self, price_steps=PRICE_STEPS, cost_steps=COST_STEPS, elasticity=0.0):
+        """Сетка сценариев в процентах изменения цены и себестоимости"""
+        price = self.price[:, None] * (1 + np.asarray(price_steps, dtype=float) / 100)[None, :]
+        cost = self.cost_per_item[:, None] * (1 + np.asarray(cost_steps, dtype=float) / 100)[None, :]
+        return self.evaluate(price, cost, elasticity)
+
+
+def load_scenario_base(shop_id: int, nm_id=None):
+    session = sessionmaker(bind=engine)()
+    try:
+        ensure_profitability(session, shop_id)
+        query = session.query(ArticleProfitability).filter(
+            ArticleProfitability.shop_id == shop_id, ArticleProfitability.period == "30d"
+        )
+        if nm_id is not None:
+            query = query.filter(ArticleProfitability.nm_id == nm_id)
+        base = ScenarioBase(query.all())
+        estimates = shop_elasticities(session, shop_id)
+        base.elasticity = np.array([estimates.get(nm_id, 0.0) for nm_id in base.nm_ids], dtype=float)
+        return base
+    finally:
+        session.close()
+
+
+def grid_summary(base, elasticity=0.0, price_steps=PRICE_STEPS, cost_steps=COST_STEPS):
+    """Итоги сетки по всем артикулам базы: матрицы (P, C) и лучший сценарий по артикулам"""
+    result = base.grid(price_steps, cost_steps, elasticity)
+    profit = result["profit"].sum(axis=0)
+    revenue = result["revenue"].sum(axis=0)
+    margin = np.divide(profit * 100, revenue, out=np.zeros_like(profit), where=revenue != 0)
+
+    # Лучшее изменение цены для каждого артикула при текущей себестоимости
+    current_cost = list(cost_steps).index(0) if 0 in cost_steps else len(cost_steps) // 2
+    per_article = result["profit"][:, :, current_cost]
+    best = per_article.argmax(axis=1)
+    baseline = base.baseline_profit()
+    articles = [
+        (
+            base.articles[i],
+            base.nm_ids[i],
+            float(base.price[i]),
+            price_steps[best[i]],
+            float(base.price[i] * (1 + price_steps[best[i]] / 100)),
+            float(baseline[i]),
+            float(per_article[i, best[i]]),
+        )
+        for i in range(len(base))
+    ]
+    best_cell = np.unravel_index(int(profit.argmax()), profit.shape)
+    return {
+        "price_steps": list(price_steps),
+        "cost_steps": list(cost_steps),
+        "profit": profit.tolist(),
+        "revenue": revenue.tolist(),
+        "margin": margin.tolist(),
+        "articles": articles,
+        "baseline": float(baseline.sum()),
+        "best": (price_steps[best_cell[0]], cost_steps[best_cell[1]], float(profit[best_cell])),
+        "scenarios": len(price_steps) * len(cost_steps) * len(base),
+    }
+
+
+def simulate_grid(shop_id: int, nm_id=None, elasticity=0.0):
+    """Сетка сценариев для артикула или всего каталога (None, если продаж не было)"""
+    base = load_scenario_base(shop_id, nm_id)
+    if not len(base):
+        return None
+    return grid_summary(base, elasticity)
+
+
+def simulate_one(shop_id: int, nm_id: int, new_price: float, new_cost: float, elasticity=0.0):
+    """Один сценарий для артикула: текущие и прогнозные показатели"""
+    base = load_scenario_base(shop_id, nm_id)
+    if not len(base):
+        return None
+    result = base.evaluate(np.array([[new_price]]), np.array([[new_cost]]), elasticity)
+    return {
+        "quantity": float(base.quantity[0]),
+        "revenue": float(base.revenue[0]),
+        "price": float(base.price[0]),
+        "cost": float(base.cost_per_item[0]),
+        "profit": float(base.baseline_profit()[0]),
+        "elasticity": float(base.elasticity[0]) if elasticity is None else elasticity,
+        "forecast_quantity": float(result["quantity"][0, 0, 0]),
+        "forecast_revenue": float(result["revenue"][0, 0, 0]),
+        "forecast_profit": float(result["profit"][0, 0, 0]),
+    }
+
+
+async def run_simulation(func, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, func, *args)
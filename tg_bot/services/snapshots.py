@@ -0,0 +1,107 @@
+import os
+import json
+import glob
+import logging
+import struct
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Каталог снапшотов (общий том у загрузчика и бота)
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", "snapshots")
+# Сколько последних версий оставлять на диске (старые могут быть ещё открыты ботом)
+SNAPSHOT_KEEP = 2
+
+MAGIC = b"WBSNAP03"  # 03: srid — колонка хэшей, а не таблица строк в заголовке
+ALIGN = 64
+_PREFIX = struct.Struct("<8sQ")  # magic, длина заголовка
+
+
+def _align(value):
+    return (value + ALIGN - 1) // ALIGN * ALIGN
+
+
+def snapshot_path(shop_id: int, version: int) -> str:
+    return os.path.join(SNAPSHOT_DIR, f"shop_{shop_id}.v{version}.snap")
+
+
+def write_snapshot(shop_id: int, version: int, arrays: dict, strings: dict):
+    """Атомарно пишет неизменяемый снапшот магазина.
+
+    arrays — колонки фиксированной ширины одинаковой длины,
+    strings — таблицы строк для словарно закодированных колонок.
+    Файл: magic, JSON-заголовок, затем выровненные массивы.
+    """
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    columns = []
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        columns.append({
+            "name": name,
+            "dtype": array.dtype.str,
+            "offset": offset,
+            "count": len(array),
+        })
+        offset = _align(offset + array.nbytes)
+    header = json.dumps({
+        "shop_id": shop_id,
+        "version": version,
+        "columns": columns,
+        "strings": strings,
+    }, ensure_ascii=False).encode("utf-8")
+    data_start = _align(_PREFIX.size + len(header))
+
+    path = snapshot_path(shop_id, version)
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(_PREFIX.pack(MAGIC, len(header)))
+        f.write(header)
+        for column, array in zip(columns, arrays.values()):
+            f.seek(data_start + column["offset"])
+            f.write(np.ascontiguousarray(array).tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    logger.info(f"Shop {shop_id}: snapshot v{version} written ({os.path.getsize(path)} bytes)")
+    _cleanup(shop_id, version)
+    return path
+
+
+def read_snapshot(shop_id: int, version: int):
+    """Отображает снапшот в память без копирования: (arrays, strings) или None"""
+    path = snapshot_path(shop_id, version)
+    if not os.path.exists(path):
+        return None
+    try:
+        buffer = np.memmap(path, dtype=np.uint8, mode="r")
+        magic, header_len = _PREFIX.unpack(bytes(buffer[:_PREFIX.size]))
+        if magic != MAGIC:
+            logger.error(f"Shop {shop_id}: bad snapshot {path}")
+            return None
+        header = json.loads(bytes(buffer[_PREFIX.size:_PREFIX.size + header_len]).decode("utf-8"))
+        data_start = _align(_PREFIX.size + header_len)
+        arrays = {}
+        for column in header["columns"]:
+            dtype = np.dtype(column["dtype"])
+            start = data_start + column["offset"]
+            arrays[column["name"]] = buffer[start:start + column["count"] * dtype.itemsize].view(dtype)
+        return arrays, header["strings"]
+    except (OSError, ValueError, KeyError) as e:
+        logger.error(f"Shop {shop_id}: failed to map snapshot {path}: {e}")
+        return None
+
+
+def _cleanup(shop_id: int, version: int):
+    """Удаляет старые версии (открытые отображения продолжают работать)"""
+    for path in glob.glob(os.path.join(SNAPSHOT_DIR, f"shop_{shop_id}.v*.snap")):
+        try:
+            old_version = int(path.rsplit(".v", 1)[1].split(".")[0])
+        except ValueError:
+            continue
+        if old_version <= version - SNAPSHOT_KEEP:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logger.warning(f"Failed to remove snapshot {path}: {e}")
@@ -0,0 +1,237 @@
+import io
+import os
+import re
+import math
+import zipfile
+import logging
+import posixpath
+from xml.sax.saxutils import escape
+
+from openpyxl.utils import column_index_from_string, get_column_letter
+
+logger = logging.getLogger(__name__)
+
+# Шаблоны отчётов: разбираются один раз на процесс, дальше меняются только ячейки со значениями
+PNL_TEMPLATES = ("pnl_template.xlsx", "pnl_template_year.xlsx")
+
+_ROW = re.compile(r'<row\b[^>]*?\br="(\d+)"[^>]*?(/?)>', re.S)
+_CELL = re.compile(r'<c\b[^>]*?\br="([A-Z]+)(\d+)"[^>]*?(?:/>|>.*?</c>)', re.S)
+_STYLE = re.compile(r'\bs="(\d+)"')
+_SHARED_MASTER = re.compile(r'<f\b[^>]*?\bt="shared"[^>]*?\bref="', re.S)
+_DIMENSION = re.compile(r'<dimension\b[^>]*?\bref="([A-Z]+)(\d+)(?::([A-Z]+)(\d+))?"[^>]*/>')
+
+
+class XlsxTemplate:
+    """Разобранный xlsx-шаблон: части архива в памяти и индекс ячеек активного листа.
+
+    render(cells) не разбирает книгу заново: в XML листа подменяются (или вставляются)
+    только указанные ячейки, остальные части архива пишутся как есть.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.mtime = os.path.getmtime(path)
+        with zipfile.ZipFile(path) as archive:
+            self.infos = [info for info in archive.infolist() if info.filename != "xl/calcChain.xml"]
+            self.parts = {info.filename: archive.read(info.filename) for info in self.infos}
+
+        # calcChain пересоберёт Excel; формулы пересчитываются при открытии
+        self._drop_calc_chain()
+        self.parts["xl/workbook.xml"] = _full_calc_on_load(self.parts["xl/workbook.xml"].decode("utf-8")).encode("utf-8")
+
+        self.sheet_part = self._active_sheet_part()
+        self.sheet = self.parts[self.sheet_part].decode("utf-8")
+        self._index()
+
+    def _drop_calc_chain(self):
+        rels = "xl/_rels/workbook.xml.rels"
+        self.parts[rels] = re.sub(
+            rb'<Relationship\b[^>]*?Target="[^"]*calcChain\.xml"[^>]*/>', b"", self.parts[rels]
+        )
+        self.parts["[Content_Types].xml"] = re.sub(
+            rb'<Override\b[^>]*?PartName="/xl/calcChain\.xml"[^>]*/>', b"", self.parts["[Content_Types].xml"]
+        )
+
+    def _active_sheet_part(self):
+        """Путь XML активного листа (как wb.active в openpyxl)"""
+        workbook = self.parts["xl/workbook.xml"].decode("utf-8")
+        active = re.search(r'\bactiveTab="(\d+)"', workbook)
+        sheets = re.findall(r'<sheet\b[^>]*?\br:id="([^"]+)"', workbook)
+        rel_id = sheets[int(active.group(1)) if active else 0]
+        rels = self.parts["xl/_rels/workbook.xml.rels"].decode("utf-8")
+        for rel in re.findall(r"<Relationship\b[^>]*/>", rels):
+            if f'Id="{rel_id}"' in rel:
+                target = re.search(r'Target="([^"]+)"', rel).group(1)
+                return target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join("xl", target))
+        raise ValueError(f"{self.path}: active sheet not found")
+
+    def _index(self):
+        """Позиции строк и ячеек в XML листа"""
+        sheet = self.sheet
+        self.rows = {}
+        self.dimension = _DIMENSION.search(sheet)
+        # Ячейки с ведущей общей формулой: от её текста зависят соседние ячейки
+        self.shared_masters = set()
+        data_start = sheet.index("<sheetData")
+        empty = sheet.startswith("<sheetData/>", data_start)
+        self.data_end = data_start if empty else sheet.index("</sheetData>")
+        self.empty_data = empty
+        for match in _ROW.finditer(sheet, data_start, self.data_end):
+            closed = match.group(2) == "/"
+            end = match.end() if closed else sheet.index("</row>", match.end())
+            cells = {}
+            if not closed:
+                for cell in _CELL.finditer(sheet, match.end(), end):
+                    style = _STYLE.search(cell.group(0).split(">", 1)[0])
+                    cells[column_index_from_string(cell.group(1))] = (
+                        cell.start(), cell.end(), style.group(1) if style else None
+                    )
+                    if _SHARED_MASTER.search(cell.group(0)):
+                        self.shared_masters.add(cell.group(1) + cell.group(2))
+            self.rows[int(match.group(1))] = {
+                "start": match.start(),
+                "open_end": match.end(),
+                "end": end,
+                "closed": closed,
+                "cells": cells,
+            }
+
+    def render(self, cells: dict) -> bytes:
+        """xlsx с подставленными значениями {адрес: значение}.
+
+        ValueError — в ячейке ведущая общая формула: замена сломала бы зависимые
+        ячейки, такой шаблон заполняется через openpyxl.
+        """
+        overwritten = self.shared_masters.intersection(cells)
+        if overwritten:
+            raise ValueError(f"{self.path}: shared formula in {', '.join(sorted(overwritten))}")
+        by_row = {}
+        for address, value in cells.items():
+            letters = address.rstrip("0123456789")
+            by_row.setdefault(int(address[len(letters):]), []).append(
+                (column_index_from_string(letters), address, value)
+            )
+
+        edits = []  # (начало, конец, текст)
+        new_rows = []
+        for row_number, row_cells in sorted(by_row.items()):
+            row_cells.sort()
+            row = self.rows.get(row_number)
+            if row is None:
+                xml = "".join(_cell_xml(address, value, None) for _, address, value in row_cells)
+                new_rows.append((row_number, f'<row r="{row_number}">{xml}</row>'))
+                continue
+            inserts = []
+            for column, address, value in row_cells:
+                existing = row["cells"].get(column)
+                if existing is not None:
+                    start, end, style = existing
+                    edits.append((start, end, _cell_xml(address, value, style)))
+                else:
+                    inserts.append((column, _cell_xml(address, value, None)))
+            if not inserts:
+                continue
+            if row["closed"]:
+                tag = self.sheet[row["start"]:row["open_end"]]
+                xml = "".join(text for _, text in inserts)
+                edits.append((row["start"], row["end"], f"{tag[:-2]}>{xml}</row>"))
+                continue
+            positions = sorted(row["cells"].items())
+            for column, text in inserts:
+                position = next((start for col, (start, _, _) in positions if col > column), row["end"])
+                edits.append((position, position, text))
+
+        for row_number, text in new_rows:
+            following = [r["start"] for number, r in self.rows.items() if number > row_number]
+            position = min(following) if following else self.data_end
+            edits.append((position, position, text))
+        if self.empty_data and new_rows:
+            # В пустом листе других правок нет: <sheetData/> -> <sheetData>...</sheetData>
+            rows = "".join(text for _, text in new_rows)
+            edits = [(self.data_end, self.data_end + len("<sheetData/>"), f"<sheetData>{rows}</sheetData>")]
+        if self.dimension is not None and by_row:
+            edits.append(self._dimension_edit(by_row))
+
+        chunks = []
+        position = 0
+        for start, end, text in sorted(edits, key=lambda edit: (edit[0], edit[1] != edit[0])):
+            chunks.append(self.sheet[position:start])
+            chunks.append(text)
+            position = max(position, end)
+        chunks.append(self.sheet[position:])
+        sheet = "".join(chunks).encode("utf-8")
+
+        stream = io.BytesIO()
+        with zipfile.ZipFile(stream, "w", zipfile.ZIP_DEFLATED) as archive:
+            for info in self.infos:
+                data = sheet if info.filename == self.sheet_part else self.parts[info.filename]
+                archive.writestr(zipfile.ZipInfo(info.filename, info.date_time), data, zipfile.ZIP_DEFLATED)
+        return stream.getvalue()
+
+
+    def _dimension_edit(self, by_row):
+        """<dimension ref> с учётом новых строк и колонок"""
+        first_col, first_row, last_col, last_row = self.dimension.groups()
+        first_col, first_row = column_index_from_string(first_col), int(first_row)
+        last_col = column_index_from_string(last_col) if last_col else first_col
+        last_row = int(last_row) if last_row else first_row
+        columns = [column for row_cells in by_row.values() for column, _, _ in row_cells]
+        first_col, last_col = min(first_col, *columns), max(last_col, *columns)
+        first_row, last_row = min(first_row, *by_row), max(last_row, *by_row)
+        ref = f"{get_column_letter(first_col)}{first_row}:{get_column_letter(last_col)}{last_row}"
+        return self.dimension.start(), self.dimension.end(), f'<dimension ref="{ref}"/>'
+
+
+def _cell_xml(address, value, style):
+    style_attr = f' s="{style}"' if style is not None else ""
+    if value is not None and not isinstance(value, (bool, str)) and not math.isfinite(value):
+        # NaN/inf в <v> Excel считает повреждением файла — ячейка остаётся пустой
+        value = None
+    if value is None:
+        return f'<c r="{address}"{style_attr}/>'
+    if isinstance(value, bool):
+        return f'<c r="{address}"{style_attr} t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, str):
+        if value.startswith("="):
+            return f'<c r="{address}"{style_attr}><f>{escape(value[1:])}</f></c>'
+        return f'<c r="{address}"{style_attr} t="inlineStr"><is><t>{escape(value)}</t></is></c>'
+    return f'<c r="{address}"{style_attr}><v>{repr(float(value)) if not isinstance(value, int) else value}</v></c>'
+
+
+def _full_calc_on_load(workbook: str) -> str:
+    if "<calcPr" in workbook:
+        if "fullCalcOnLoad" not in workbook:
+            workbook = workbook.replace("<calcPr", '<calcPr fullCalcOnLoad="1"', 1)
+        return workbook
+    # calcPr идёт после definedNames / externalReferences / sheets
+    for anchor in ("</definedNames>", "</externalReferences>", "</functionGroups>", "</sheets>"):
+        if anchor in workbook:
+            return workbook.replace(anchor, anchor + '<calcPr fullCalcOnLoad="1"/>', 1)
+    return workbook
+
+
+_templates = {}
+
+
+def get_template(path: str):
+    """Разобранный шаблон из кэша процесса (перечитывается при изменении файла) или None"""
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    template = _templates.get(path)
+    if template is None or template.mtime != mtime:
+        try:
+            template = XlsxTemplate(path)
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile) as e:
+            logger.error(f"Failed to preload template {path}: {e}")
+            return None
+        _templates[path] = template
+    return template
+
+
+def preload_templates(paths=PNL_TEMPLATES):
+    """Разбор шаблонов при старте процесса пула"""
+    for path in paths:
+        get_template(path)
+
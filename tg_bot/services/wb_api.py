@@ -1,13 +1,89 @@
+import os
+import hashlib
 import requests
 import logging
 from datetime import datetime, timedelta
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 import time
+
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert
+from sqlalchemy.exc import OperationalError
+
+from tg_bot.models import sessionmaker, engine, ApiRateBudget
+from tg_bot.services.dedup import dedup_rows
 logger = logging.getLogger(__name__)
 
 executor = ThreadPoolExecutor(max_workers=5)
 
+# Лимит WB на reportDetailByPeriod для одного токена
+REPORT_RATE_PER_MINUTE = float(os.getenv("WB_REPORT_RATE_PER_MINUTE", 1))
+
+
+class RateBudget:
+    """Ограничение частоты запросов одного токена, общее для всех процессов.
+
+    Бот, загрузчики и интерактивные запросы резервируют слоты в api_rate_budgets:
+    запись в SQLite сериализуется, поэтому лимит WB соблюдается суммарно.
+    """
+
+    def __init__(self, api_token: str, per_minute: float):
+        self.key = hashlib.sha256(api_token.encode()).hexdigest()
+        self.interval = 60.0 / per_minute
+
+    def _reserve(self, now: float, wait: bool):
+        """Слот запроса: время (time.time()), когда его можно отправить, или None"""
+        session = sessionmaker(bind=engine)()
+        try:
+            session.execute(
+                insert(ApiRateBudget)
+                .values(key=self.key, next_at=0)
+                .on_conflict_do_nothing(index_elements=["key"])
+            )
+            query = session.query(ApiRateBudget).filter(ApiRateBudget.key == self.key)
+            if not wait:
+                query = query.filter(ApiRateBudget.next_at <= now)
+            reserved = query.update(
+                {ApiRateBudget.next_at: func.max(ApiRateBudget.next_at, now) + self.interval},
+                synchronize_session=False,
+            )
+            next_at = session.query(ApiRateBudget.next_at).filter(ApiRateBudget.key == self.key).scalar()
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+        return next_at - self.interval if reserved else None
+
+    def acquire(self):
+        """Ждёт своего слота (слоты раздаются по очереди резервирования)"""
+        while True:
+            try:
+                slot = self._reserve(time.time(), wait=True)
+                break
+            except OperationalError as e:
+                # База занята записью другого процесса — пробуем ещё раз
+                logger.warning(f"Rate budget is busy: {e}")
+                time.sleep(1)
+        delay = slot - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def try_acquire(self) -> bool:
+        """Берёт запрос, только если он свободен прямо сейчас (для интерактивных запросов)"""
+        try:
+            return self._reserve(time.time(), wait=False) is not None
+        except OperationalError as e:
+            logger.warning(f"Rate budget is busy: {e}")
+            return False
+
+
+def rate_budget(api_token: str, per_minute: float = REPORT_RATE_PER_MINUTE) -> RateBudget:
+    """Бюджет запросов токена (состояние — в БД, общее для всех процессов)"""
+    return RateBudget(api_token, per_minute)
+
 
 async def fetch_report_async(api_token: str, date_from: datetime, date_to: datetime):
     """Асинхронная обертка для получения отчета"""
@@ -38,7 +114,8 @@ async def fetch_full_report(api_token: str, start_date: datetime, end_date: date
     full_report = []
     for result in results:
         full_report.extend(result)
-    return full_report
+    # Окна могут пересекаться — одна строка на rrd_id
+    return dedup_rows(full_report)
 
 
 def fetch_report_detail_by_period(api_token: str, date_from: datetime, date_to: datetime, retries=3, delay=5):
@@ -54,7 +131,7 @@ def fetch_report_detail_by_period(api_token: str, date_from: datetime, date_to:
         try:
             response = requests.get(url, headers=headers, params=params, timeout=30)
             if response.status_code == 200:
-                return response.json()
+                return dedup_rows(response.json())
             
             # Обработка ошибки 429 (Too Many Requests)
             if response.status_code == 429:
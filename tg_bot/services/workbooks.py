@@ -0,0 +1,339 @@
+import io
+import os
+import asyncio
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import openpyxl
+from openpyxl import load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Border, Side, Alignment, NamedStyle, Font
+from openpyxl.formatting.rule import ColorScaleRule
+from openpyxl.utils import get_column_letter
+
+from tg_bot.services.templates import get_template, preload_templates
+
+logger = logging.getLogger(__name__)
+
+# Процессы для сборки Excel: openpyxl держит GIL, в потоке он тормозит бота
+WORKBOOK_WORKERS = int(os.getenv("WORKBOOK_WORKERS", min(4, os.cpu_count() or 1)))
+# С какого числа артикулов товарная аналитика пишется потоково (write-only, без шаблона)
+STREAMING_ROWS = int(os.getenv("WORKBOOK_STREAMING_ROWS", 2000))
+
+# Колонки товарной аналитики: проценты, суммы с копейками и средние в строке ИТОГО
+PERCENT_COLUMNS = (5, 11, 13, 16, 20, 27, 28, 29)
+AVERAGE_COLUMNS = (5, 6, 11, 13, 16, 18, 20, 24)
+# Группы ABC/XYZ (текст) и последняя колонка, для которой считается строка ИТОГО
+CLASS_COLUMNS = (24, 25, 26)
+TOTAL_COLUMNS = 23
+
+_executor = None
+
+
+def workbook_executor():
+    global _executor
+    if _executor is None:
+        # Каждый процесс пула разбирает шаблоны один раз при старте
+        _executor = ProcessPoolExecutor(max_workers=WORKBOOK_WORKERS, initializer=preload_templates)
+    return _executor
+
+
+def start_workbook_pool():
+    """Поднимает процессы пула при старте бота, чтобы первый отчёт не ждал разбора шаблонов"""
+    executor = workbook_executor()
+    for _ in range(WORKBOOK_WORKERS):
+        executor.submit(preload_templates)
+
+
+async def build_workbook(builder, *args) -> bytes:
+    """Собирает книгу в пуле процессов: builder(*args) получает готовые строки и возвращает bytes"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(workbook_executor(), builder, *args)
+
+
+def _template(path: str, title: str):
+    try:
+        wb = load_workbook(path)
+    except FileNotFoundError:
+        wb = openpyxl.Workbook()
+        wb.active.title = title
+    return wb
+
+
+def _to_bytes(wb) -> bytes:
+    stream = io.BytesIO()
+    wb.save(stream)
+    return stream.getvalue()
+
+
+def pnl_workbook(template: str, title: str, cells: dict) -> bytes:
+    """Шаблон PNL, заполненный значениями {адрес ячейки: значение}"""
+    preloaded = get_template(template)
+    if preloaded is not None:
+        try:
+            return preloaded.render(cells)
+        except ValueError as e:
+            logger.warning(f"Template render fell back to openpyxl: {e}")
+    wb = _template(template, title)
+    ws = wb.active
+    for address, value in cells.items():
+        ws[address] = value
+    return _to_bytes(wb)
+
+
+def product_analytics_workbook(headers: list, rows: list) -> bytes:
+    """Товарная аналитика: заголовки, строки по артикулам и итоговая строка"""
+    if len(rows) >= STREAMING_ROWS:
+        return product_analytics_streaming(headers, rows)
+    wb = _template("template.xlsx", "Товарная аналитика")
+    ws = wb.active
+    ws.title = "Товарная аналитика"
+
+    for col_num, header in enumerate(headers, 1):
+        ws.cell(row=1, column=col_num, value=header)
+    for row_num, values in enumerate(rows, 2):
+        for col_num, value in enumerate(values, 1):
+            ws.cell(row=row_num, column=col_num, value=value)
+
+    # Итоговая строка
+    last_row = ws.max_row + 1
+    ws.cell(row=last_row, column=1, value="ИТОГО")
+    for col in range(3, TOTAL_COLUMNS + 1):  # От "Выручки" до "Налога"; ABC/XYZ без итога
+        col_letter = get_column_letter(col)
+        if col in AVERAGE_COLUMNS:  # Столбцы для средних значений
+            ws.cell(row=last_row, column=col, value=f"=AVERAGE({col_letter}2:{col_letter}{last_row - 1})")
+        else:  # Сумма по остальным столбцам
+            ws.cell(row=last_row, column=col, value=f"=SUM({col_letter}2:{col_letter}{last_row - 1})")
+    apply_excel_formatting(ws)
+    return _to_bytes(wb)
+
+
+def _analytics_styles():
+    """Именованные стили листа аналитики (те же, что даёт apply_excel_formatting)"""
+    border = Border(
+        left=Side(style="thin"),
+        right=Side(style="thin"),
+        top=Side(style="thin"),
+        bottom=Side(style="thin"),
+    )
+    header = NamedStyle(name="analytics_header", border=border)
+    header.alignment = Alignment(horizontal="center", vertical="center")
+    styles = [header]
+    for name, number_format in (
+        ("analytics_text", "General"),
+        ("analytics_percent", "0.00%"),
+        ("analytics_money", "#,##0.00"),
+        ("analytics_int", "#,##0"),
+    ):
+        styles.append(NamedStyle(name=name, border=border, number_format=number_format))
+    return styles
+
+
+def _column_style(col: int) -> str:
+    if col < 3 or col in CLASS_COLUMNS:
+        return "analytics_text"
+    if col in PERCENT_COLUMNS:
+        return "analytics_percent"
+    if 7 <= col <= 24 and col not in (10, 11):
+        return "analytics_money"
+    return "analytics_int"
+
+
+def product_analytics_streaming(headers: list, rows: list) -> bytes:
+    """Товарная аналитика в write-only режиме: строки пишутся потоком, стиль — по колонке.
+
+    Память не зависит от числа артикулов: openpyxl не держит ячейки листа.
+    """
+    wb = openpyxl.Workbook(write_only=True)
+    ws = wb.create_sheet("Товарная аналитика")
+    for style in _analytics_styles():
+        wb.add_named_style(style)
+
+    # Ширина колонок считается до записи (в write-only её задают заранее)
+    last_row = len(rows) + 2
+    widths = [len(str(header)) for header in headers]
+    for values in rows:
+        for i, value in enumerate(values):
+            length = len(str(value))
+            if length > widths[i]:
+                widths[i] = length
+    widths[0] = max(widths[0], len("ИТОГО"))
+    for i in range(2, len(headers)):
+        widths[i] = max(widths[i], len(f"=AVERAGE(XX2:XX{last_row - 1})"))
+    for i, width in enumerate(widths, 1):
+        ws.column_dimensions[get_column_letter(i)].width = (width + 2) * 1.2
+    ws.freeze_panes = "A2"
+
+    # Стиль колонки разрешаем один раз; ячейки строки делят готовый StyleArray
+    styles = []
+    for col in range(1, len(headers) + 1):
+        prototype = WriteOnlyCell(ws)
+        prototype.style = _column_style(col)
+        styles.append(prototype._style)
+
+    def styled(values):
+        row = []
+        for value, style in zip(values, styles):
+            cell = WriteOnlyCell(ws, value=value)
+            cell._style = style
+            row.append(cell)
+        return row
+
+    header_row = []
+    for header in headers:
+        cell = WriteOnlyCell(ws, value=header)
+        cell.style = "analytics_header"
+        header_row.append(cell)
+    ws.append(header_row)
+    for values in rows:
+        ws.append(styled(values))
+
+    # Итоговая строка
+    totals = ["ИТОГО", None]
+    for col in range(3, TOTAL_COLUMNS + 1):
+        col_letter = get_column_letter(col)
+        function = "AVERAGE" if col in AVERAGE_COLUMNS else "SUM"
+        totals.append(f"={function}({col_letter}2:{col_letter}{last_row - 1})")
+    ws.append(styled(totals))
+    return _to_bytes(wb)
+
+
+def cost_workbook(rows: list) -> bytes:
+    """Лист «Себестоимость»: артикул и себестоимость"""
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = "Себестоимость"
+    ws.append(["Артикул", "Себестоимость"])
+    for row in rows:
+        ws.append(list(row))
+    return _to_bytes(wb)
+
+
+def scenario_workbook(title: str, summary: dict) -> bytes:
+    """Сетка сценариев симулятора: тепловые карты прибыли и рентабельности, лучший сценарий по артикулам"""
+    wb = openpyxl.Workbook()
+    wb.remove(wb.active)
+    price_steps, cost_steps = summary["price_steps"], summary["cost_steps"]
+    bold = Font(bold=True)
+    for sheet_title, name, number_format in (
+        ("Прибыль", "profit", "#,##0"),
+        ("Рентабельность", "margin", "0.0"),
+        ("Выручка", "revenue", "#,##0"),
+    ):
+        ws = wb.create_sheet(sheet_title)
+        ws.append([title])
+        ws["A1"].font = bold
+        ws.append(["Цена \\ Себестоимость"] + [f"{step:+d}%" for step in cost_steps])
+        for step, values in zip(price_steps, summary[name]):
+            ws.append([f"{step:+d}%"] + [round(value, 2) for value in values])
+        last_row = len(price_steps) + 2
+        last_col = get_column_letter(len(cost_steps) + 1)
+        for row in ws.iter_rows(min_row=3, max_row=last_row, min_col=2, max_col=len(cost_steps) + 1):
+            for cell in row:
+                cell.number_format = number_format
+        for cell in ws[2] + tuple(row[0] for row in ws.iter_rows(min_row=3, max_row=last_row, max_col=1)):
+            cell.font = bold
+            cell.alignment = Alignment(horizontal="center")
+        ws.conditional_formatting.add(
+            f"B3:{last_col}{last_row}",
+            ColorScaleRule(start_type="min", start_color="F8696B", mid_type="percentile", mid_value=50,
+                           mid_color="FFEB84", end_type="max", end_color="63BE7B"),
+        )
+        ws.column_dimensions["A"].width = 24
+        ws.freeze_panes = "B3"
+
+    ws = wb.create_sheet("Артикулы")
+    ws.append(["Артикул", "nm_id", "Цена сейчас", "Лучшее изменение цены", "Цена", "Прибыль сейчас", "Прибыль"])
+    for cell in ws[1]:
+        cell.font = bold
+    for article, nm_id, price, step, new_price, profit, new_profit in summary["articles"]:
+        ws.append([article, nm_id, round(price, 2), f"{step:+d}%", round(new_price, 2), round(profit, 2), round(new_profit, 2)])
+    for letter, width in zip("ABCDEFG", (20, 12, 14, 22, 14, 16, 16)):
+        ws.column_dimensions[letter].width = width
+    ws.freeze_panes = "A2"
+    return _to_bytes(wb)
+
+
+def order_cube_workbook(title: str, sheets: list) -> bytes:
+    """Срезы куба заказов: лист на измерение (название, строки показателей)"""
+    wb = openpyxl.Workbook()
+    wb.remove(wb.active)
+    bold = Font(bold=True)
+    headers = ["Заказы", "Отмены", "Выкупы", "% выкупа", "% отмен", "Сумма заказов", "Сумма выкупов"]
+    formats = ("#,##0", "#,##0", "#,##0", "0.00%", "0.00%", "#,##0.00", "#,##0.00")
+    for sheet_title, dimension_title, items in sheets:
+        ws = wb.create_sheet(sheet_title)
+        ws.append([title])
+        ws["A1"].font = bold
+        ws.append([dimension_title] + headers)
+        for cell in ws[2]:
+            cell.font = bold
+            cell.alignment = Alignment(horizontal="center")
+        for item in items:
+            ws.append([
+                item["name"], item["orders"], item["cancellations"], item["buyouts"],
+                item["buyout_rate"], item["cancel_rate"], item["revenue"], item["buyout_revenue"],
+            ])
+        for row in ws.iter_rows(min_row=3, max_row=ws.max_row, min_col=2, max_col=len(headers) + 1):
+            for cell, number_format in zip(row, formats):
+                cell.number_format = number_format
+        ws.column_dimensions["A"].width = 40
+        for col in range(2, len(headers) + 2):
+            ws.column_dimensions[get_column_letter(col)].width = 16
+        ws.freeze_panes = "B3"
+    return _to_bytes(wb)
+
+
+def apply_excel_formatting(ws):
+    """Применяет форматирование к Excel-листу"""
+    # Устанавливаем ширину столбцов
+    for col in ws.columns:
+        max_length = 0
+        column = col[0].column_letter
+        for cell in col:
+            try:
+                if len(str(cell.value)) > max_length:
+                    max_length = len(str(cell.value))
+            except:
+                pass
+        adjusted_width = (max_length + 2) * 1.2
+        ws.column_dimensions[column].width = adjusted_width
+
+    # Форматирование чисел
+    for row in ws.iter_rows(
+        min_row=2, max_row=ws.max_row, min_col=3, max_col=ws.max_column
+    ):
+        for cell in row:
+            if isinstance(cell.value, (int, float)):
+                # Проценты
+                if cell.column_letter in ["E", "K", "M", "P", "T", "AA", "AB", "AC"]:
+                    cell.number_format = "0.00%"
+                elif (
+                    cell.column >= 7
+                    and cell.column <= 24
+                    and cell.column not in [10, 11]
+                ):
+                    cell.number_format = "#,##0.00"
+                else:
+                    cell.number_format = "#,##0"
+
+    # Границы
+    thin_border = Border(
+        left=Side(style="thin"),
+        right=Side(style="thin"),
+        top=Side(style="thin"),
+        bottom=Side(style="thin"),
+    )
+
+    for row in ws.iter_rows(
+        min_row=1, max_row=ws.max_row, min_col=1, max_col=ws.max_column
+    ):
+        for cell in row:
+            cell.border = thin_border
+
+    # Выравнивание заголовков
+    for cell in ws[1]:
+        cell.alignment = Alignment(horizontal="center", vertical="center")
+
+    # Фиксируем заголовки
+    ws.freeze_panes = "A2"
@@ -0,0 +1,109 @@
+"""Проверка и замер подстановки значений в разобранный xlsx-шаблон.
+
+python -m tools.check_templates            — round-trip на сгенерированном шаблоне
+python -m tools.check_templates --bench    — замер на шаблонах PNL (или путях после флага)
+"""
+import io
+import os
+import re
+import sys
+import time
+import zipfile
+import tempfile
+
+import openpyxl
+from openpyxl.styles import Font
+
+from tg_bot.services.templates import XlsxTemplate, get_template, PNL_TEMPLATES
+
+
+def _generated_template(path: str):
+    """Шаблон со стилями, формулой и общей формулой C2:C5 (openpyxl такие не пишет — правим XML)"""
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    for row in range(1, 6):
+        ws.cell(row=row, column=1, value=row)
+        ws.cell(row=row, column=2, value=f"строка {row}").font = Font(bold=True)
+        ws.cell(row=row, column=3, value=f"=A{row}*2")
+    ws["E3"] = "=SUM(A1:A5)"
+    stream = io.BytesIO()
+    wb.save(stream)
+
+    with zipfile.ZipFile(stream) as source:
+        parts = {info.filename: source.read(info.filename) for info in source.infolist()}
+    sheet = parts["xl/worksheets/sheet1.xml"].decode("utf-8")
+    sheet = sheet.replace("<f>A2*2</f>", '<f t="shared" ref="C2:C5" si="0">A2*2</f>')
+    for row in range(3, 6):
+        sheet = sheet.replace(f"<f>A{row}*2</f>", '<f t="shared" si="0"/>')
+    parts["xl/worksheets/sheet1.xml"] = sheet.encode("utf-8")
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as target:
+        for name, data in parts.items():
+            target.writestr(name, data)
+
+
+def check_round_trip():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "template.xlsx")
+        _generated_template(path)
+        template = XlsxTemplate(path)
+
+        try:
+            template.render({"C2": 1})
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("shared formula master was overwritten")
+
+        document = template.render({
+            "A1": 10.5,
+            "D2": 7,
+            "B4": "новое значение",
+            "C4": 3,
+            "F3": float("nan"),
+            "A5": float("inf"),
+            "H20": "=A1+D2",
+            "G12": -1.25,
+        })
+        wb = openpyxl.load_workbook(io.BytesIO(document))
+        ws = wb.active
+        expected = {
+            "A1": 10.5, "D2": 7, "B4": "новое значение", "C4": 3, "F3": None, "A5": None,
+            "H20": "=A1+D2", "G12": -1.25, "A2": 2, "C3": "=A3*2", "E3": "=SUM(A1:A5)",
+        }
+        for address, value in expected.items():
+            assert ws[address].value == value, (address, ws[address].value, value)
+        assert ws["B4"].font.bold, "style of an overwritten cell was lost"
+        assert ws.dimensions == "A1:H20", ws.dimensions
+        sheet = zipfile.ZipFile(io.BytesIO(document)).read("xl/worksheets/sheet1.xml").decode("utf-8")
+        assert not re.search(r"<v>(nan|inf|-inf)</v>", sheet)
+    print("template round-trip: ok")
+
+
+def benchmark(paths, runs=50):
+    """Сравнение load_workbook+save и подстановки в разобранный шаблон"""
+    cells = {f"{letter}{row}": row * 1000.5 for letter in "CEFGHIJKL" for row in range(3, 14)}
+    for path in paths:
+        if get_template(path) is None:
+            print(f"{path}: not found")
+            continue
+        started = time.perf_counter()
+        for _ in range(runs):
+            wb = openpyxl.load_workbook(path)
+            ws = wb.active
+            for address, value in cells.items():
+                ws[address] = value
+            wb.save(io.BytesIO())
+        openpyxl_ms = (time.perf_counter() - started) / runs * 1000
+
+        started = time.perf_counter()
+        for _ in range(runs):
+            get_template(path).render(cells)
+        template_ms = (time.perf_counter() - started) / runs * 1000
+        print(f"{path}: load_workbook {openpyxl_ms:.1f} ms, preloaded {template_ms:.1f} ms per report")
+
+
+if __name__ == "__main__":
+    if "--bench" in sys.argv:
+        benchmark(sys.argv[sys.argv.index("--bench") + 1:] or PNL_TEMPLATES)
+    else:
+        check_round_trip()